@@ -0,0 +1,24 @@
+<?php
+// Forwards the request to the ingest service (Python/ingestService.py), which validates the row and inserts it with others
+// Its address is in the environment variable ingestAddress, as host:port
+function forwardToIngest($path) {
+  $url = "http://" . getenv("ingestAddress") . $path . "?" . $_SERVER["QUERY_STRING"];
+  $context = stream_context_create(array("http" => array("method" => "GET", "timeout" => 5, "ignore_errors" => true)));
+  $response = @file_get_contents($url, false, $context);
+
+  if($response === FALSE) {
+    http_response_code(503);
+    echo "<html>\n  <body>\n    An error ocurred: ingest service unreachable\n  </body>\n</html>";
+    return;
+  }
+
+  // Same status as the service's answer (like "HTTP/1.1 503 Service Unavailable"), and when to try again if it's busy
+  $status = explode(" ", $http_response_header[0]);
+  http_response_code(intval($status[1]));
+  foreach($http_response_header as $header) {
+    if(stripos($header, "Retry-After:") === 0)
+      header($header);
+  }
+  echo $response;
+}
+?>
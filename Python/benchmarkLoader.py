@@ -0,0 +1,196 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from mysql.connector import Error
+from dbConnection import DBConnection
+from dbWriter import openWriter, BATCH_SIZE
+from syntheticFeed import makeFeed
+
+#* Benchmarks of the loader's write paths
+#* Run against a scratch DB (like a local MySQL/MariaDB container), the connection is read from .env as in setCarrisData.py
+#* python benchmarkLoader.py [rows] [batchSize]
+#* The loader stages can also be benchmarked without a DB, on synthetic feeds of growing size and a connection that only records statements
+#* python benchmarkLoader.py stages [stream|pandas|cache] [shuffle]
+
+BENCHMARK_TABLE = "BenchmarkLoad"
+
+def createBenchmarkTable(conn):
+	cursor = conn.cursor()
+	cursor.execute(f"DROP TABLE IF EXISTS {BENCHMARK_TABLE}")
+	# Same column types as BusStops and BusRoutes
+	cursor.execute(f"CREATE TABLE {BENCHMARK_TABLE} (ID INT PRIMARY KEY, Name VARCHAR(255), Latitude DOUBLE, Longitude DOUBLE, Direction BOOLEAN)")
+	conn.commit()
+	cursor.close()
+
+def benchmarkWriter(conn, numRows, batchSize, fastLoad):
+	#* Loads numRows rows in the cleared benchmark table, returns [seconds, commits, fellBack]
+	cursor = conn.cursor()
+	cursor.execute(f"DELETE FROM {BENCHMARK_TABLE}")
+	conn.commit()
+	cursor.close()
+
+	start = time.perf_counter()
+	writer = openWriter(conn, BENCHMARK_TABLE, ["ID", "Name", "Latitude", "Longitude", "Direction"], batchSize, fastLoad = fastLoad)
+	for row in range(numRows):
+		writer.add([row, f"Stop\t{row}", 38.7 + row * 1e-6, -9.1 - row * 1e-6, row % 2 == 1])
+	writer.close()
+	seconds = time.perf_counter() - start
+
+	return [seconds, writer.commits, getattr(writer, "fellBack", False)]
+
+# [routes, tripsPerRoute, stopsPerTrip] of the synthetic feeds, each about 10 times the stop times of the one before
+FEED_SIZES = [[25, 20, 20], [100, 50, 25], [400, 100, 30]]
+
+class RecordingCursor:
+	def __init__(self, conn):
+		self.conn = conn
+		self.rowcount = 0
+
+	def execute(self, query, params = None):
+		self.conn.record(query, 1)
+
+	def executemany(self, query, seqParams):
+		# mysql-connector sends the rows of an INSERT as one multi-row statement
+		self.rowcount = len(seqParams)
+		self.conn.record(query, self.rowcount)
+
+	def fetchall(self):
+		# Tables are always empty, so verifying a table inserts every row
+		return []
+
+	def close(self):
+		pass
+
+class RecordingConnection:
+	#* Stand-in for a DB connection, keeps count of the statements, rows and commits it's given
+	def __init__(self):
+		self.statements = 0
+		self.rowsSent = 0
+		self.commits = 0
+		self.statementKinds = {}
+
+	def record(self, query, numRows):
+		self.statements += 1
+		self.rowsSent += numRows
+		kind = query.split(None, 1)[0].upper()
+		self.statementKinds[kind] = self.statementKinds.get(kind, 0) + 1
+
+	def cursor(self, prepared = False):
+		return RecordingCursor(self)
+
+	def commit(self):
+		self.commits += 1
+
+	def rollback(self):
+		pass
+
+	def start_transaction(self):
+		pass
+
+	def is_connected(self):
+		return True
+
+	def reconnect(self, attempts = 1, delay = 0):
+		pass
+
+	def close(self):
+		pass
+
+def getStages(source, fastLoad):
+	# [name, function(feedPath, conn)] of every stage of a load
+	import setCarrisData
+
+	return [
+		["BusStops (cleared)", lambda feedPath, conn: setCarrisData.setBusStops(feedPath, conn, True, fastLoad = fastLoad, source = source)],
+		["BusStops (verified)", lambda feedPath, conn: setCarrisData.setBusStops(feedPath, conn, False, source = source)],
+		["ServiceModes (cleared)", lambda feedPath, conn: setCarrisData.setServiceModes(feedPath, conn, True, fastLoad = fastLoad, source = source)],
+		["BusTrips, BusRoutes, BusPatterns", lambda feedPath, conn: setCarrisData.setBusTripsAndBusRoutes(feedPath, conn, True, True, True, fastLoad = fastLoad, source = source)],
+		["StopTimes (cleared)", lambda feedPath, conn: setCarrisData.setStopTimes(feedPath, conn, True, fastLoad = fastLoad, source = source)],
+	]
+
+def runStage(stage, feedPath, traceMemory):
+	#* Runs a stage against a recording connection, returns [seconds, peak bytes or None, conn]
+	#* Tracing memory slows the stage down, so time and memory are measured in separate runs
+	conn = RecordingConnection()
+	if traceMemory:
+		tracemalloc.start()
+	start = time.perf_counter()
+	with contextlib.redirect_stdout(io.StringIO()):	# The loader's messages
+		success = stage(feedPath, conn)
+	seconds = time.perf_counter() - start
+	peak = None
+	if traceMemory:
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+
+	if not success:
+		raise RuntimeError("stage failed")
+	return [seconds, peak, conn]
+
+def benchmarkStages(source = "stream", shuffle = False, fastLoad = False, sizes = FEED_SIZES):
+	#* Benchmarks every stage on synthetic feeds of the given sizes, returns [[feed size, stop times, stage, seconds, peak MiB, statements, rows, commits]]
+	results = []
+	workDir = os.getcwd()
+	with tempfile.TemporaryDirectory() as tempDir:
+		# The feed cache is built in the current directory
+		os.chdir(tempDir)
+		try:
+			for routes, tripsPerRoute, stopsPerTrip in sizes:
+				feedPath = f"./feed_{routes}_{tripsPerRoute}_{stopsPerTrip}.zip"
+				numStopTimes = makeFeed(feedPath, routes, tripsPerRoute, stopsPerTrip, shuffle, shuffle)
+				if(source == "cache"):
+					import feedCache
+					feedCache.openFeedCache(feedPath)
+
+				for name, stage in getStages(source, fastLoad):
+					seconds, _, conn = runStage(stage, feedPath, False)
+					_, peak, _ = runStage(stage, feedPath, True)
+					results.append([f"{routes}x{tripsPerRoute}x{stopsPerTrip}", numStopTimes, name, seconds, peak / 2 ** 20, conn.statements, conn.rowsSent, conn.commits])
+		finally:
+			os.chdir(workDir)
+
+	return results
+
+def printStages(results):
+	print(f"{'Feed':<14}{'Stop times':>12}  {'Stage':<34}{'Seconds':>9}{'Peak MiB':>10}{'Statements':>12}{'Rows':>10}{'Commits':>9}")
+	for feed, numStopTimes, name, seconds, peak, statements, rows, commits in results:
+		print(f"{feed:<14}{numStopTimes:>12}  {name:<34}{seconds:>9.3f}{peak:>10.1f}{statements:>12}{rows:>10}{commits:>9}")
+
+def main():
+	if(len(sys.argv) > 1 and sys.argv[1] == "stages"):
+		source = sys.argv[2] if len(sys.argv) > 2 else "stream"
+		if(source not in ["stream", "pandas", "cache"]):
+			print("Unrecognized source ->", source)
+			return
+		printStages(benchmarkStages(source, "shuffle" in sys.argv[3:]))
+		return
+
+	numRows = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+	batchSize = int(sys.argv[2]) if len(sys.argv) > 2 else BATCH_SIZE
+
+	conn = DBConnection()
+	if(conn == None):
+		return
+
+	try:
+		createBenchmarkTable(conn)
+		for name, fastLoad in [["Batched INSERT", False], ["LOAD DATA LOCAL INFILE", True]]:
+			seconds, commits, fellBack = benchmarkWriter(conn, numRows, batchSize, fastLoad)
+			note = " (not allowed, fell back to INSERT)" if fellBack else ""
+			print(f"{name}{note}: {numRows} rows in {seconds:.2f} s -> {numRows / seconds:.0f} rows/s, {commits} commit(s)")
+
+		cursor = conn.cursor()
+		cursor.execute(f"DROP TABLE {BENCHMARK_TABLE}")
+		cursor.close()
+	except Error as error:
+		print(f"Error while benchmarking -> '{error}'")
+
+	conn.close()
+
+if(__name__ == "__main__"):
+	main()
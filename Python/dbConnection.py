@@ -0,0 +1,135 @@
+import os
+import random
+import time
+
+from dotenv import load_dotenv
+from mysql.connector import Error
+from mysql.connector.pooling import MySQLConnectionPool
+
+
+# Errors worth retrying, the connection dropped or the transaction lost a lock
+#? 1205 lock wait timeout, 1213 deadlock, 2003 can't connect, 2006 server gone away,
+#? 2013 and 2055 lost connection during query, 4031 disconnected for inactivity
+TRANSIENT_ERRORS = [1205, 1213, 2003, 2006, 2013, 2055, 4031]
+
+MAX_RETRIES = 6
+RETRY_DELAY = 0.5		# Seconds before the first retry, doubled on every retry
+MAX_RETRY_DELAY = 30	# Seconds
+
+# Connection reuse and retry counts of this process, with the statements and commits it issued
+METRICS = {
+	"connectionsCreated": 0,
+	"connectionsReused": 0,
+	"retries": 0,
+	"reconnects": 0,
+	"statements": 0,
+	"commits": 0,
+}
+
+# Pool of this process, workers forked from the main process create their own
+pool = None
+poolPid = None
+seenConnections = set()	# Server ids of the connections handed out by the pool
+
+def getPool():
+	global pool, poolPid, seenConnections
+
+	if(pool == None or poolPid != os.getpid()):
+		# Get environment variables
+		load_dotenv()
+		config = {
+			"host": os.getenv("hostname"),
+			"database": os.getenv("dbnameSecure"),
+			"user": os.getenv("usernameSecure"),
+			"password": os.getenv("passwordSecure"),
+			"port": int(os.getenv("portSecure")),
+			"allow_local_infile": True,
+		}
+		poolSize = int(os.getenv("poolSize", "2"))
+
+		pool = MySQLConnectionPool(pool_name = f"loader{os.getpid()}", pool_size = poolSize, **config)
+		poolPid = os.getpid()
+		seenConnections = set()
+
+	return pool
+
+def retryDelay(attempt):
+	# Exponential backoff, with some jitter so workers don't retry all at once
+	delay = min(RETRY_DELAY * 2 ** attempt, MAX_RETRY_DELAY)
+	return delay * random.uniform(0.8, 1.2)
+
+def isTransientError(error):
+	return error.errno in TRANSIENT_ERRORS
+
+def DBConnection():
+	#* Returns a connection from this process' pool, or None if the DB can't be reached
+	#* Closing the connection gives it back to the pool
+	attempt = 0
+	while True:
+		try:
+			conn = getPool().get_connection()
+			if conn.connection_id in seenConnections:
+				METRICS["connectionsReused"] += 1
+			else:
+				seenConnections.add(conn.connection_id)
+				METRICS["connectionsCreated"] += 1
+			print("DB connection successful")
+			return conn
+		except (Error, ValueError, TypeError) as error:
+			if not isinstance(error, Error) or not isTransientError(error) or attempt == MAX_RETRIES:
+				print(f"Error while setting the DB connection -> '{error}'")
+				return None
+
+			delay = retryDelay(attempt)
+			print(f"DB not reachable, retrying in {delay:.1f} s -> '{error}'")
+			METRICS["retries"] += 1
+			time.sleep(delay)
+			attempt += 1
+
+def recover(conn):
+	# Leaves conn ready to run a transaction again, reconnecting if it dropped
+	try:
+		if conn.is_connected():
+			conn.rollback()
+			return
+	except Error:
+		pass
+
+	conn.reconnect(attempts = 1, delay = 0)
+	METRICS["reconnects"] += 1
+
+def runWithRetry(conn, action, description, onRetry = None):
+	#* Runs action(), and on transient errors recovers conn and runs it again with exponential backoff
+	#* Whatever wasn't committed is lost on a retry, onRetry() is called so the caller can redo it
+	attempt = 0
+	while True:
+		try:
+			return action()
+		except Error as error:
+			if not isTransientError(error) or attempt == MAX_RETRIES:
+				raise
+
+			delay = retryDelay(attempt)
+			print(f"Transient DB error while {description}, retrying in {delay:.1f} s -> '{error}'")
+			METRICS["retries"] += 1
+			time.sleep(delay)
+
+			# The DB may still be down, recovering is part of the retry
+			try:
+				recover(conn)
+			except Error as recoverError:
+				print(f"Could not recover the DB connection -> '{recoverError}'")
+				attempt += 1
+				continue
+
+			if(onRetry != None):
+				onRetry()
+			attempt += 1
+
+def mergeMetrics(metrics):
+	# Adds the metrics of a worker to the ones of this process
+	for key, value in metrics.items():
+		METRICS[key] += value
+
+def printMetrics():
+	print(f"DB connections -> {METRICS['connectionsCreated']} created, {METRICS['connectionsReused']} reused, {METRICS['retries']} retries, {METRICS['reconnects']} reconnects, {METRICS['statements']} statements, {METRICS['commits']} commits")
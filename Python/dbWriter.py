@@ -0,0 +1,450 @@
+import math
+import os
+import tempfile
+
+from mysql.connector import Error
+from dbConnection import runWithRetry, METRICS
+
+
+# Number of rows sent to the DB in a single statement
+BATCH_SIZE = 1000
+# Number of batches between commits, 0 commits only once at the end of the table (or every MAX_UNCOMMITTED batches)
+COMMIT_EVERY = 0
+# Most batches kept for writing again after a dropped connection, a commit is forced when there are this many
+MAX_UNCOMMITTED = 100
+
+# Most placeholders a prepared statement can have
+MAX_PLACEHOLDERS = 65535
+
+# Errors meaning LOAD DATA LOCAL INFILE is not allowed, by the server (1148, 3948) or by the client (2068)
+LOCAL_INFILE_ERRORS = [1148, 2068, 3948]
+
+# Escapes of LOAD DATA's default FIELDS ESCAPED BY '\\'
+TSV_ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'}
+TSV_UNESCAPES = {'\\': '\\', 't': '\t', 'n': '\n', 'r': '\r', '0': '\0'}
+
+def batches(rows, batchSize = BATCH_SIZE):
+	# Split rows in lists of at most batchSize rows
+	for start in range(0, len(rows), batchSize):
+		yield rows[start:start + batchSize]
+
+def safeRollback(conn):
+	# Rolling back a dropped connection fails, but then there's nothing to roll back anyway
+	try:
+		conn.rollback()
+	except Error:
+		pass
+
+def getPrimaryKey(conn, tableName):
+	# Columns of the table's primary key, in order
+	cursor = conn.cursor()
+	cursor.execute("SELECT COLUMN_NAME FROM information_schema.KEY_COLUMN_USAGE WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s "
+		"AND CONSTRAINT_NAME = 'PRIMARY' ORDER BY ORDINAL_POSITION", (tableName,))
+	rows = cursor.fetchall()
+	cursor.close()
+	METRICS["statements"] += 1
+	return [row[0] for row in rows]
+
+def hasRow(conn, tableName, columns, row):
+	#* Whether the table has row (values of columns), looked up by the table's primary key
+	#* None when the key isn't among columns, there's no telling then
+	key = getPrimaryKey(conn, tableName)
+	if(not key or any(column not in columns for column in key)):
+		return None
+
+	cursor = conn.cursor()
+	cursor.execute(f"SELECT 1 FROM {tableName} WHERE {' AND '.join(column + ' = %s' for column in key)} LIMIT 1",
+		[row[columns.index(column)] for column in key])
+	rows = cursor.fetchall()
+	cursor.close()
+	METRICS["statements"] += 1
+	return len(rows) > 0
+
+def sameValues(feedValues, dbValues):
+	# DB values come back with the column's type, so they are converted to the feed's type before comparing
+	for feedValue, dbValue in zip(feedValues, dbValues):
+		if(dbValue == None):
+			if(feedValue != None):
+				return False
+		elif isinstance(feedValue, float):
+			if not math.isclose(feedValue, float(dbValue), rel_tol = 1e-9, abs_tol = 1e-7):
+				return False
+		elif(feedValue != type(feedValue)(dbValue)):
+			return False
+
+	return True
+
+def getUpsertQuery(tableName, columns):
+	# INSERT that updates the row instead when its key is already in the table
+	placeholders = ", ".join(["%s"] * len(columns))
+	assignments = ", ".join(f"{column} = VALUES({column})" for column in columns[1:])
+	return f"INSERT INTO {tableName} ({', '.join(columns)}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {assignments}"
+
+def syncTable(conn, tableName, columns, feedRows, batchSize = BATCH_SIZE):
+	#* Makes tableName hold exactly feedRows, the first of columns must be the table's key
+	#* The table is fetched in one query and diffed in memory, then only the changes are written in one transaction
+	#* Returns [inserted, updated, deleted] or None in case of error
+	key = columns[0]
+
+	# Fetch current table
+	def fetchTable():
+		cursor = conn.cursor()
+		cursor.execute(f"SELECT {', '.join(columns)} FROM {tableName}")
+		METRICS["statements"] += 1
+		rows = cursor.fetchall()
+		cursor.close()
+		return rows
+
+	try:
+		current = {row[0]: row[1:] for row in runWithRetry(conn, fetchTable, f"reading table {tableName}")}
+	except Error as error:
+		print(f"Error while reading table {tableName} -> '{error}'")
+		return None
+
+	# Diff it against the feed
+	inserts = []
+	updates = []
+	feedKeys = set()
+	for row in feedRows:
+		feedKeys.add(row[0])
+		dbRow = current.get(row[0])
+		if(dbRow == None):	# Row is not present in the DB, add it
+			inserts.append(row)
+		elif not sameValues(row[1:], dbRow):	# Row changed, update it
+			updates.append(row)
+	deletes = [dbKey for dbKey in current if dbKey not in feedKeys]	# Row is no longer in the feed
+
+	# Ready queries
+	queryUpsert = getUpsertQuery(tableName, columns)
+
+	# Apply changes, autocommit is off so everything up to the commit is a single transaction
+	def applyChanges():
+		cursor = conn.cursor()
+		for batch in batches(inserts + updates, batchSize):
+			cursor.executemany(queryUpsert, batch)
+			METRICS["statements"] += 1
+		for batch in batches(deletes, batchSize):
+			queryDelete = f"DELETE FROM {tableName} WHERE {key} IN ({', '.join(['%s'] * len(batch))})"
+			cursor.execute(queryDelete, batch)
+			METRICS["statements"] += 1
+		conn.commit()
+		METRICS["commits"] += 1
+		cursor.close()
+
+	try:
+		# A retry runs the whole transaction again
+		runWithRetry(conn, applyChanges, f"syncing table {tableName}")
+	except Error as error:
+		safeRollback(conn)
+		print(f"Error while syncing table {tableName}, no changes were made -> '{error}'")
+		return None
+
+	print(f"Table {tableName} synced -> {len(inserts)} inserted, {len(updates)} updated, {len(deletes)} deleted")
+	return [len(inserts), len(updates), len(deletes)]
+
+def syncFingerprints(conn, tableName, columns, feedRows, batchSize = BATCH_SIZE):
+	#* Makes tableName hold exactly feedRows, like syncTable, but only the key and fingerprint of every row are fetched and compared
+	#* The first of columns must be the rows' key and the last their fingerprint (see routePatterns.getFingerprint)
+	#? The key doesn't have to be unique in the table, keys it has more than once are deleted and inserted again, rows without a key
+	#? (written before the table had one) are deleted
+	#* Returns [inserted, updated, deleted] or None in case of error
+	key = columns[0]
+
+	# Fetch the fingerprints of the table
+	def fetchFingerprints():
+		cursor = conn.cursor()
+		cursor.execute(f"SELECT {key}, {columns[-1]} FROM {tableName}")
+		METRICS["statements"] += 1
+		rows = cursor.fetchall()
+		cursor.close()
+		return rows
+
+	try:
+		dbRows = runWithRetry(conn, fetchFingerprints, f"reading fingerprints of table {tableName}")
+	except Error as error:
+		print(f"Error while reading table {tableName} -> '{error}'")
+		return None
+
+	current = {}	# key = row key, value = [fingerprint, times the table has the key]
+	keyless = 0
+	for dbKey, fingerprint in dbRows:
+		if(dbKey == None):
+			keyless += 1
+			continue
+		entry = current.setdefault(dbKey, [fingerprint, 0])
+		entry[1] += 1
+
+	# Diff them against the feed's
+	inserts = []
+	updates = []
+	rewrites = []	# Rows whose key the table has more than once
+	feedKeys = set()
+	for row in feedRows:
+		feedKeys.add(row[0])
+		dbRow = current.get(row[0])
+		if(dbRow == None):	# Row is not present in the DB, add it
+			inserts.append(row)
+		elif(dbRow[1] > 1):
+			rewrites.append(row)
+		elif(dbRow[0] != row[-1]):	# Row changed, update it
+			updates.append(row)
+	deletes = [dbKey for dbKey in current if dbKey not in feedKeys]	# Row is no longer in the feed
+
+	# Ready queries
+	queryInsert = f"INSERT INTO {tableName} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+	queryUpdate = f"UPDATE {tableName} SET {', '.join(column + ' = %s' for column in columns[1:])} WHERE {key} = %s"
+
+	# Apply changes, autocommit is off so everything up to the commit is a single transaction
+	def applyChanges():
+		cursor = conn.cursor()
+		if keyless:
+			cursor.execute(f"DELETE FROM {tableName} WHERE {key} IS NULL")
+			METRICS["statements"] += 1
+		for batch in batches(deletes + [row[0] for row in rewrites], batchSize):
+			queryDelete = f"DELETE FROM {tableName} WHERE {key} IN ({', '.join(['%s'] * len(batch))})"
+			cursor.execute(queryDelete, batch)
+			METRICS["statements"] += 1
+		for batch in batches(updates, batchSize):
+			cursor.executemany(queryUpdate, [row[1:] + row[:1] for row in batch])
+			METRICS["statements"] += 1
+		for batch in batches(inserts + rewrites, batchSize):
+			cursor.executemany(queryInsert, batch)
+			METRICS["statements"] += 1
+		conn.commit()
+		METRICS["commits"] += 1
+		cursor.close()
+
+	try:
+		# A retry runs the whole transaction again
+		runWithRetry(conn, applyChanges, f"syncing table {tableName}")
+	except Error as error:
+		safeRollback(conn)
+		print(f"Error while syncing table {tableName}, no changes were made -> '{error}'")
+		return None
+
+	numDeleted = len(deletes) + keyless
+	print(f"Table {tableName} synced by fingerprint -> {len(inserts)} inserted, {len(updates) + len(rewrites)} updated, {numDeleted} deleted")
+	return [len(inserts), len(updates) + len(rewrites), numDeleted]
+
+class BatchWriter:
+	#* Buffers rows for query and writes them with executemany in batches of batchSize rows
+	#* executemany turns an INSERT into a single multi-row INSERT, so each batch is one round trip
+	#* With prepared, full batches use a server-side prepared multi-row INSERT instead, parsed only once by the server
+	#* Commits every commitEvery batches (at most MAX_UNCOMMITTED), and once more when closed
+	#? Batches since the last commit are kept, so they can be written again if the connection drops
+	#? A connection dropped during COMMIT leaves it unknown whether the server committed, with tableName and columns the last row
+	#? sent is then looked up by the table's key, and the batches are only written again if it isn't there (a transaction is
+	#? all or nothing, and an INSERT of a key the table already had would have failed)
+	def __init__(self, conn, query, batchSize = BATCH_SIZE, commitEvery = COMMIT_EVERY, prepared = False, tableName = None, columns = None):
+		self.conn = conn
+		self.query = query
+		self.batchSize = batchSize
+		self.commitEvery = commitEvery
+		self.prepared = prepared
+		self.tableName = tableName
+		self.columns = columns
+
+		if prepared:
+			# query must end in "VALUES (<placeholders>)", which is repeated once per row
+			rowPlaceholders = query[query.rindex("VALUES") + len("VALUES"):].strip()
+			self.batchSize = max(1, min(batchSize, MAX_PLACEHOLDERS // rowPlaceholders.count("%s")))
+			self.preparedQuery = query + (", " + rowPlaceholders) * (self.batchSize - 1)
+			self.preparedCursor = None
+
+		self.rows = []
+		self.uncommitted = []	# Batches written since the last commit
+		self.sent = 0			# How many of them the current transaction has
+		self.batches = 0
+		self.rowsWritten = 0
+		self.rowsCommitted = 0
+		self.commits = 0
+		self.committing = False	# Set while a COMMIT hasn't answered
+
+	def add(self, row):
+		self.rows.append(row)
+		if(len(self.rows) >= self.batchSize):
+			self.flush()
+
+	def lostCommit(self):
+		# Whether the COMMIT that didn't answer went through, in which case the batches it had are done
+		if not self.committing:
+			return False
+		self.committing = False
+		if(self.tableName == None or self.columns == None or not self.uncommitted):
+			return False
+
+		committed = hasRow(self.conn, self.tableName, self.columns, self.uncommitted[-1][-1])
+		if(committed == None):
+			print(f"Can't tell whether the COMMIT that didn't answer went through, table {self.tableName} has no key among the columns written")
+		if not committed:
+			return False
+
+		print(f"Table {self.tableName} has the rows of the COMMIT that didn't answer, not writing them again")
+		self.rowsCommitted += sum(len(batch) for batch in self.uncommitted)
+		self.uncommitted = []
+		self.sent = 0
+		return True
+
+	def send(self):
+		# Writes the batches the current transaction doesn't have yet
+		for batch in self.uncommitted[self.sent:]:
+			if(self.prepared and len(batch) == self.batchSize):
+				if(self.preparedCursor == None):
+					self.preparedCursor = self.conn.cursor(prepared = True)
+				self.preparedCursor.execute(self.preparedQuery, [value for row in batch for value in row])
+			else:
+				cursor = self.conn.cursor()
+				cursor.executemany(self.query, batch)
+				cursor.close()
+			METRICS["statements"] += 1
+			self.sent += 1
+
+	def resend(self):
+		# The transaction was lost, everything since the last commit has to be written again
+		self.sent = 0
+		self.preparedCursor = None	# Prepared statements don't survive a reconnect
+
+	def flush(self):
+		if not self.rows:
+			return
+
+		self.uncommitted.append(self.rows)
+		self.rowsWritten += len(self.rows)
+		self.rows = []
+		self.batches += 1
+		runWithRetry(self.conn, self.send, f"writing batch {self.batches}", self.resend)
+
+		if((self.commitEvery and self.batches % self.commitEvery == 0) or len(self.uncommitted) >= MAX_UNCOMMITTED):
+			self.commit()
+
+	def commit(self):
+		def sendAndCommit():
+			if self.lostCommit():
+				return
+			self.send()
+			self.committing = True
+			self.conn.commit()
+			self.committing = False
+			METRICS["commits"] += 1
+			self.rowsCommitted += sum(len(batch) for batch in self.uncommitted)
+			self.uncommitted = []
+			self.sent = 0
+
+		runWithRetry(self.conn, sendAndCommit, "committing", self.resend)
+		self.commits += 1
+
+	def close(self):
+		# Write what is left and commit
+		self.flush()
+		self.commit()
+		if(self.prepared and self.preparedCursor != None):
+			self.preparedCursor.close()
+
+def toTSVField(value):
+	if(value == None):
+		return "\\N"
+	if isinstance(value, bool):
+		return "1" if value else "0"
+	if isinstance(value, float):
+		return repr(value)
+	return "".join(TSV_ESCAPES.get(char, char) for char in str(value))
+
+def fromTSVField(field):
+	if(field == "\\N"):
+		return None
+	if '\\' not in field:
+		return field
+
+	value = []
+	escaped = False
+	for char in field:
+		if escaped:
+			value.append(TSV_UNESCAPES.get(char, char))
+			escaped = False
+		elif(char == '\\'):
+			escaped = True
+		else:
+			value.append(char)
+	return "".join(value)
+
+class FileLoader:
+	#* Same interface as BatchWriter, for tables that were cleared
+	#* Rows are written to a temporary TSV file, which is ingested with LOAD DATA LOCAL INFILE when closed
+	#* If the server (or the connection) doesn't allow it, the file is read back and written through a BatchWriter
+	def __init__(self, conn, tableName, columns, batchSize = BATCH_SIZE, commitEvery = COMMIT_EVERY, prepared = False):
+		self.conn = conn
+		self.tableName = tableName
+		self.columns = columns
+		self.batchSize = batchSize
+		self.commitEvery = commitEvery
+		self.prepared = prepared
+
+		self.file = tempfile.NamedTemporaryFile('w', encoding = "utf8", newline = "\n", suffix = ".tsv", delete = False)
+		self.rowsWritten = 0
+		self.commits = 0
+		self.fellBack = False
+		self.lastRow = None
+		self.committing = False	# Set while the COMMIT of LOAD DATA hasn't answered
+
+	def add(self, row):
+		self.file.write("\t".join(toTSVField(value) for value in row) + "\n")
+		self.rowsWritten += 1
+		self.lastRow = row
+
+	def close(self):
+		self.file.close()
+		try:
+			try:
+				runWithRetry(self.conn, self.load, f"loading table {self.tableName}")
+			except Error as error:
+				if error.errno not in LOCAL_INFILE_ERRORS:
+					raise
+				print(f"LOAD DATA LOCAL INFILE not allowed for table {self.tableName}, using INSERT instead -> '{error}'")
+				safeRollback(self.conn)
+				self.fallBack()
+		finally:
+			os.remove(self.file.name)
+
+	def load(self):
+		if self.committing:
+			self.committing = False
+			# Looked up by its last row, like BatchWriter.lostCommit
+			if(self.lastRow != None and hasRow(self.conn, self.tableName, self.columns, self.lastRow)):
+				print(f"Table {self.tableName} has the rows of the COMMIT that didn't answer, not loading them again")
+				self.commits += 1
+				return
+
+		query = (f"LOAD DATA LOCAL INFILE %s INTO TABLE {self.tableName} CHARACTER SET utf8mb4 "
+			"FIELDS TERMINATED BY '\\t' ESCAPED BY '\\\\' LINES TERMINATED BY '\\n' "
+			f"({', '.join(self.columns)})")
+
+		cursor = self.conn.cursor()
+		cursor.execute(query, (self.file.name,))
+		cursor.close()
+		self.committing = True
+		self.conn.commit()
+		self.committing = False
+		METRICS["statements"] += 1
+		METRICS["commits"] += 1
+		self.commits += 1
+
+	def fallBack(self):
+		self.fellBack = True
+		placeholders = ", ".join(["%s"] * len(self.columns))
+		query = f"INSERT INTO {self.tableName} ({', '.join(self.columns)}) VALUES ({placeholders})"
+
+		writer = BatchWriter(self.conn, query, self.batchSize, self.commitEvery, self.prepared, self.tableName, self.columns)
+		with open(self.file.name, 'r', encoding = "utf8", newline = "\n") as file:
+			for line in file:
+				writer.add([fromTSVField(field) for field in line[:-1].split("\t")])
+		writer.close()
+		self.commits += writer.commits
+
+def openWriter(conn, tableName, columns, batchSize = BATCH_SIZE, commitEvery = COMMIT_EVERY, fastLoad = False, prepared = False):
+	#* Returns a FileLoader if fastLoad is set, a BatchWriter with an INSERT for columns otherwise
+	if fastLoad:
+		return FileLoader(conn, tableName, columns, batchSize, commitEvery, prepared)
+
+	placeholders = ", ".join(["%s"] * len(columns))
+	query = f"INSERT INTO {tableName} ({', '.join(columns)}) VALUES ({placeholders})"
+	return BatchWriter(conn, query, batchSize, commitEvery, prepared, tableName, columns)
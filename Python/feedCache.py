@@ -0,0 +1,254 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+import numpy as np
+
+from datetime import datetime, timedelta
+from zipfile import ZipFile
+from gtfsFrames import readFrame
+from routePatterns import buildRouteRows
+
+#* On-disk cache of the parsed feed, one directory per feed content
+#* Ids are interned to integers and every column is a NumPy array saved as .npy, which is opened memory-mapped
+#* Opening a cache doesn't parse anything, and processes opening the same cache share its pages
+#* python feedCache.py <feed.zip> builds the cache of a feed
+
+CACHE_DIR = "./feedCache/"
+CACHE_VERSION = 2
+
+# Time of stops without one in the feed (stops that aren't timepoints)
+NO_TIME = -1
+
+# GTFS files the cache is built from
+CACHE_FILES = ["stops.txt", "calendar_dates.txt", "routes.txt", "trips.txt", "stop_times.txt"]
+
+#* Arrays of a cache
+# stopIds, stopLat, stopLon -> stops, the first listedStops are the ones in stops.txt (in its order), the rest only appear in stop_times.txt
+# calendarDate (YYYYMMDD), calendarService, calendarException -> rows of calendar_dates.txt, in file order
+# tripRoute, tripService, tripDirection -> trips, in trips.txt order, routes from listedRoutes on are not in routes.txt
+# stopTimeStop, stopTimeSequence, stopTimeArrival, stopTimeDeparture -> rows of stop_times.txt, grouped by trip and ordered by stop_sequence
+# tripOffsets -> the stop times of trip t are rows tripOffsets[t] to tripOffsets[t + 1]
+# Times are seconds since the start of the service day (so they can go past 24:00)
+ARRAYS = ["stopIds", "stopLat", "stopLon", "calendarDate", "calendarService", "calendarException", "tripRoute", "tripService",
+	"tripDirection", "stopTimeStop", "stopTimeSequence", "stopTimeArrival", "stopTimeDeparture", "tripOffsets"]
+
+class FeedCache:
+	#* Arrays of the cache are attributes with the same name, string ids are in tripIds, routeIds, serviceIds and stopNames
+	def __init__(self, cachePath):
+		self.path = cachePath
+		for name in ARRAYS:
+			setattr(self, name, np.load(os.path.join(cachePath, name + ".npy"), mmap_mode = "r"))
+
+		with open(os.path.join(cachePath, "ids.json"), 'r', encoding = "utf8") as file:
+			ids = json.load(file)
+		self.tripIds = ids["tripIds"]
+		self.routeIds = ids["routeIds"]
+		self.serviceIds = ids["serviceIds"]
+		self.stopNames = ids["stopNames"]
+		self.listedRoutes = ids["listedRoutes"]
+		self.listedStops = ids["listedStops"]
+
+# Content keys already computed, key = [path, modification time, size] of the zip, so a feed that didn't change isn't hashed again
+cacheKeys = {}
+
+def hashMember(sha, zipfile, fileName):
+	# Adds the name and bytes of a file of the zip to sha
+	sha.update(f"{fileName};".encode())
+	with zipfile.open(fileName) as member:
+		for block in iter(lambda: member.read(1024 * 1024), b""):
+			sha.update(block)
+
+def getCacheKey(feedPath):
+	#* SHA-256 of the content of every file the cache is built from, so only a feed with the same files gets the same cache
+	#? The zip's CRC and size of each file would be read without decompressing anything, but files that collide on both
+	#? would open a cache of another feed, hashing the content is a second or so for a whole feed and is done once per zip
+	stat = os.stat(feedPath)
+	fileKey = (os.path.realpath(feedPath), stat.st_mtime_ns, stat.st_size)
+	if fileKey not in cacheKeys:
+		sha = hashlib.sha256(f"v{CACHE_VERSION}".encode())
+		with ZipFile(feedPath) as zipfile:
+			for fileName in CACHE_FILES:
+				hashMember(sha, zipfile, fileName)
+		cacheKeys[fileKey] = sha.hexdigest()
+	return cacheKeys[fileKey]
+
+def toSeconds(times):
+	# "HH:MM:SS" strings to seconds, hours can be 24 or more, missing times are NO_TIME
+	parts = times.str.extract(r"^(\d+):(\d+):(\d+)$").astype("float64")
+	return (parts[0] * 3600 + parts[1] * 60 + parts[2]).fillna(NO_TIME).to_numpy(dtype = np.int32)
+
+def intern(values, ids, index):
+	# Integer ids of values, new values are appended to ids
+	for value in values:
+		if value not in index:
+			index[value] = len(ids)
+			ids.append(value)
+	return np.array([index[value] for value in values], dtype = np.int32)
+
+def buildCache(feedPath, cachePath):
+	#* Parses the feed and writes its cache to cachePath
+	stops = readFrame(feedPath, "stops.txt", ["stop_id", "stop_name", "stop_lat", "stop_lon"])
+	calendarDates = readFrame(feedPath, "calendar_dates.txt", ["service_id", "date", "exception_type"])
+	routes = readFrame(feedPath, "routes.txt", ["route_id"])
+	trips = readFrame(feedPath, "trips.txt", ["route_id", "service_id", "trip_id", "direction_id"])
+	stopTimes = readFrame(feedPath, "stop_times.txt", ["trip_id", "arrival_time", "departure_time", "stop_id", "stop_sequence"])
+
+	arrays = {}
+	stopIds = stops["stop_id"].tolist()
+	stopIndex = {stopId: index for index, stopId in enumerate(stopIds)}
+	stopNames = stops["stop_name"].tolist()
+	stopLat = stops["stop_lat"].tolist()
+	stopLon = stops["stop_lon"].tolist()
+	listedStops = len(stopIds)
+
+	routeIds = []
+	routeIndex = {}
+	intern(routes["route_id"].tolist(), routeIds, routeIndex)
+	listedRoutes = len(routeIds)
+
+	serviceIds = []
+	serviceIndex = {}
+	arrays["calendarDate"] = calendarDates["date"].astype("int32").to_numpy(dtype = np.int32)
+	arrays["calendarService"] = intern(calendarDates["service_id"].astype("string").tolist(), serviceIds, serviceIndex)
+	arrays["calendarException"] = calendarDates["exception_type"].to_numpy(dtype = np.int8)
+
+	tripIds = trips["trip_id"].tolist()
+	tripIndex = {tripId: index for index, tripId in enumerate(tripIds)}
+	arrays["tripRoute"] = intern(trips["route_id"].astype("string").tolist(), routeIds, routeIndex)
+	arrays["tripService"] = intern(trips["service_id"].astype("string").tolist(), serviceIds, serviceIndex)
+	arrays["tripDirection"] = trips["direction_id"].to_numpy(dtype = np.int8)
+
+	# Stop times of trips not in trips.txt are left out
+	tripCodes = stopTimes["trip_id"].astype("string").map(tripIndex)
+	known = tripCodes.notna().to_numpy()
+	stopTimes = stopTimes[known]
+	tripOfRow = tripCodes[known].to_numpy(dtype = np.int64)
+
+	# Stops that only appear in stop_times.txt are added after the listed ones
+	for stopId in stopTimes["stop_id"].unique().tolist():
+		if stopId not in stopIndex:
+			stopIndex[stopId] = len(stopIds)
+			stopIds.append(stopId)
+			stopNames.append("")
+			stopLat.append(np.nan)
+			stopLon.append(np.nan)
+
+	# Group rows by trip, ordered by stop_sequence, file order breaking ties
+	order = np.lexsort((stopTimes["stop_sequence"].to_numpy(), tripOfRow))
+	arrays["stopTimeStop"] = stopTimes["stop_id"].map(stopIndex).to_numpy(dtype = np.int32)[order]
+	arrays["stopTimeSequence"] = stopTimes["stop_sequence"].to_numpy(dtype = np.int32)[order]
+	arrays["stopTimeArrival"] = toSeconds(stopTimes["arrival_time"])[order]
+	arrays["stopTimeDeparture"] = toSeconds(stopTimes["departure_time"])[order]
+	arrays["tripOffsets"] = np.concatenate([[0], np.cumsum(np.bincount(tripOfRow, minlength = len(tripIds)))]).astype(np.int64)
+
+	arrays["stopIds"] = np.array(stopIds, dtype = np.int64)
+	arrays["stopLat"] = np.array(stopLat, dtype = np.float64)
+	arrays["stopLon"] = np.array(stopLon, dtype = np.float64)
+
+	# Written to a temporary directory first, so a crash never leaves a broken cache
+	tempPath = cachePath.rstrip("/") + f".part{os.getpid()}"
+	shutil.rmtree(tempPath, ignore_errors = True)
+	os.makedirs(tempPath)
+	for name in ARRAYS:
+		np.save(os.path.join(tempPath, name + ".npy"), arrays[name])
+	with open(os.path.join(tempPath, "ids.json"), 'w', encoding = "utf8") as file:
+		json.dump({"tripIds": tripIds, "routeIds": routeIds, "serviceIds": serviceIds, "stopNames": stopNames,
+			"listedRoutes": listedRoutes, "listedStops": listedStops}, file)
+
+	try:
+		os.rename(tempPath, cachePath)
+	except OSError:	# Someone else built it first
+		shutil.rmtree(tempPath, ignore_errors = True)
+
+def openFeedCache(feedPath, cacheDir = CACHE_DIR):
+	#* Opens the cache of the feed at feedPath, building it if it doesn't exist yet
+	cachePath = os.path.join(cacheDir, getCacheKey(feedPath))
+	if not os.path.exists(cachePath):
+		print("Building cache of the feed")
+		os.makedirs(cacheDir, exist_ok = True)
+		buildCache(feedPath, cachePath)
+
+	return FeedCache(cachePath)
+
+def formatTime(seconds):
+	# Like fixTime, times of 24:00 or later are wrapped back into a 24 hour clock
+	hours, rest = divmod(int(seconds), 3600)
+	if(hours >= 24):
+		hours -= 24
+	return f"{hours:02}:{rest // 60:02}:{rest % 60:02}"
+
+#* Row builders, giving the same rows as the ones in setCarrisData.py
+
+def getBusStopsRows(cache):
+	count = cache.listedStops
+	return [list(row) for row in zip(cache.stopIds[:count].tolist(), cache.stopNames[:count], cache.stopLat[:count].tolist(), cache.stopLon[:count].tolist())]
+
+def getServiceModesRows(cache):
+	if not len(cache.calendarDate):
+		return []
+
+	# Services running each day (exception_type 1), in file order
+	dic = {}
+	for date, service, exceptionType in zip(cache.calendarDate.tolist(), cache.calendarService.tolist(), cache.calendarException.tolist()):
+		services = dic.setdefault(date, [])
+		if(exceptionType == 1):
+			services.append(cache.serviceIds[service])
+
+	# Every day the feed covers
+	day = datetime.strptime(str(min(dic)), "%Y%m%d").date()
+	lastDay = datetime.strptime(str(max(dic)), "%Y%m%d").date()
+	queryRows = []
+	while day <= lastDay:
+		index = int(day.strftime("%Y%m%d"))
+		queryRows.append([index, json.dumps(",".join(dic.get(index, [])))])
+		day += timedelta(days = 1)
+
+	return queryRows
+
+def getBusTripsAndBusRoutesRows(cache):
+	offsets = np.asarray(cache.tripOffsets)
+	stopIds = np.asarray(cache.stopIds)[np.asarray(cache.stopTimeStop)]
+	arrivals = np.asarray(cache.stopTimeArrival)
+
+	# Stops and starting time of every trip with stop times
+	shared = {}		# Trips with the same stops share the tuple
+	tripStops = {}
+	startingTimes = {}
+	for trip, [start, end] in enumerate(zip(offsets[:-1].tolist(), offsets[1:].tolist())):
+		if(start == end):	# Trip without stop times
+			continue
+		tripId = cache.tripIds[trip]
+		stops = tuple(stopIds[start:end].tolist())
+		tripStops[tripId] = shared.setdefault(stops, stops)
+		startingTimes[tripId] = formatTime(arrivals[start])
+
+	tripsRows = [[cache.routeIds[route], cache.serviceIds[service], tripId, direction] for route, service, tripId, direction
+		in zip(cache.tripRoute.tolist(), cache.tripService.tolist(), cache.tripIds, cache.tripDirection.tolist())]
+	return buildRouteRows(cache.routeIds[:cache.listedRoutes], tripsRows, tripStops, startingTimes)
+
+def getStopTimesChunks(cache, chunkSize = 10000):
+	#* Yields the rows of StopTimes (in setCarrisData.py) in chunks, in trip order
+	offsets = np.asarray(cache.tripOffsets)
+	tripOfRow = np.repeat(np.arange(len(cache.tripIds)), np.diff(offsets))
+
+	# Per trip columns, looked up once instead of once per row
+	routes = [cache.routeIds[route] for route in cache.tripRoute.tolist()]
+	services = [cache.serviceIds[service] for service in cache.tripService.tolist()]
+	directions = [direction != 0 for direction in cache.tripDirection.tolist()]
+
+	for start in range(0, len(tripOfRow), chunkSize):
+		end = min(start + chunkSize, len(tripOfRow))
+		columns = zip(tripOfRow[start:end].tolist(), cache.stopTimeSequence[start:end].tolist(), cache.stopIds[cache.stopTimeStop[start:end]].tolist(),
+			cache.stopTimeArrival[start:end].tolist(), cache.stopTimeDeparture[start:end].tolist())
+		yield [[cache.tripIds[trip], sequence, stop, routes[trip], services[trip], directions[trip],
+			None if arrival == NO_TIME else arrival, None if departure == NO_TIME else departure]
+			for trip, sequence, stop, arrival, departure in columns]
+
+if(__name__ == "__main__"):
+	if(len(sys.argv) != 2):
+		print("Usage: python feedCache.py <feed.zip>")
+		sys.exit(2)
+	print("Feed cache at", openFeedCache(sys.argv[1]).path)
@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import shutil
+
+from email.utils import parsedate_to_datetime
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+from zipfile import ZipFile
+
+
+FEED_URL = "https://github.com/carrismetropolitana/gtfs/raw/live/CarrisMetropolitana.zip"
+
+# GTFS files each table is built from
+TABLE_FILES = {
+	"BusStops": ["stops.txt"],
+	"ServiceModes": ["calendar_dates.txt"],
+	"ServiceCalendars": ["calendar_dates.txt"],
+	"BusTrips": ["routes.txt", "trips.txt", "stop_times.txt"],
+	"BusRoutes": ["routes.txt", "trips.txt", "stop_times.txt"],
+	"BusPatterns": ["routes.txt", "trips.txt", "stop_times.txt"],
+	"StopTimes": ["trips.txt", "stop_times.txt"],
+	"StopDepartures": ["calendar_dates.txt", "trips.txt", "stop_times.txt"],
+	"ServiceDayTypes": ["calendar_dates.txt", "trips.txt", "stop_times.txt"],
+}
+
+#* The state of the local feed is kept in a JSON file next to the archive
+#* {"etag": <ETag>, "lastModified": <Last-Modified>, "loaded": {<table>: {<file>: <sha256>}}}
+#* "loaded" has the hashes of the files each table was last successfully loaded from
+
+def getStatePath(feedPath):
+	return os.path.splitext(feedPath)[0] + ".state.json"
+
+def loadFeedState(feedPath):
+	try:
+		with open(getStatePath(feedPath), 'r', encoding = "utf8") as file:
+			return json.load(file)
+	except (OSError, ValueError):	# No state yet, or unreadable, start over
+		return {"etag": None, "lastModified": None, "loaded": {}}
+
+def saveFeedState(feedPath, state):
+	# Written to a temporary file first, so a crash never leaves a broken state
+	statePath = getStatePath(feedPath)
+	with open(statePath + ".part", 'w', encoding = "utf8") as file:
+		json.dump(state, file, indent = "\t")
+	os.replace(statePath + ".part", statePath)
+
+def sameDate(date, otherDate):
+	try:
+		return parsedate_to_datetime(date) == parsedate_to_datetime(otherDate)
+	except (TypeError, ValueError):
+		return False
+
+def downloadZip(feedPath, state, url = FEED_URL):
+	#* Downloads the feed to feedPath unless the local copy is already the latest one
+	#* Returns True if a new archive was downloaded, False if the local one is up to date
+	request = Request(url)
+	haveArchive = os.path.exists(feedPath)
+	if haveArchive:
+		# Ask the server to only send the archive if it changed
+		if state.get("etag"):
+			request.add_header("If-None-Match", state["etag"])
+		if state.get("lastModified"):
+			request.add_header("If-Modified-Since", state["lastModified"])
+
+	try:
+		httpResponse = urlopen(request)
+	except HTTPError as error:
+		if(error.code == 304 and haveArchive):	# Not modified
+			return False
+		raise
+
+	with httpResponse:
+		etag = httpResponse.headers.get("ETag")
+		lastModified = httpResponse.headers.get("Last-Modified")
+
+		# Servers that ignore the conditional headers (and file:// URLs) are checked here
+		if haveArchive:
+			if(etag != None and etag == state.get("etag")):
+				return False
+			if(etag == None and lastModified != None and sameDate(lastModified, state.get("lastModified"))):
+				return False
+
+		# Stream the archive to disk, the files are read straight from it later on
+		tempPath = feedPath + ".part"
+		with open(tempPath, 'wb') as file:
+			shutil.copyfileobj(httpResponse, file, 1024 * 1024)
+		os.replace(tempPath, feedPath)
+
+	state["etag"] = etag
+	state["lastModified"] = lastModified
+	return True
+
+def hashFeedFiles(feedPath):
+	#* Returns {<file>: <sha256>} of every file used by the loader
+	fileNames = sorted({fileName for fileNames in TABLE_FILES.values() for fileName in fileNames})
+
+	hashes = {}
+	with ZipFile(feedPath) as zipfile:
+		for fileName in fileNames:
+			sha = hashlib.sha256()
+			with zipfile.open(fileName) as member:
+				for block in iter(lambda: member.read(1024 * 1024), b""):
+					sha.update(block)
+			hashes[fileName] = sha.hexdigest()
+
+	return hashes
+
+def isTableLoaded(state, tableName, hashes):
+	# True if tableName was last loaded from files with these exact contents
+	loaded = state["loaded"].get(tableName)
+	return loaded != None and all(loaded.get(fileName) == hashes[fileName] for fileName in TABLE_FILES[tableName])
+
+def setTableLoaded(state, tableName, hashes):
+	state["loaded"][tableName] = {fileName: hashes[fileName] for fileName in TABLE_FILES[tableName]}
+
+def clearTableLoaded(state, tableName):
+	state["loaded"].pop(tableName, None)
@@ -0,0 +1,466 @@
+import json
+import sys
+import time
+
+import numpy as np
+
+from datetime import date, datetime, timedelta, timezone
+from zoneinfo import ZoneInfo
+from mysql.connector import Error
+from dbConnection import DBConnection, runWithRetry, recover, printMetrics, METRICS
+from dbWriter import batches, getUpsertQuery, safeRollback, BATCH_SIZE
+from feedCache import openFeedCache, getCacheKey, CACHE_DIR, NO_TIME
+from stopIndex import openStopIndex
+from serviceCalendar import openServiceCalendar
+from routePatterns import getPatternID
+from tableSchemas import createTables
+from watermarks import getWatermark, setWatermark, WATERMARKS_TABLE
+
+#* Matches the GPS fixes of the UPLYs to the trips of the feed, keeping the trip every bus is running and its delay
+#* GPS rows past the job's watermark are streamed in chunks through an unbuffered cursor, so history is never read again
+#* A fix near a stop (see stopIndex.py) is a visit to it, the last visits of a bus are matched against the stop times of the
+#* trips running that day, the trip that explains most of them, in order and with a steady delay, is the one the bus is running
+#* Each chunk's visits (StopVisits), the states of its buses (VehicleTrips) and the watermark are written in one transaction
+#* python gpsMatcher.py [options] runs the job, with --simulate <buses> it matches made up fixes instead, without a DB
+
+JOB = "gpsMatcher"
+FEED_PATH = "./CarrisMetropolitana.zip"
+CHUNK_SIZE = 5000		# GPS rows matched and written together
+TIMEZONE = ZoneInfo("Europe/Lisbon")	# Of the feed's times, the UPLYs send UTC
+
+SNAP_DISTANCE = 40		# Meters from a stop a fix is a visit to it
+SEARCH_WINDOW = 1800	# Seconds a bus can be late (or early)
+MAX_DELAY_CHANGE = 300	# Seconds the delay can change between two visits of the same trip
+MAX_DWELL = 600			# Seconds at the same stop that are still the same visit
+MAX_VISIT_GAP = 1800	# Seconds without visits after which a bus starts over
+MAX_VISITS = 8			# Last visits of a bus its match is made on
+MIN_VISITS = 2			# Visits a trip must explain before a bus is matched to it
+
+MATCHER_TABLES = [WATERMARKS_TABLE, "StopVisits", "VehicleTrips"]
+STOP_VISITS_COLUMNS = ["GPSID", "UPLYID", "StopID", "VisitTime", "TripID", "RouteID", "PatternID", "Direction", "ServiceDate", "StopSequence", "Delay"]
+VEHICLE_TRIPS_COLUMNS = ["UPLYID", "TripID", "RouteID", "PatternID", "Direction", "ServiceDate", "StopSequence", "StopID", "Delay", "VisitTime", "LastGPSID", "Visits"]
+
+GPS_QUERY = "SELECT ID, UPLYID, Latitude, Longitude, Date, UTCTime FROM GPS WHERE ID > %s ORDER BY ID"
+
+# Local times are seconds since 0001-01-01, so a visit's day and time of day are one divmod away
+def toDayNumber(day):
+	# YYYYMMDD, like calendar_dates.txt and ServiceModes
+	return day.year * 10000 + day.month * 100 + day.day
+
+def toDateTime(seconds):
+	return datetime.fromordinal(seconds // 86400) + timedelta(seconds = seconds % 86400)
+
+def fromDateTime(moment):
+	return moment.toordinal() * 86400 + moment.hour * 3600 + moment.minute * 60 + moment.second
+
+# Offsets of local time, key = UTC hour, value = seconds
+utcOffsets = {}
+
+def toLocal(day, utcTime):
+	# day and utcTime as DATE and TIME columns come back (date and timedelta), to local seconds
+	seconds = day.toordinal() * 86400 + int(utcTime.total_seconds())
+	hour = seconds // 3600
+	offset = utcOffsets.get(hour)
+	if(offset == None):
+		moment = datetime.fromordinal(hour // 24).replace(hour = hour % 24, tzinfo = timezone.utc)
+		offset = int(moment.astimezone(TIMEZONE).utcoffset().total_seconds())
+		utcOffsets[hour] = offset
+	return seconds + offset
+
+def newVehicle():
+	# Assignment is the current trip of the bus, as the VehicleTrips columns from TripID to VisitTime
+	return {"visits": [], "trip": None, "assignment": [None] * 9, "lastGpsId": 0}
+
+class GPSMatcher:
+	#* Timetable of the feed at feedPath, indexed by stop and time, and the matching state of every bus
+	def __init__(self, feedPath, cacheDir = CACHE_DIR):
+		cache = openFeedCache(feedPath, cacheDir)
+		self.cache = cache
+		self.cacheKey = getCacheKey(feedPath)
+		self.index = openStopIndex(feedPath, cacheDir)
+		self.stopRows = {stopId: stop for stop, stopId in enumerate(cache.stopIds.tolist())}
+		self.tripIndex = {tripId: trip for trip, tripId in enumerate(cache.tripIds)}
+		self.tripOfRow = np.repeat(np.arange(len(cache.tripIds)), np.diff(cache.tripOffsets))
+		self.tripService = np.asarray(cache.tripService)
+
+		# Stop times ordered by stop and time, at their departure (arrival if they have none), the ones without times can't be matched
+		stops = np.asarray(cache.stopTimeStop)
+		departures = np.asarray(cache.stopTimeDeparture)
+		times = np.where(departures != NO_TIME, departures, cache.stopTimeArrival)
+		timed = np.flatnonzero(times != NO_TIME)
+		self.rows = timed[np.lexsort((times[timed], stops[timed]))]
+		self.rowTimes = times[self.rows]
+		self.stopStarts = np.searchsorted(stops[self.rows], np.arange(len(cache.stopIds) + 1))
+		self.serviceDays = int(self.rowTimes.max() // 86400) + 1 if len(self.rowTimes) else 1	# Days a trip can run for, counting the one it starts
+
+		# Days each service runs on, and the services running on the days seen so far, key = YYYYMMDD, value = [mask over serviceIds, any set]
+		self.calendar = openServiceCalendar(feedPath, cacheDir, cache)
+		self.services = {}
+
+		self.patterns = {}		# key = trip, value = PatternID
+		self.vehicles = {}		# key = UPLYID, value = state of the bus, see newVehicle
+
+	def getPattern(self, trip):
+		pattern = self.patterns.get(trip)
+		if(pattern == None):
+			cache = self.cache
+			start, end = cache.tripOffsets[trip], cache.tripOffsets[trip + 1]
+			stops = tuple(cache.stopIds[cache.stopTimeStop[start:end]].tolist())
+			pattern = getPatternID(cache.routeIds[cache.tripRoute[trip]], int(cache.tripDirection[trip]), stops)
+			self.patterns[trip] = pattern
+		return pattern
+
+	def getCandidates(self, stopId, seconds):
+		#* Stop times at stopId within SEARCH_WINDOW of local time seconds, of the trips running that day
+		#* Trips of the days before are there too, their times go past 24:00
+		#* Returns {(trip, ServiceDate): [[row, delay]]}
+		candidates = {}
+		stop = self.stopRows.get(stopId)
+		if(stop == None):
+			return candidates
+
+		start, end = self.stopStarts[stop], self.stopStarts[stop + 1]
+		stopTimes = self.rowTimes[start:end]
+		day, dayTime = divmod(seconds, 86400)
+		for daysBefore in range(self.serviceDays):
+			serviceDate = toDayNumber(date.fromordinal(day - daysBefore))
+			if serviceDate not in self.services:
+				services = self.calendar.getServiceMask(date.fromordinal(day - daysBefore))
+				self.services[serviceDate] = [services, services.any()]
+			services, anyRunning = self.services[serviceDate]
+			if not anyRunning:
+				continue
+
+			serviceTime = dayTime + daysBefore * 86400
+			first = np.searchsorted(stopTimes, serviceTime - SEARCH_WINDOW)
+			last = np.searchsorted(stopTimes, serviceTime + SEARCH_WINDOW, side = "right")
+			rows = self.rows[start + first:start + last]
+			trips = self.tripOfRow[rows]
+			running = services[self.tripService[trips]]
+			for row, trip, scheduled in zip(rows[running].tolist(), trips[running].tolist(), stopTimes[first:last][running].tolist()):
+				candidates.setdefault((trip, serviceDate), []).append([row, serviceTime - scheduled])
+
+		return candidates
+
+	def matchVisits(self, visits, currentTrip):
+		#* Finds the trip that explains most of visits, the last one included
+		#* Returns [(trip, ServiceDate), [[visit, row, delay]] of the visits it explains] or None
+		best = None
+		bestRank = None
+		for key, options in visits[-1]["candidates"].items():
+			row, delay = min(options, key = lambda option: abs(option[1]))
+			chain = [[visits[-1], row, delay]]
+
+			# Every earlier visit has to be at an earlier stop of the trip, with about the same delay
+			for visit in reversed(visits[:-1]):
+				earlier = [option for option in visit["candidates"].get(key, []) if option[0] < row and abs(option[1] - delay) <= MAX_DELAY_CHANGE]
+				if earlier:
+					row, delay = min(earlier, key = lambda option: abs(option[1] - delay))
+					chain.append([visit, row, delay])
+
+			# Most visits explained, then the trip the bus was on (so it doesn't flip between trips as good), then the smallest delay
+			rank = [len(chain), key == currentTrip, -abs(chain[0][2])]
+			if(bestRank == None or rank > bestRank):
+				best = [key, chain[::-1]]
+				bestRank = rank
+
+		if(best == None or len(best[1]) < MIN_VISITS):
+			return None
+		return best
+
+	def getVisitRow(self, uplyId, visit, key, row, delay):
+		cache = self.cache
+		trip, serviceDate = key
+		return [visit["gpsId"], uplyId, visit["stopId"], toDateTime(visit["time"]), cache.tripIds[trip], cache.routeIds[cache.tripRoute[trip]],
+			self.getPattern(trip), bool(cache.tripDirection[trip]), serviceDate, int(cache.stopTimeSequence[row]), delay]
+
+	def addVisit(self, uplyId, gpsId, stopId, seconds, visitRows):
+		# A bus reached a stop, matches it again and adds the visits whose match changed to visitRows
+		vehicle = self.vehicles[uplyId]
+		visits = vehicle["visits"]
+		if visits:
+			last = visits[-1]
+			if(last["stopId"] == stopId and 0 <= seconds - last["time"] <= MAX_DWELL):	# Still at the same stop
+				return
+			if not 0 <= seconds - last["time"] <= MAX_VISIT_GAP:	# Out of service for a while (or the clock went back)
+				visits.clear()
+				vehicle["trip"] = None
+				vehicle["assignment"] = [None] * 9
+
+		visits.append({"gpsId": gpsId, "stopId": stopId, "time": seconds, "emitted": None})
+		del visits[:-MAX_VISITS]
+		for visit in visits:
+			if "candidates" not in visit:	# Visits resumed from VehicleTrips
+				visit["candidates"] = self.getCandidates(visit["stopId"], visit["time"])
+
+		match = self.matchVisits(visits, vehicle["trip"])
+		if(match == None):
+			return
+
+		key, chain = match
+		for visit, row, delay in chain:
+			visitRow = self.getVisitRow(uplyId, visit, key, row, delay)
+			emitted = [visitRow[4], visitRow[8], visitRow[9]]	# TripID, ServiceDate, StopSequence
+			if(visit["emitted"] != emitted):
+				visit["emitted"] = emitted
+				visitRows[visit["gpsId"]] = visitRow
+
+		vehicle["trip"] = key
+		vehicle["assignment"] = [visitRow[4], visitRow[5], visitRow[6], visitRow[7], visitRow[8], visitRow[9], visitRow[2], visitRow[10], visitRow[3]]
+
+	def matchChunk(self, rows):
+		#* rows are [ID, UPLYID, Latitude, Longitude, Date, UTCTime] rows of GPS ordered by ID, buses not loaded (see loadVehicles) start over
+		#* Returns [StopVisits rows, VehicleTrips rows] to write
+		for row in rows:
+			self.vehicles.setdefault(row[1], newVehicle())["lastGpsId"] = row[0]
+
+		visitRows = {}	# key = GPSID, a visit matched again in the same chunk is written once
+		located = [row for row in rows if None not in row]
+		if located:
+			stopIds, distances = self.index.nearest([float(row[2]) for row in located], [float(row[3]) for row in located])
+			for row, stopId, distance in zip(located, stopIds.tolist(), distances.tolist()):
+				if(distance <= SNAP_DISTANCE):
+					self.addVisit(row[1], row[0], stopId, toLocal(row[4], row[5]), visitRows)
+
+		vehicleRows = []
+		for uplyId in dict.fromkeys(row[1] for row in rows):
+			vehicle = self.vehicles[uplyId]
+			visits = [[visit["gpsId"], visit["stopId"], visit["time"], visit["emitted"]] for visit in vehicle["visits"]]
+			vehicleRows.append([uplyId] + vehicle["assignment"] + [vehicle["lastGpsId"], json.dumps(visits)])
+
+		return [list(visitRows.values()), vehicleRows]
+
+	def resumeVehicle(self, row):
+		# State of a bus from its VehicleTrips row
+		vehicle = newVehicle()
+		vehicle["assignment"] = list(row[1:10])
+		vehicle["lastGpsId"] = row[10]
+		vehicle["visits"] = [{"gpsId": gpsId, "stopId": stopId, "time": seconds, "emitted": emitted} for gpsId, stopId, seconds, emitted in json.loads(row[11])]
+
+		tripId, serviceDate = row[1], row[5]
+		if(tripId != None and tripId in self.tripIndex):	# Trips of an older feed are matched again
+			vehicle["trip"] = (self.tripIndex[tripId], serviceDate)
+		self.vehicles[row[0]] = vehicle
+
+def loadVehicles(conn, matcher, uplyIds):
+	# Reads the states of the buses of uplyIds the matcher doesn't have yet
+	missing = [uplyId for uplyId in dict.fromkeys(uplyIds) if uplyId not in matcher.vehicles]
+	for batch in batches(missing):
+		query = f"SELECT {', '.join(VEHICLE_TRIPS_COLUMNS)} FROM VehicleTrips WHERE UPLYID IN ({', '.join(['%s'] * len(batch))})"
+
+		def fetch():
+			cursor = conn.cursor()
+			cursor.execute(query, batch)
+			METRICS["statements"] += 1
+			rows = cursor.fetchall()
+			cursor.close()
+			return rows
+
+		for row in runWithRetry(conn, fetch, "reading VehicleTrips"):
+			matcher.resumeVehicle(row)
+
+def readGPSChunks(conn, watermark, chunkSize = CHUNK_SIZE):
+	# Unbuffered, the server streams the rows as they are fetched instead of the client holding all of them
+	#? conn can't run anything else until they are all read, everything else goes through another connection
+	cursor = conn.cursor(buffered = False)
+	cursor.execute(GPS_QUERY, (watermark,))
+	METRICS["statements"] += 1
+	try:
+		while True:
+			rows = cursor.fetchmany(chunkSize)
+			if not rows:
+				return
+			yield rows
+	finally:
+		try:
+			cursor.close()
+		except Error:	# Rows left unread, the connection is recovered by the caller
+			pass
+
+def writeChunk(conn, visitRows, vehicleRows, lastId, batchSize = BATCH_SIZE):
+	# A retry runs the whole transaction again
+	def write():
+		cursor = conn.cursor()
+		for tableName, columns, rows in [["StopVisits", STOP_VISITS_COLUMNS, visitRows], ["VehicleTrips", VEHICLE_TRIPS_COLUMNS, vehicleRows]]:
+			query = getUpsertQuery(tableName, columns)
+			for batch in batches(rows, batchSize):
+				cursor.executemany(query, batch)
+				METRICS["statements"] += 1
+		setWatermark(cursor, JOB, lastId)
+		conn.commit()
+		METRICS["commits"] += 1
+		cursor.close()
+
+	runWithRetry(conn, write, f"writing GPS matches up to row {lastId}")
+
+def runMatcher(matcher, reader, writer, chunkSize = CHUNK_SIZE, batchSize = BATCH_SIZE):
+	#* Matches every GPS row past the watermark, reading them through reader and writing through writer
+	#* Returns [GPS rows read, StopVisits rows written] or None in case of error
+	numRows = 0
+	numVisits = 0
+	try:
+		watermark = getWatermark(writer, JOB)
+		for rows in readGPSChunks(reader, watermark, chunkSize):
+			loadVehicles(writer, matcher, [row[1] for row in rows])
+			visitRows, vehicleRows = matcher.matchChunk(rows)
+			writeChunk(writer, visitRows, vehicleRows, rows[-1][0], batchSize)
+			numRows += len(rows)
+			numVisits += len(visitRows)
+	except Error as error:
+		safeRollback(writer)
+		matcher.vehicles.clear()	# They may be ahead of what was written, they are read again
+		print(f"Error while matching GPS rows, {numRows} were matched -> '{error}'")
+		try:
+			recover(reader)
+		except Error:
+			pass
+		return None
+
+	# Ends the reader's snapshot, so the next run sees the rows inserted since
+	safeRollback(reader)
+	return [numRows, numVisits]
+
+def simulate(matcher, numBuses, chunkSize = CHUNK_SIZE, fixInterval = 10, seed = 0):
+	#* Makes up the GPS rows of numBuses buses running random trips of the feed and matches them, without a DB
+	#* Prints how many fixes per second were matched, and how many visits got the trip the bus was running
+	cache = matcher.cache
+	rand = np.random.default_rng(seed)
+	latitudes = np.asarray(cache.stopLat)
+	longitudes = np.asarray(cache.stopLon)
+	departures = np.where(np.asarray(cache.stopTimeDeparture) != NO_TIME, cache.stopTimeDeparture, cache.stopTimeArrival)
+
+	fixes = []	# [local seconds, UPLYID, latitude, longitude]
+	truth = {}	# key = UPLYID, value = [TripID, ServiceDate]
+	runningDays = {}
+	calendar = matcher.calendar
+	for index in range(calendar.numDays):
+		day = calendar.getDate(index)
+		for service in np.flatnonzero(calendar.getServiceMask(day)).tolist():
+			runningDays.setdefault(service, []).append(toDayNumber(day))
+	while len(truth) < numBuses:
+		trip = int(rand.integers(len(cache.tripIds)))
+		start, end = cache.tripOffsets[trip], cache.tripOffsets[trip + 1]
+		days = runningDays.get(int(cache.tripService[trip]))
+		times = departures[start:end].astype(np.int64)
+		stops = np.asarray(cache.stopTimeStop[start:end])
+		if(not days or end - start < 3 or (times == NO_TIME).any() or np.isnan(latitudes[stops]).any()):
+			continue
+
+		# The bus runs the trip late by a drifting delay, fixes are interpolated between stops with a few meters of noise
+		uplyId = len(truth) + 1
+		serviceDate = days[int(rand.integers(len(days)))]
+		day = date(serviceDate // 10000, serviceDate // 100 % 100, serviceDate % 100).toordinal()
+		delays = rand.integers(-60, 300) + np.cumsum(rand.integers(-20, 40, len(times)))
+		arrivals = day * 86400 + times + delays
+		for stop in range(len(stops) - 1):
+			for fixTime in range(int(arrivals[stop]), int(arrivals[stop + 1]), fixInterval):
+				progress = (fixTime - arrivals[stop]) / max(arrivals[stop + 1] - arrivals[stop], 1)
+				latitude = latitudes[stops[stop]] + (latitudes[stops[stop + 1]] - latitudes[stops[stop]]) * progress + rand.normal(0, 0.00005)
+				longitude = longitudes[stops[stop]] + (longitudes[stops[stop + 1]] - longitudes[stops[stop]]) * progress + rand.normal(0, 0.00005)
+				fixes.append([fixTime, uplyId, latitude, longitude])
+		truth[uplyId] = [cache.tripIds[trip], serviceDate]
+
+	# As the UPLYs send them, in UTC and in order of arrival
+	fixes.sort()
+	rows = []
+	for gpsId, [fixTime, uplyId, latitude, longitude] in enumerate(fixes, 1):
+		moment = toDateTime(fixTime).replace(tzinfo = TIMEZONE).astimezone(timezone.utc)
+		rows.append([gpsId, uplyId, latitude, longitude, moment.date(), timedelta(hours = moment.hour, minutes = moment.minute, seconds = moment.second)])
+
+	visits = {}
+	start = time.perf_counter()
+	for chunkStart in range(0, len(rows), chunkSize):
+		visitRows, _ = matcher.matchChunk(rows[chunkStart:chunkStart + chunkSize])
+		for visitRow in visitRows:
+			visits[visitRow[0]] = visitRow
+	seconds = time.perf_counter() - start
+
+	right = sum(1 for visitRow in visits.values() if [visitRow[4], visitRow[8]] == truth[visitRow[1]])
+	matched = sum(1 for uplyId, vehicle in matcher.vehicles.items() if [vehicle["assignment"][0], vehicle["assignment"][4]] == truth[uplyId])
+	print(f"{len(rows)} fixes of {numBuses} buses in {seconds:.2f} s -> {len(rows) / seconds:.0f} fixes/s")
+	print(f"{len(visits)} stop visits, {right / max(len(visits), 1):.1%} on the right trip, {matched} of {numBuses} buses on the right trip at the end")
+
+def readMatcherOptions(args):
+	# "--option value" pairs, returns the options or None if one is invalid
+	options = {
+		"--batch-size": BATCH_SIZE,
+		"--chunk-size": CHUNK_SIZE,
+		"--feed": FEED_PATH,
+		"--follow": 0,
+		"--simulate": 0,
+	}
+	if(len(args) % 2 != 0):
+		print("Missing value for option ->", args[-1])
+		return None
+
+	for arg, value in zip(args[::2], args[1::2]):
+		if arg not in options:
+			print("Unrecognized option ->", arg)
+			return None
+		try:
+			options[arg] = type(options[arg])(value)
+		except ValueError:
+			print("Invalid value for option", arg, "->", value)
+			return None
+
+	if(options["--batch-size"] < 1 or options["--chunk-size"] < 1):
+		print("Options --batch-size and --chunk-size must be at least 1")
+		return None
+	return options
+
+def main():
+	options = readMatcherOptions(sys.argv[1:])
+	if(options == None):
+		print("Usage: python gpsMatcher.py [options]")
+		print("Options\t--feed <feed.zip> (feed the trips are matched against, default " + FEED_PATH + ", as downloaded by setCarrisData.py)")
+		print("\t--chunk-size <rows> (GPS rows matched and written per transaction, default " + str(CHUNK_SIZE) + ")")
+		print("\t--batch-size <rows> (rows per INSERT, default " + str(BATCH_SIZE) + ")")
+		print("\t--follow <seconds> (keep matching new rows, every that many seconds)")
+		print("\t--simulate <buses> (match made up fixes of that many buses instead, without a DB)")
+		sys.exit(2)
+
+	try:
+		matcher = GPSMatcher(options["--feed"])
+	except (OSError, ValueError, KeyError) as error:
+		print(f"Error while opening the feed -> '{error}'")
+		sys.exit(1)
+
+	if options["--simulate"]:
+		simulate(matcher, options["--simulate"], options["--chunk-size"])
+		return
+
+	# The unbuffered read holds its connection until it's done
+	reader = DBConnection()
+	writer = DBConnection()
+	if(reader == None or writer == None):
+		sys.exit(1)
+
+	try:
+		if not createTables(writer, MATCHER_TABLES):
+			return
+		while True:
+			start = time.perf_counter()
+			result = runMatcher(matcher, reader, writer, options["--chunk-size"], options["--batch-size"])
+			if(result != None and result[0]):
+				seconds = time.perf_counter() - start
+				print(f"Matched {result[0]} GPS rows in {seconds:.2f} s ({result[0] / seconds:.0f}/s) -> {result[1]} stop visits")
+			if not options["--follow"]:
+				break
+			time.sleep(options["--follow"])
+
+			# A new feed downloaded by the loader, buses are matched again from their VehicleTrips rows
+			try:
+				if(getCacheKey(options["--feed"]) != matcher.cacheKey):
+					print("Feed changed, opening the new one")
+					matcher = GPSMatcher(options["--feed"])
+			except (OSError, ValueError, KeyError) as error:
+				print(f"Error while opening the new feed, keeping the current one -> '{error}'")
+	except KeyboardInterrupt:
+		print("Received SIGINT from user, terminating program")
+	finally:
+		reader.close()
+		writer.close()
+		printMetrics()
+
+if(__name__ == "__main__"):
+	main()
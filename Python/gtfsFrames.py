@@ -0,0 +1,116 @@
+import json
+import sys
+
+import numpy as np
+import pandas as pd
+
+from zipfile import ZipFile
+from routePatterns import buildRouteRows
+
+#* Columnar version of the row builders in setCarrisData.py
+#* Every get*Rows function returns exactly the DB-ready rows of its counterpart there
+#* python gtfsFrames.py <feed.zip> checks that both, and the feed cache, give the same rows
+
+# Types of the columns read, ids are categorical since they repeat a lot
+COLUMN_DTYPES = {
+	"stops.txt": {"stop_id": "int64", "stop_name": "string", "stop_lat": "float64", "stop_lon": "float64"},
+	"calendar_dates.txt": {"service_id": "category", "date": "string", "exception_type": "int64"},
+	"routes.txt": {"route_id": "string"},
+	"trips.txt": {"route_id": "category", "service_id": "category", "trip_id": "string", "direction_id": "int64"},
+	"stop_times.txt": {"trip_id": "category", "arrival_time": "string", "departure_time": "string", "stop_id": "int64", "stop_sequence": "int64"},
+}
+
+def readFrame(feedPath, fileName, columns):
+	# Reads columns of fileName straight from the feed's zip
+	dtypes = COLUMN_DTYPES[fileName]
+	with ZipFile(feedPath) as zipfile:
+		with zipfile.open(fileName) as member:
+			# round_trip parses floats exactly like float() does
+			return pd.read_csv(member, usecols = columns, dtype = {column: dtypes[column] for column in columns},
+				encoding = "utf-8-sig", keep_default_na = False, float_precision = "round_trip")[columns]
+
+def toRows(frame):
+	# Series.tolist gives Python values, not NumPy ones
+	return [list(row) for row in zip(*(frame[column].tolist() for column in frame.columns))]
+
+def fixTimes(times):
+	# Vectorized fixTime, times of 24:00 or later are wrapped back into a 24 hour clock
+	parts = times.str.extract(r"^(\d+)(:.*)$")
+	hours = parts[0].astype("int64")
+	late = hours >= 24
+	return times.mask(late, (hours - 24).astype("string").str.zfill(2) + parts[1])
+
+def getBusStopsRows(feedPath):
+	stops = readFrame(feedPath, "stops.txt", ["stop_id", "stop_name", "stop_lat", "stop_lon"])
+	return toRows(stops)
+
+def getServiceModesRows(feedPath):
+	calendarDates = readFrame(feedPath, "calendar_dates.txt", ["service_id", "date", "exception_type"])
+	if calendarDates.empty:
+		return []
+
+	# Every day the feed covers, which can span several years
+	dates = pd.to_datetime(calendarDates["date"], format = "%Y%m%d")
+	days = pd.date_range(dates.min(), dates.max()).strftime("%Y%m%d")
+
+	# Services running each day (exception_type 1), in file order
+	running = calendarDates[calendarDates["exception_type"] == 1]
+	services = (running.assign(service_id = running["service_id"].astype("string"))
+		.groupby("date", sort = False)["service_id"].agg(",".join)
+		.reindex(days, fill_value = ""))
+
+	return [[int(day), json.dumps(dayServices)] for day, dayServices in zip(days, services.tolist())]
+
+def getBusTripsAndBusRoutesRows(feedPath):
+	routes = readFrame(feedPath, "routes.txt", ["route_id"])["route_id"].tolist()
+	trips = readFrame(feedPath, "trips.txt", ["route_id", "service_id", "trip_id", "direction_id"])
+	stopTimes = readFrame(feedPath, "stop_times.txt", ["trip_id", "arrival_time", "stop_id", "stop_sequence"])
+
+	# First departure of every trip, ties go to the first row in the file
+	firstRows = stopTimes.groupby("trip_id", observed = True, sort = False)["stop_sequence"].idxmin()
+	firstTimes = fixTimes(stopTimes["arrival_time"].loc[firstRows.to_numpy()]).tolist()
+	startingTimes = dict(zip(firstRows.index.astype("string").tolist(), firstTimes))
+
+	# Stops of every trip ordered by stop_sequence, cut where the trip changes
+	ordered = stopTimes.sort_values(["trip_id", "stop_sequence", "stop_id"], kind = "stable")
+	codes = ordered["trip_id"].cat.codes.to_numpy()
+	starts = np.concatenate([[0], np.flatnonzero(codes[1:] != codes[:-1]) + 1, [len(codes)]]).tolist()
+	tripIds = ordered["trip_id"].astype("string").to_numpy()[starts[:-1]].tolist()
+	stopIds = ordered["stop_id"].tolist()
+	shared = {}		# Trips with the same stops share the tuple
+	tripStops = {}
+	for trip, start, end in zip(tripIds, starts[:-1], starts[1:]):
+		stops = tuple(stopIds[start:end])
+		tripStops[trip] = shared.setdefault(stops, stops)
+
+	trips = trips.assign(route_id = trips["route_id"].astype("string"), service_id = trips["service_id"].astype("string"))
+	return buildRouteRows(routes, toRows(trips), tripStops, startingTimes)
+
+def checkParity(feedPath):
+	#* Compares the rows of every builder, and of the feed cache's, with the ones of setCarrisData.py, returns True if they all match
+	import setCarrisData
+	import feedCache
+
+	cache = feedCache.openFeedCache(feedPath)
+	matches = True
+	pairs = [
+		["BusStops", getBusStopsRows, feedCache.getBusStopsRows, setCarrisData.getBusStopsRows],
+		["ServiceModes", getServiceModesRows, feedCache.getServiceModesRows, setCarrisData.getServiceModesRows],
+		["BusTrips, BusRoutes and BusPatterns", getBusTripsAndBusRoutesRows, feedCache.getBusTripsAndBusRoutesRows, setCarrisData.getBusTripsAndBusRoutesRows],
+	]
+	for name, getFrameRows, getCacheRows, getRows in pairs:
+		rows = getRows(feedPath)
+		for builder, builderRows in [["pandas", getFrameRows(feedPath)], ["cache", getCacheRows(cache)]]:
+			if(builderRows == rows):
+				print(f"Rows of {name} ({builder}) match")
+			else:
+				matches = False
+				print(f"Rows of {name} ({builder}) don't match")
+
+	return matches
+
+if(__name__ == "__main__"):
+	if(len(sys.argv) != 2):
+		print("Usage: python gtfsFrames.py <feed.zip>")
+		sys.exit(2)
+	sys.exit(0 if checkParity(sys.argv[1]) else 1)
@@ -0,0 +1,62 @@
+import csv
+import io
+
+from zipfile import ZipFile
+
+
+# Rows are read from the zip in chunks of this size, so memory doesn't grow with the feed
+CHUNK_SIZE = 10000
+
+# Types of the columns the loader uses, any other column is read as a string
+#* Line formats are
+# stops.txt -> stop_id,stop_code,stop_name,stop_lat,stop_lon,municipality,locality,near_health_clinic,...
+# calendar_dates.txt -> service_id,date,holiday,period,day_type,exception_type
+# routes.txt -> route_id,agency_id,route_short_name,route_long_name,route_type,route_color,route_text_color,circular,path_type
+# trips.txt -> route_id,service_id,trip_id,trip_headsign,direction_id,shape_id,calendar_desc
+# stop_times.txt -> trip_id,arrival_time,departure_time,stop_id,stop_sequence,shape_dist_traveled,pickup_type,drop_off_type
+COLUMN_TYPES = {
+	"stops.txt": {"stop_id": int, "stop_lat": float, "stop_lon": float},
+	"calendar_dates.txt": {"exception_type": int},
+	"routes.txt": {},
+	"trips.txt": {"direction_id": int},
+	"stop_times.txt": {"stop_id": int, "stop_sequence": int},
+}
+
+def readChunks(feedPath, fileName, columns, chunkSize = CHUNK_SIZE):
+	#* Yields lists of at most chunkSize rows of fileName, read straight from the feed's zip
+	#* Each row is a tuple with the values of columns, converted to the types in COLUMN_TYPES
+	types = COLUMN_TYPES.get(fileName, {})
+
+	with ZipFile(feedPath) as zipfile:
+		with zipfile.open(fileName) as member:
+			# utf-8-sig drops the BOM some feeds have before the header
+			file = io.TextIOWrapper(member, encoding = "utf-8-sig", newline = "")
+			reader = csv.reader(file, delimiter = ',')
+
+			# Columns are found by name, so their order in the file doesn't matter
+			header = [name.strip() for name in next(reader)]
+			try:
+				positions = [header.index(column) for column in columns]
+			except ValueError:
+				missing = [column for column in columns if column not in header]
+				raise ValueError(f"{fileName} has no column(s) {', '.join(missing)}")
+			converters = [types.get(column, str) for column in columns]
+			fields = list(zip(positions, converters))
+
+			chunk = []
+			for row in reader:
+				if not row:	# Ignore empty lines
+					continue
+				chunk.append(tuple(convert(row[position]) for position, convert in fields))
+
+				if(len(chunk) == chunkSize):
+					yield chunk
+					chunk = []
+
+			if chunk:
+				yield chunk
+
+def readRows(feedPath, fileName, columns, chunkSize = CHUNK_SIZE):
+	#* Same as readChunks, but yields one row at a time
+	for chunk in readChunks(feedPath, fileName, columns, chunkSize):
+		yield from chunk
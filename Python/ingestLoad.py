@@ -0,0 +1,134 @@
+import asyncio
+import random
+import sys
+import time
+
+from datetime import datetime, timedelta, timezone
+
+#* Load generator of ingestService.py, made up UPLYs sending their reports as the Arduino does, over keep-alive connections
+#* Prints the requests answered every second, then the sustained rate, latency percentiles and answers by status
+#* python ingestService.py --dry-run 1 in one terminal (or against a DB), python ingestLoad.py [options] in another
+
+HOST = "127.0.0.1"
+PORT = 8080
+CONNECTIONS = 64
+SECONDS = 10
+BUSES = 1000
+
+# Share of each report, most are GPS fixes
+REPORTS = [["/UPLYGPS.php", 0.8], ["/UPLYOpenings.php", 0.15], ["/UPLYPassengers.php", 0.05]]
+
+def getQuery(path, uplyId, moment, rng):
+	#* GET parameters of a report of the UPLY uplyId at moment (UTC), as the Arduino formats them
+	latitude = f"{38.7 + rng.uniform(-0.2, 0.2):.6f}"
+	longitude = f"{-9.1 + rng.uniform(-0.2, 0.2):.6f}"
+	day = moment.strftime("%y%m%d")
+	utcTime = moment.strftime("%H%M%S") + ".000"
+	if(path == "/UPLYGPS.php"):
+		return (f"Latitude={latitude}&Longitude={longitude}&Altitude={rng.uniform(0, 200):.1f}&Velocity={rng.uniform(0, 60):.2f}"
+			f"&UTCTime={utcTime}&Date={day}&UPLYID={uplyId}")
+	if(path == "/UPLYOpenings.php"):
+		closing = (moment + timedelta(seconds = 20)).strftime("%H%M%S")
+		return (f"OpeningUTCTime={utcTime}&ClosingUTCTime={closing}&OpenedTime=20&Latitude={latitude}&Longitude={longitude}"
+			f"&Altitude={rng.uniform(0, 200):.1f}&Date={day}&UPLYID={uplyId}&DiffPeople={rng.randint(-5, 5)}"
+			f"&DiffWeight={rng.uniform(-300, 300):.3f}&Capacity={rng.randint(0, 100)}")
+	return (f"EntryLatitude={latitude}&EntryLongitude={longitude}&ExitLatitude={latitude}&ExitLongitude={longitude}"
+		f"&EntryTime={utcTime}&ExitTime={utcTime}&Date={day}&Weight={rng.uniform(40, 120):.3f}&UPLYID={uplyId}")
+
+async def runClient(host, port, numBuses, deadline, results, seed):
+	# One keep-alive connection sending requests back to back until deadline, results are [second, latency, status]
+	rng = random.Random(seed)
+	paths = [path for path, _ in REPORTS]
+	weights = [weight for _, weight in REPORTS]
+	reader, writer = await asyncio.open_connection(host, port)
+	try:
+		start = time.perf_counter()
+		while start < deadline:
+			path = rng.choices(paths, weights)[0]
+			query = getQuery(path, rng.randint(1, numBuses), datetime.now(timezone.utc), rng)
+			writer.write(f"GET {path}?{query} HTTP/1.1\r\nHost: {host}\r\n\r\n".encode())
+			await writer.drain()
+
+			head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+			length = 0
+			for line in head[1:]:
+				name, _, value = line.partition(":")
+				if(name.lower() == "content-length"):
+					length = int(value)
+			await reader.readexactly(length)
+
+			end = time.perf_counter()
+			results.append([int(end), end - start, int(head[0].split(" ")[1])])
+			start = end
+	finally:
+		writer.close()
+
+async def runLoad(host, port, numConnections, seconds, numBuses):
+	#* Returns [seconds taken, results] of numConnections clients sending requests for seconds
+	results = []
+	start = time.perf_counter()
+	clients = [runClient(host, port, numBuses, start + seconds, results, seed) for seed in range(numConnections)]
+	await asyncio.gather(*clients)
+	return [time.perf_counter() - start, results]
+
+def readLoadOptions(args):
+	# "--option value" pairs, returns the options or None if one is invalid
+	options = {"--host": HOST, "--port": PORT, "--connections": CONNECTIONS, "--seconds": SECONDS, "--buses": BUSES}
+	if(len(args) % 2 != 0):
+		print("Missing value for option ->", args[-1])
+		return None
+
+	for arg, value in zip(args[::2], args[1::2]):
+		if arg not in options:
+			print("Unrecognized option ->", arg)
+			return None
+		try:
+			options[arg] = type(options[arg])(value)
+		except ValueError:
+			print("Invalid value for option", arg, "->", value)
+			return None
+
+	if(min(options["--connections"], options["--seconds"], options["--buses"]) < 1):
+		print("Options --connections, --seconds and --buses must be at least 1")
+		return None
+	return options
+
+def main():
+	options = readLoadOptions(sys.argv[1:])
+	if(options == None):
+		print("Usage: python ingestLoad.py [options]")
+		print("Options\t--host <address> --port <port> (of the ingest service, default " + HOST + ":" + str(PORT) + ")")
+		print("\t--connections <clients> (concurrent keep-alive connections, default " + str(CONNECTIONS) + ")")
+		print("\t--seconds <seconds> (how long to send for, default " + str(SECONDS) + ")")
+		print("\t--buses <buses> (UPLYIDs the reports are spread over, default " + str(BUSES) + ")")
+		sys.exit(2)
+
+	try:
+		seconds, results = asyncio.run(runLoad(options["--host"], options["--port"], options["--connections"], options["--seconds"],
+			options["--buses"]))
+	except (OSError, asyncio.IncompleteReadError) as error:
+		print(f"Error while sending requests -> '{error}'")
+		sys.exit(1)
+
+	if not results:
+		print("No requests were answered")
+		sys.exit(1)
+
+	# Requests answered in each whole second, the first and last are partial
+	perSecond = {}
+	statuses = {}
+	for second, _, status in results:
+		perSecond[second] = perSecond.get(second, 0) + 1
+		statuses[status] = statuses.get(status, 0) + 1
+	for index, second in enumerate(sorted(perSecond)[1:-1]):
+		print(f"{index + 1:>4} s -> {perSecond[second]} requests/s")
+
+	latencies = sorted(latency for _, latency, _ in results)
+	percentiles = ", ".join(f"p{percent} {latencies[min(len(latencies) - 1, len(latencies) * percent // 100)] * 1000:.2f} ms"
+		for percent in [50, 90, 99])
+	print(f"{len(results)} requests in {seconds:.2f} s over {options['--connections']} connections -> {len(results) / seconds:.0f} requests/s")
+	print(f"Latency -> {percentiles}")
+	print("Answers ->", ", ".join(f"{count} x {status}" for status, count in sorted(statuses.items())))
+
+if(__name__ == "__main__"):
+	main()
@@ -0,0 +1,598 @@
+import asyncio
+import json
+import os
+import re
+import signal
+import sys
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+from urllib.parse import parse_qsl
+from mysql.connector import Error
+from dbConnection import getPool, retryDelay, isTransientError, printMetrics, METRICS
+from dbWriter import batches, safeRollback, BATCH_SIZE
+
+#* Ingest service of the UPLYs' reports, in place of one mysqli connection and INSERT per request in the PHP endpoints
+#* Takes the same GET requests as UPLYGPS.php, UPLYPassengers.php, UPLYOpenings.php and UPLYEntryPoint.php (which now forward to it),
+#* validates them and buffers the rows, that are inserted into GPS, Passengers and Openings every FLUSH_ROWS rows or FLUSH_TIME
+#* seconds, as multi-row INSERTs of one pooled connection in a writer thread, so the event loop never waits for the DB
+#* Requests wait while MAX_PENDING rows are not written yet, and are answered 503 after BACKPRESSURE_WAIT
+#* When the DB can't be written, the rows are spilled to files in the spill directory (fsynced before being dropped from memory),
+#* written back first once it can, so each table's rows reach the DB in the order they arrived
+#* Rows the DB refuses for good (a bad value, a duplicate key) are never retried, they are moved to the rejected directory inside the
+#* spill directory, to be looked at by hand, and the rows after them keep being written
+#* python ingestService.py [options] runs the service, see ingestLoad.py for a load generator
+
+HOST = "0.0.0.0"
+PORT = 8080
+FLUSH_ROWS = 500		# Rows of a table that trigger a flush
+FLUSH_TIME = 0.2		# Seconds between flushes, at most
+MAX_PENDING = 20000		# Rows accepted but not written (or spilled) yet
+BACKPRESSURE_WAIT = 2	# Seconds a request waits for room before being answered 503
+IDLE_TIMEOUT = 30		# Seconds a keep-alive connection is kept without requests
+MAX_BODY = 65536		# Bytes of a request's body, which is read and ignored
+SPILL_DIR = "./ingestSpill"
+REJECTED_DIR = "rejected"	# Inside the spill directory
+
+#? Rows are stored as the UPLYs send them: dates and times in UTC, Date as YYMMDD (or YYYY-MM-DD) and times as hhmmss(.sss)
+TIME_PATTERN = re.compile(r"(\d{2}):?(\d{2}):?(\d{2})(\.\d{1,6})?")
+# Plain decimals only, float() and int() would also take "nan", "1e9" or "1_000"
+NUMBER_PATTERN = re.compile(r"[-+]?(\d+\.?\d*|\.\d+)")
+INTEGER_PATTERN = re.compile(r"[-+]?\d{1,19}")
+
+def parseNumber(low, high):
+	def parse(text):
+		if not NUMBER_PATTERN.fullmatch(text):
+			raise ValueError("not a number")
+		value = float(text)
+		if not low <= value <= high:
+			raise ValueError(f"not between {low} and {high}")
+		return value
+	return parse
+
+def parseInteger(low, high):
+	def parse(text):
+		if not INTEGER_PATTERN.fullmatch(text):
+			raise ValueError("not an integer")
+		value = int(text)
+		if not low <= value <= high:
+			raise ValueError(f"not between {low} and {high}")
+		return value
+	return parse
+
+def parseDate(text):
+	# date() raises ValueError on days that don't exist
+	if re.fullmatch(r"\d{6}", text):
+		return date(2000 + int(text[:2]), int(text[2:4]), int(text[4:])).isoformat()
+	if re.fullmatch(r"\d{4}-\d{2}-\d{2}", text):
+		return date(int(text[:4]), int(text[5:7]), int(text[8:])).isoformat()
+	raise ValueError("not a date")
+
+def parseTime(text):
+	match = TIME_PATTERN.fullmatch(text)
+	if(match == None or int(match[1]) > 23 or int(match[2]) > 59 or int(match[3]) > 59):
+		raise ValueError("not a time")
+	return f"{match[1]}:{match[2]}:{match[3]}{match[4] or ''}"
+
+def parseDuration(text):
+	# Seconds, or a time
+	if ":" in text:
+		return parseTime(text)
+	seconds = parseNumber(0, 86399)(text)
+	return f"{int(seconds) // 3600:02d}:{int(seconds) // 60 % 60:02d}:{seconds % 60:09.6f}"
+
+#? Ranges are the ones of the columns in DBSchema.ods
+parseLatitude = parseNumber(-90, 90)
+parseLongitude = parseNumber(-180, 180)
+parseUPLYID = parseInteger(1, 2 ** 63 - 1)
+
+# key = table, value = [[column (and GET parameter), parser, required]]
+TABLE_FIELDS = {
+	"GPS": [
+		["Latitude", parseLatitude, True],
+		["Longitude", parseLongitude, True],
+		["Altitude", parseNumber(-9999.99, 9999.99), True],
+		["Velocity", parseNumber(0, 999.99), True],
+		["UTCTime", parseTime, True],
+		["Date", parseDate, True],
+		["UPLYID", parseUPLYID, True],
+	],
+	"Passengers": [
+		["EntryLatitude", parseLatitude, True],
+		["EntryLongitude", parseLongitude, True],
+		["ExitLatitude", parseLatitude, True],
+		["ExitLongitude", parseLongitude, True],
+		["EntryTime", parseTime, True],
+		["ExitTime", parseTime, True],
+		["Date", parseDate, True],
+		["Weight", parseNumber(0, 999.999), True],
+		["UPLYID", parseUPLYID, True],
+	],
+	# UPLYEntryPoint.php only sends the opening, closing and opened times with the position
+	"Openings": [
+		["OpeningUTCTime", parseTime, True],
+		["ClosingUTCTime", parseTime, False],
+		["OpenedTime", parseDuration, False],
+		["Latitude", parseLatitude, True],
+		["Longitude", parseLongitude, True],
+		["Altitude", parseNumber(-9999.99, 9999.99), True],
+		["Date", parseDate, True],
+		["UPLYID", parseUPLYID, True],
+		["DiffPeople", parseInteger(-128, 127), False],
+		["DiffWeight", parseNumber(-999.999, 999.999), False],
+		["Capacity", parseInteger(0, 255), False],
+	],
+}
+
+# key = path, value = table, None is UPLYEntryPoint.php's, which tells Openings from GPS by the parameters
+ENDPOINTS = {
+	"/UPLYGPS.php": "GPS",
+	"/UPLYPassengers.php": "Passengers",
+	"/UPLYOpenings.php": "Openings",
+	"/UPLYEntryPoint.php": None,
+}
+
+# Answers as the PHP endpoints gave them
+PAGE = "<html>\n  <body>\n    {}\n  </body>\n</html>"
+REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 503: "Service Unavailable"}
+
+def getInsertQuery(tableName):
+	# executemany sends the rows of an INSERT ... VALUES as one multi-row statement
+	columns = [field[0] for field in TABLE_FIELDS[tableName]]
+	return f"INSERT INTO {tableName} ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})"
+
+def parseRow(tableName, params):
+	#* Returns the row of tableName in the GET parameters params, raises ValueError if one is missing or invalid
+	row = []
+	for column, parse, required in TABLE_FIELDS[tableName]:
+		text = params.get(column, "").strip()
+		if not text:
+			if required:
+				raise ValueError(f"missing {column}")
+			row.append(None)
+			continue
+		try:
+			row.append(parse(text))
+		except ValueError as error:
+			raise ValueError(f"invalid {column} '{text[:32]}', {error}")
+	return row
+
+def getResponse(status, body, keepAlive, headers = {}):
+	head = [f"HTTP/1.1 {status} {REASONS[status]}", "Content-Type: text/html; charset=utf-8", f"Content-Length: {len(body)}",
+		"Connection: " + ("keep-alive" if keepAlive else "close")]
+	head += [f"{name}: {value}" for name, value in headers.items()]
+	return ("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body
+
+def syncDir(path):
+	# A rename is only durable once its directory is synced
+	dirFd = os.open(path, os.O_RDONLY)
+	try:
+		os.fsync(dirFd)
+	finally:
+		os.close(dirFd)
+
+class SpillDir:
+	#* Rows the DB couldn't take, one file per flush ({table: rows}), named by an increasing sequence number
+	#* A file is written to a .part file, fsynced and renamed, so a crash never leaves half of one
+	#* Files the DB refused for good are moved to the rejected directory, with the same names
+	def __init__(self, path):
+		self.path = path
+		self.rejectedPath = os.path.join(path, REJECTED_DIR)
+		os.makedirs(self.rejectedPath, exist_ok = True)
+		self.files = sorted(name for name in os.listdir(path) if name.endswith(".json"))
+		# Numbers go on from the rejected files too, so a new file never replaces one of them
+		names = self.files + [name for name in os.listdir(self.rejectedPath) if name.endswith(".json")]
+		self.nextFile = max(int(name[:-5]) for name in names) + 1 if names else 0
+
+	def __len__(self):
+		return len(self.files)
+
+	def write(self, tables, rejected = False):
+		# Returns the name of the file, rejected tables go straight to the rejected directory
+		name = f"{self.nextFile:012d}.json"
+		path = self.rejectedPath if rejected else self.path
+		tempPath = os.path.join(path, name + ".part")
+		with open(tempPath, 'w', encoding = "utf8") as file:
+			json.dump(tables, file)
+			file.flush()
+			os.fsync(file.fileno())
+		os.replace(tempPath, os.path.join(path, name))
+		syncDir(path)
+		if not rejected:
+			self.files.append(name)
+		self.nextFile += 1
+		return name
+
+	def rewrite(self, name, tables):
+		# Replaces the rows of a spilled file, with the ones of it still to write
+		tempPath = os.path.join(self.path, name + ".part")
+		with open(tempPath, 'w', encoding = "utf8") as file:
+			json.dump(tables, file)
+			file.flush()
+			os.fsync(file.fileno())
+		os.replace(tempPath, os.path.join(self.path, name))
+		syncDir(self.path)
+
+	def read(self):
+		# Oldest file, [name, {table: rows}]
+		with open(os.path.join(self.path, self.files[0]), 'r', encoding = "utf8") as file:
+			return [self.files[0], json.load(file)]
+
+	def remove(self, name):
+		os.remove(os.path.join(self.path, name))
+		self.files.remove(name)
+
+	def reject(self, name):
+		os.replace(os.path.join(self.path, name), os.path.join(self.rejectedPath, name))
+		syncDir(self.rejectedPath)
+		self.files.remove(name)
+
+class IngestService:
+	def __init__(self, flushRows = FLUSH_ROWS, flushTime = FLUSH_TIME, maxPending = MAX_PENDING, spillDir = SPILL_DIR,
+		batchSize = BATCH_SIZE, dryRun = False):
+		self.flushRows = flushRows
+		self.flushTime = flushTime
+		self.maxPending = maxPending
+		self.batchSize = batchSize
+		self.dryRun = dryRun	# Rows are counted and dropped, for load tests without a DB
+		self.spill = SpillDir(spillDir)
+
+		self.buffers = {tableName: [] for tableName in TABLE_FIELDS}
+		self.pending = 0		# Rows in the buffers and being written
+		self.full = asyncio.Event()
+		self.room = asyncio.Condition()
+		self.running = True
+
+		# Only the writer thread touches the DB connection and the spill directory
+		self.executor = ThreadPoolExecutor(max_workers = 1)
+		self.conn = None
+		self.failures = 0		# Writes failed in a row
+		self.retryAt = 0		# time.monotonic() before which rows go straight to the spill directory
+
+		self.stats = {"requests": 0, "accepted": 0, "rejected": 0, "throttled": 0, "flushes": 0, "inserted": 0, "spilled": 0, "replayed": 0,
+			"refused": 0}
+
+	# Writer thread
+
+	def getConnection(self):
+		if(self.conn == None):
+			self.conn = getPool().get_connection()
+			METRICS["connectionsCreated"] += 1
+		return self.conn
+
+	def dropConnection(self):
+		# A connection that failed is given back and a new one taken next time, the pool reconnects it
+		if(self.conn != None):
+			safeRollback(self.conn)
+			try:
+				self.conn.close()
+			except Error:
+				pass
+			self.conn = None
+			METRICS["reconnects"] += 1
+
+	def insertTables(self, tables):
+		# All rows of tables in one transaction, no runWithRetry here, the rows are spilled instead and written once the DB is back
+		conn = self.getConnection()
+		cursor = conn.cursor()
+		for tableName, rows in tables.items():
+			for batch in batches(rows, self.batchSize):
+				cursor.executemany(getInsertQuery(tableName), batch)
+				METRICS["statements"] += 1
+		conn.commit()
+		METRICS["commits"] += 1
+		cursor.close()
+
+	def refuse(self, error):
+		# Whether error means the DB won't ever take the rows, an error while connecting (or a .env the pool can't be made from)
+		# says nothing about them, so they are kept for later
+		if(self.conn == None or not isinstance(error, Error) or error.errno == None or isTransientError(error)):
+			return False
+		safeRollback(self.conn)
+		return True
+
+	def insertIsolating(self, tables):
+		#* Writes the rows of tables, when the DB refuses them each table is written on its own, and the rows it refuses are halved
+		#* until the ones refused are alone, so a bad row costs only itself and not the rows that came with it
+		#* Returns [{table: rows} refused, {table: rows} not written, error that stopped it or None], any error the DB may get over stops it
+		try:
+			self.insertTables(tables)
+			return [{}, {}, None]
+		except Error as error:
+			if not self.refuse(error):
+				return [{}, tables, error]
+
+		refused = {}
+		pending = [[tableName, rows] for tableName, rows in reversed(tables.items()) if rows]	# Last is written first
+		while pending:
+			tableName, rows = pending.pop()
+			try:
+				self.insertTables({tableName: rows})
+			except Error as error:
+				if not self.refuse(error):
+					unwritten = {}
+					for pendingTable, pendingRows in [[tableName, rows]] + pending[::-1]:
+						unwritten.setdefault(pendingTable, []).extend(pendingRows)
+					return [refused, unwritten, error]
+				if(len(rows) == 1):
+					refused.setdefault(tableName, []).extend(rows)
+					print(f"Row of {tableName} refused -> '{error}'")
+				else:
+					middle = len(rows) // 2
+					pending += [[tableName, rows[middle:]], [tableName, rows[:middle]]]
+		return [refused, {}, None]
+
+	def rejectRows(self, refused):
+		# Refused rows go to the rejected directory, retrying them would block the ones after them
+		numRows = sum(len(rows) for rows in refused.values())
+		if not numRows:
+			return 0
+		try:
+			name = self.spill.write(refused, rejected = True)
+			print(f"{numRows} refused rows moved to {self.spill.rejectedPath}/{name}")
+		except OSError as error:
+			print(f"Error while moving {numRows} refused rows to {self.spill.rejectedPath}, they are lost -> '{error}'")
+		self.stats["refused"] += numRows
+		return numRows
+
+	def replaySpill(self):
+		# Spilled rows go first, oldest file first, a file is removed once its rows are committed
+		#? A crash between a commit and the removal (or rewrite) of the file writes those rows twice
+		while len(self.spill):
+			try:
+				name, tables = self.spill.read()
+			except ValueError as error:	# Not JSON, it can't be written either
+				name = self.spill.files[0]
+				self.spill.reject(name)
+				print(f"Error while reading spilled file {name}, moved to {self.spill.rejectedPath} -> '{error}'")
+				continue
+			numRows = sum(len(rows) for rows in tables.values())
+			refused, unwritten, error = self.insertIsolating(tables)
+			numRefused = self.rejectRows(refused)
+			if(error != None):
+				# What was written is left out of the file, so it isn't written again
+				numUnwritten = sum(len(rows) for rows in unwritten.values())
+				if(numUnwritten < numRows):
+					self.spill.rewrite(name, unwritten)
+					self.stats["replayed"] += numRows - numRefused - numUnwritten
+				raise error
+			self.spill.remove(name)
+			self.stats["replayed"] += numRows - numRefused
+
+	def writeTables(self, tables):
+		#* Writes the rows of tables ({table: rows}), or spills them if the DB can't take them
+		numRows = sum(len(rows) for rows in tables.values())
+		if self.dryRun:
+			self.stats["inserted"] += numRows
+			return
+
+		if(time.monotonic() >= self.retryAt):
+			try:
+				self.replaySpill()
+				if tables:
+					refused, unwritten, error = self.insertIsolating(tables)
+					numRefused = self.rejectRows(refused)
+					numUnwritten = sum(len(rows) for rows in unwritten.values())
+					self.stats["inserted"] += numRows - numRefused - numUnwritten
+					if(error != None):
+						# Only the rows not written yet are spilled
+						tables = unwritten
+						numRows = numUnwritten
+						raise error
+				if self.failures:
+					print("DB writable again, spill directory replayed")
+				self.failures = 0
+				return
+			except (Error, ValueError, TypeError) as error:	# ValueError and TypeError are a .env the pool can't be made from
+				self.dropConnection()
+				delay = retryDelay(min(self.failures, 6))
+				self.retryAt = time.monotonic() + delay
+				self.failures += 1
+				print(f"Error while writing rows, spilling them for {delay:.1f} s -> '{error}'")
+
+		if tables:
+			try:
+				self.spill.write(tables)
+			except OSError as error:
+				# Nowhere left to put them
+				print(f"Error while spilling {numRows} rows, they are lost -> '{error}'")
+				return
+			self.stats["spilled"] += numRows
+
+	# Event loop
+
+	async def addRow(self, tableName, row):
+		#* Buffers row, waiting up to BACKPRESSURE_WAIT for room, returns False if there was none
+		if(self.pending >= self.maxPending):
+			async with self.room:
+				try:
+					await asyncio.wait_for(self.room.wait_for(lambda: self.pending < self.maxPending), BACKPRESSURE_WAIT)
+				except asyncio.TimeoutError:
+					self.stats["throttled"] += 1
+					return False
+
+		buffer = self.buffers[tableName]
+		buffer.append(row)
+		self.pending += 1
+		self.stats["accepted"] += 1
+		if(len(buffer) >= self.flushRows):
+			self.full.set()
+		return True
+
+	async def flushLoop(self):
+		# Runs until the service stops and its buffers are written
+		loop = asyncio.get_running_loop()
+		while self.running or self.pending:
+			try:
+				await asyncio.wait_for(self.full.wait(), self.flushTime)
+			except asyncio.TimeoutError:
+				pass
+			self.full.clear()
+
+			tables = {tableName: rows for tableName, rows in self.buffers.items() if rows}
+			if(not tables and not len(self.spill)):
+				continue
+			self.buffers = {tableName: [] for tableName in TABLE_FIELDS}
+			numRows = sum(len(rows) for rows in tables.values())
+
+			# Spilled rows are retried even when nothing new arrives
+			await loop.run_in_executor(self.executor, self.writeTables, tables)
+			if tables:
+				self.stats["flushes"] += 1
+			self.pending -= numRows
+			async with self.room:
+				self.room.notify_all()
+
+	def getStatus(self):
+		return dict(self.stats, pending = self.pending, spillFiles = len(self.spill), **METRICS)
+
+	async def handleRequest(self, method, target):
+		# Returns [status, body, headers]
+		path, _, query = target.partition("?")
+		if(path == "/status"):
+			return [200, json.dumps(self.getStatus()), {}]
+		if path not in ENDPOINTS:
+			return [404, PAGE.format("Not found"), {}]
+		if(method != "GET"):
+			return [405, PAGE.format("Only GET requests"), {"Allow": "GET"}]
+
+		# The last of a repeated parameter wins, as in PHP
+		params = dict(parse_qsl(query, keep_blank_values = True))
+		tableName = ENDPOINTS[path]
+		if(tableName == None):
+			tableName = "Openings" if params.get("OpeningUTCTime") else "GPS"
+		try:
+			row = parseRow(tableName, params)
+		except ValueError as error:
+			self.stats["rejected"] += 1
+			return [400, PAGE.format(f"An error ocurred: {error}"), {}]
+
+		if not await self.addRow(tableName, row):
+			return [503, PAGE.format("An error ocurred: too many requests, try again later"), {"Retry-After": BACKPRESSURE_WAIT}]
+		return [200, PAGE.format("Change made successfully"), {}]
+
+	async def handleClient(self, reader, writer):
+		# HTTP/1.1 with keep-alive, one request at a time
+		try:
+			while self.running:
+				try:
+					head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT)
+				except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError):
+					break
+
+				lines = head.decode("latin-1").split("\r\n")
+				request = lines[0].split(" ")
+				headers = {}
+				for line in lines[1:]:
+					name, _, value = line.partition(":")
+					headers[name.strip().lower()] = value.strip()
+				try:
+					length = int(headers.get("content-length", "0"))
+				except ValueError:
+					length = -1
+				if(len(request) != 3 or not request[2].startswith("HTTP/") or not 0 <= length <= MAX_BODY):
+					writer.write(getResponse(400, PAGE.format("Bad request").encode(), False))
+					await writer.drain()
+					break
+				if length:
+					await reader.readexactly(length)
+
+				method, target, version = request
+				self.stats["requests"] += 1
+				status, body, extraHeaders = await self.handleRequest(method, target)
+				connection = headers.get("connection", "").lower()
+				keepAlive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+				body = body.encode()
+				writer.write(getResponse(status, body, keepAlive, extraHeaders))
+				await writer.drain()
+				if not keepAlive:
+					break
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		finally:
+			writer.close()
+
+	async def serve(self, host = HOST, port = PORT):
+		server = await asyncio.start_server(self.handleClient, host, port, backlog = 1024)
+		flusher = asyncio.create_task(self.flushLoop())
+		stopped = asyncio.Event()
+		loop = asyncio.get_running_loop()
+		for signalNumber in [signal.SIGINT, signal.SIGTERM]:
+			loop.add_signal_handler(signalNumber, stopped.set)
+
+		print(f"Ingest service listening on {host}:{port}" + (" (dry run, rows are dropped)" if self.dryRun else ""))
+		if len(self.spill):
+			print(f"{len(self.spill)} spilled file(s) to write first")
+		await stopped.wait()
+
+		# No new requests, the buffered rows are written (or spilled) before leaving
+		print("Stopping, writing the buffered rows")
+		server.close()
+		self.running = False
+		self.full.set()
+		await flusher
+		self.executor.shutdown()
+		if(self.conn != None):
+			self.conn.close()
+
+def readIngestOptions(args):
+	# "--option value" pairs, returns the options or None if one is invalid
+	options = {
+		"--host": HOST,
+		"--port": PORT,
+		"--flush-rows": FLUSH_ROWS,
+		"--flush-ms": int(FLUSH_TIME * 1000),
+		"--max-pending": MAX_PENDING,
+		"--batch-size": BATCH_SIZE,
+		"--spill-dir": SPILL_DIR,
+		"--dry-run": 0,
+	}
+	if(len(args) % 2 != 0):
+		print("Missing value for option ->", args[-1])
+		return None
+
+	for arg, value in zip(args[::2], args[1::2]):
+		if arg not in options:
+			print("Unrecognized option ->", arg)
+			return None
+		try:
+			options[arg] = type(options[arg])(value)
+		except ValueError:
+			print("Invalid value for option", arg, "->", value)
+			return None
+
+	if(min(options["--flush-rows"], options["--flush-ms"], options["--max-pending"], options["--batch-size"]) < 1):
+		print("Options --flush-rows, --flush-ms, --max-pending and --batch-size must be at least 1")
+		return None
+	return options
+
+def main():
+	options = readIngestOptions(sys.argv[1:])
+	if(options == None):
+		print("Usage: python ingestService.py [options]")
+		print("Options\t--host <address> --port <port> (to listen on, default " + HOST + ":" + str(PORT) + ")")
+		print("\t--flush-rows <rows> (rows of a table that are inserted together, default " + str(FLUSH_ROWS) + ")")
+		print("\t--flush-ms <milliseconds> (most time rows wait in memory, default " + str(int(FLUSH_TIME * 1000)) + ")")
+		print("\t--max-pending <rows> (rows not written yet before requests are held back, default " + str(MAX_PENDING) + ")")
+		print("\t--batch-size <rows> (rows per INSERT, default " + str(BATCH_SIZE) + ")")
+		print("\t--spill-dir <dir> (where rows wait while the DB is unavailable, default " + SPILL_DIR + ", rows the DB refuses go to its " + REJECTED_DIR + " directory)")
+		print("\t--dry-run 1 (count and drop the rows instead of writing them, for load tests)")
+		sys.exit(2)
+
+	async def run():
+		service = IngestService(options["--flush-rows"], options["--flush-ms"] / 1000, options["--max-pending"], options["--spill-dir"],
+			options["--batch-size"], bool(options["--dry-run"]))
+		await service.serve(options["--host"], options["--port"])
+		print("Ingest ->", ", ".join(f"{value} {key}" for key, value in service.stats.items()))
+
+	try:
+		asyncio.run(run())
+	except OSError as error:
+		print(f"Error while starting the ingest service -> '{error}'")
+		sys.exit(1)
+	finally:
+		printMetrics()
+
+if(__name__ == "__main__"):
+	main()
@@ -0,0 +1,619 @@
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from datetime import timedelta
+from feedCache import openFeedCache, CACHE_DIR, NO_TIME
+from serviceCalendar import openServiceCalendar
+from stopIndex import openStopIndex
+
+#* Journey planner over the feed's timetable, RAPTOR (round-based public transit routing) with walking transfers between stops
+#* Trips with the same stops and service make a route, split further so no trip of a route overtakes another, so a whole route runs
+#* on a day or doesn't, and the earliest trip a rider can catch at a stop is the earliest at every stop after it
+#* Round k finds the earliest arrivals with k buses, the routes of a round are scanned at once with numpy: a binary search in every
+#* column finds the trip caught at the stops marked in the round before, a running minimum along the route the trip ridden at each stop
+#* The timetable is kept memory-mapped in the feed's cache directory, so processes answering queries share it, the days routes run
+#* on are read from the service calendar (see serviceCalendar.py)
+#* python journeyPlanner.py <feed.zip> [queries] benchmarks it with random queries
+
+PLANNER_VERSION = 2
+MAX_ROUNDS = 5			# Buses a journey can take
+MAX_WALK = 400			# Meters in a straight line a transfer can walk between stops
+WALK_SPEED = 1.2		# Meters per second
+WALK_DETOUR = 1.3		# Streets are longer than the straight line
+CHANGE_TIME = 60		# Seconds from reaching a stop to catching a bus there, but at the origin
+PROFILE_WINDOW = 3600	# Seconds of departures a profile query covers when not told
+
+INFINITY = np.iinfo(np.int64).max // 4
+ORIGIN = -1		# Parent route of the origin
+
+#* Arrays of a planner, routes are numbered from 0 and every stop of a route is a column
+# routeStopStarts -> columns of route r are routeStopStarts[r] to routeStopStarts[r + 1], columnStops the stop (index in the cache's stopIds)
+# of each
+# routeTripStarts -> trips of route r are routeTrips[routeTripStarts[r]:routeTripStarts[r + 1]] (index in the cache's tripIds), by time
+# routeServices, routeLastTimes -> service (index in the cache's serviceIds) of every route, and the last arrival of its trips
+# columnTimeStarts -> times of the trips of column c are departures and arrivals from columnTimeStarts[c] on, in the order of routeTrips
+# columnLastDepartures -> departure of the last trip of every column
+# stopRouteStarts -> routes stopping at stop s are stopRoutes[k], at position stopRoutePositions[k], for k in stopRouteStarts[s] to
+# stopRouteStarts[s + 1]
+# transferStarts -> stops that can be walked to from stop s are transferStops[k], in transferTimes[k] seconds, for k in transferStarts[s]
+# to transferStarts[s + 1]
+# Times are seconds since the start of the service day (so they can go past 24:00)
+ARRAYS = ["routeStopStarts", "columnStops", "routeTripStarts", "routeTrips", "routeServices", "routeLastTimes", "columnTimeStarts",
+	"departures", "arrivals", "columnLastDepartures", "stopRouteStarts", "stopRoutes", "stopRoutePositions", "transferStarts", "transferStops",
+	"transferTimes"]
+
+def getTimes(cache):
+	#* Returns [arrivals, departures, routable] of the cache's stop times and trips
+	#* Stops without times take the previous stop's, GTFS only requires them at timepoints, trips that don't start with one aren't routable
+	offsets = np.asarray(cache.tripOffsets)
+	arrivals = np.asarray(cache.stopTimeArrival).astype(np.int64)
+	departures = np.asarray(cache.stopTimeDeparture).astype(np.int64)
+	arrivals = np.where(arrivals != NO_TIME, arrivals, departures)
+	departures = np.where(departures != NO_TIME, np.maximum(departures, arrivals), arrivals)
+
+	rows = np.arange(len(departures))
+	timed = departures != NO_TIME
+	previous = np.maximum.accumulate(np.where(timed, rows, -1)) if len(rows) else rows
+	tripOfRow = np.repeat(np.arange(len(cache.tripIds)), np.diff(offsets))
+	filled = (previous >= 0) & (previous >= offsets[tripOfRow])
+	routable = np.ones(len(cache.tripIds), dtype = bool)
+	routable[tripOfRow[~filled]] = False
+
+	previous = np.where(filled, previous, rows)
+	arrivals = np.where(timed, arrivals, departures[previous])
+	departures = departures[previous]
+	return [arrivals, departures, routable]
+
+def getRoutes(cache, arrivals, departures, routable):
+	# [service, trips] of every route, trips by time
+	offsets = np.asarray(cache.tripOffsets)
+	stopTimeStops = np.asarray(cache.stopTimeStop)
+	groups = {}
+	for trip, [service, start, end] in enumerate(zip(cache.tripService.tolist(), offsets[:-1].tolist(), offsets[1:].tolist())):
+		if(end - start >= 2 and routable[trip]):
+			groups.setdefault((service, stopTimeStops[start:end].tobytes()), []).append(trip)
+
+	routes = []
+	for [service, _], trips in groups.items():
+		trips.sort(key = lambda trip: (departures[offsets[trip]], arrivals[offsets[trip + 1] - 1]))
+
+		# Every trip goes in the first route of the group it doesn't overtake, [trips, last trip's departures, last trip's arrivals]
+		split = []
+		for trip in trips:
+			tripDepartures = departures[offsets[trip]:offsets[trip + 1]]
+			tripArrivals = arrivals[offsets[trip]:offsets[trip + 1]]
+			for route in split:
+				if((tripDepartures >= route[1]).all() and (tripArrivals >= route[2]).all()):
+					route[0].append(trip)
+					route[1] = tripDepartures
+					route[2] = tripArrivals
+					break
+			else:
+				split.append([[trip], tripDepartures, tripArrivals])
+		routes += [[service, route[0]] for route in split]
+	return routes
+
+def getTransfers(cache, index):
+	# [from stops, to stops, seconds] of the walks between stops of the cache closer than MAX_WALK, from the grid of the stop index
+	cellStarts = np.asarray(index.cellStarts)
+	x = np.asarray(index.x)
+	y = np.asarray(index.y)
+	cellX, cellY = index.getCells(x, y)
+	stops = np.arange(len(x))
+	reach = int(np.ceil(MAX_WALK / index.cellSize))
+
+	fromStops = []
+	toStops = []
+	distances = []
+	for offsetX in range(-reach, reach + 1):
+		for offsetY in range(-reach, reach + 1):
+			neighbourX = cellX + offsetX
+			neighbourY = cellY + offsetY
+			inside = (neighbourX >= 0) & (neighbourX < index.numX) & (neighbourY >= 0) & (neighbourY < index.numY)
+			cell = np.where(inside, neighbourX * index.numY + neighbourY, 0)
+			starts = cellStarts[cell]
+			counts = np.where(inside, cellStarts[cell + 1] - starts, 0)
+			pairFrom = np.repeat(stops, counts)
+			pairTo = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(len(pairFrom))
+			distance = np.hypot(x[pairTo] - x[pairFrom], y[pairTo] - y[pairFrom])
+			near = (distance <= MAX_WALK) & (pairTo != pairFrom)
+			fromStops.append(pairFrom[near])
+			toStops.append(pairTo[near])
+			distances.append(distance[near])
+
+	# Stops of the index are ordered by cell, the planner's are the cache's
+	cacheStopIds = np.asarray(cache.stopIds)
+	order = np.argsort(cacheStopIds, kind = "stable")
+	toCache = order[np.searchsorted(cacheStopIds[order], np.asarray(index.stopIds))]
+	fromStops = toCache[np.concatenate(fromStops)]
+	toStops = toCache[np.concatenate(toStops)]
+	seconds = np.ceil(np.concatenate(distances) * WALK_DETOUR / WALK_SPEED).astype(np.int64)
+	return [fromStops, toStops, seconds]
+
+def buildPlanner(cache, index, plannerPath):
+	#* Builds the timetable of the journey planner of the feed cache in plannerPath, with the stop index for the walks
+	numStops = len(cache.stopIds)
+	offsets = np.asarray(cache.tripOffsets)
+	arrivals, departures, routable = getTimes(cache)
+	routes = getRoutes(cache, arrivals, departures, routable)
+
+	# Times of every route as a matrix of its stops by its trips, stored by stop
+	routeLengths = np.array([offsets[trips[0] + 1] - offsets[trips[0]] for _, trips in routes], dtype = np.int64)
+	routeNumTrips = np.array([len(trips) for _, trips in routes], dtype = np.int64)
+	columnStops = []
+	columnTimes = [[], []]
+	routeLastTimes = []
+	for service, trips in routes:
+		rows = offsets[trips][:, None] + np.arange(offsets[trips[0] + 1] - offsets[trips[0]])
+		columnStops.append(np.asarray(cache.stopTimeStop)[rows[0]])
+		columnTimes[0].append(departures[rows].T.ravel())
+		columnTimes[1].append(arrivals[rows].T.ravel())
+		routeLastTimes.append(arrivals[rows[:, -1]].max())
+
+	routeStopStarts = np.concatenate([[0], np.cumsum(routeLengths)]).astype(np.int64)
+	numColumns = int(routeStopStarts[-1])
+	columnRoutes = np.repeat(np.arange(len(routes)), routeLengths)
+	columnTrips = routeNumTrips[columnRoutes]
+	columnTimeStarts = np.concatenate([[0], np.cumsum(columnTrips)[:-1]]).astype(np.int64) if numColumns else np.zeros(0, dtype = np.int64)
+	columnDepartures = np.concatenate(columnTimes[0]) if routes else np.zeros(0, dtype = np.int64)
+	columnStops = np.concatenate(columnStops).astype(np.int32) if routes else np.zeros(0, dtype = np.int32)
+
+	# Routes of every stop
+	stopOrder = np.argsort(columnStops, kind = "stable")
+	fromStops, toStops, transferTimes = getTransfers(cache, index)
+	transferOrder = np.lexsort((transferTimes, fromStops))
+
+	arrays = {
+		"routeStopStarts": routeStopStarts,
+		"columnStops": columnStops,
+		"routeTripStarts": np.concatenate([[0], np.cumsum(routeNumTrips)]).astype(np.int64),
+		"routeTrips": np.array([trip for _, trips in routes for trip in trips], dtype = np.int32),
+		"routeServices": np.array([service for service, _ in routes], dtype = np.int32),
+		"routeLastTimes": np.array(routeLastTimes, dtype = np.int32),
+		"columnTimeStarts": columnTimeStarts,
+		"departures": columnDepartures.astype(np.int32),
+		"arrivals": (np.concatenate(columnTimes[1]) if routes else np.zeros(0)).astype(np.int32),
+		"columnLastDepartures": columnDepartures[columnTimeStarts + columnTrips - 1].astype(np.int32),
+		"stopRouteStarts": np.concatenate([[0], np.cumsum(np.bincount(columnStops, minlength = numStops))]).astype(np.int64),
+		"stopRoutes": columnRoutes[stopOrder].astype(np.int32),
+		"stopRoutePositions": (np.arange(numColumns) - routeStopStarts[columnRoutes])[stopOrder].astype(np.int32),
+		"transferStarts": np.concatenate([[0], np.cumsum(np.bincount(fromStops, minlength = numStops))]).astype(np.int64),
+		"transferStops": toStops[transferOrder].astype(np.int32),
+		"transferTimes": transferTimes[transferOrder].astype(np.int32),
+	}
+	meta = {"version": PLANNER_VERSION, "maxLength": int(routeLengths.max()) if routes else 1, "maxTrips": int(routeNumTrips.max()) if routes else 1,
+		"serviceDays": int(max(routeLastTimes, default = 0) // 86400) + 1}
+
+	# Written to a temporary directory first, so a crash never leaves a broken planner
+	tempPath = plannerPath.rstrip("/") + f".part{os.getpid()}"
+	shutil.rmtree(tempPath, ignore_errors = True)
+	os.makedirs(tempPath)
+	for name, array in arrays.items():
+		np.save(os.path.join(tempPath, name + ".npy"), array)
+	with open(os.path.join(tempPath, "planner.json"), 'w', encoding = "utf8") as file:
+		json.dump(meta, file)
+
+	try:
+		os.rename(tempPath, plannerPath)
+	except OSError:	# Someone else built it first
+		shutil.rmtree(tempPath, ignore_errors = True)
+
+class Search:
+	#* Labels of one query, per round and stop: the earliest arrival, and the earliest arrival by bus and how it was reached
+	#* walkFroms is the stop walked from after its bus (-1 when the stop was reached by bus), parentRoutes the route ridden (ORIGIN),
+	#* parentFroms the position it was caught at, parentTrips and parentShifts its trip and the seconds its service day starts before
+	#* the query's, walks are kept apart so a stop reached walking earlier than by bus still has the bus to walk on from
+	def __init__(self, numRounds, numStops):
+		self.arrivals = np.full((numRounds + 1, numStops), INFINITY, dtype = np.int64)
+		self.busArrivals = np.full((numRounds + 1, numStops), INFINITY, dtype = np.int64)
+		self.best = np.full(numStops, INFINITY, dtype = np.int64)
+		self.bestBus = np.full(numStops, INFINITY, dtype = np.int64)
+		self.board = self.best	# Earliest a bus can be caught at each stop with the buses of the rounds before
+		self.walkFroms = np.full((numRounds + 1, numStops), -1, dtype = np.int32)
+		self.parentRoutes = np.full((numRounds + 1, numStops), ORIGIN, dtype = np.int32)
+		self.parentFroms = np.zeros((numRounds + 1, numStops), dtype = np.int32)
+		self.parentTrips = np.zeros((numRounds + 1, numStops), dtype = np.int32)
+		self.parentShifts = np.zeros((numRounds + 1, numStops), dtype = np.int32)
+
+def keepEarliest(stops, arrivals, numStops):
+	# Indices of the earliest arrival at every stop, the first of the ties
+	earliest = np.full(numStops, INFINITY, dtype = np.int64)
+	np.minimum.at(earliest, stops, arrivals)
+	winners = np.flatnonzero(arrivals == earliest[stops])
+	return winners[np.unique(stops[winners], return_index = True)[1]]
+
+class JourneyPlanner:
+	#* Timetable of a feed, opened memory-mapped from plannerPath, with the feed's cache for the ids and its service calendar
+	def __init__(self, plannerPath, cache, calendar):
+		self.cache = cache
+		self.calendar = calendar
+		for name in ARRAYS:
+			# Plain arrays over the mapped files, slicing a memmap costs more than the work
+			setattr(self, name, np.asarray(np.load(os.path.join(plannerPath, name + ".npy"), mmap_mode = "r")))
+
+		with open(os.path.join(plannerPath, "planner.json"), 'r', encoding = "utf8") as file:
+			meta = json.load(file)
+		self.maxLength = meta["maxLength"]
+		self.maxTrips = meta["maxTrips"]
+		self.serviceDays = meta["serviceDays"]	# Days a trip can run for, counting the one it starts
+
+		self.numStops = len(cache.stopIds)
+		self.numRoutes = len(self.routeServices)
+		self.stopIndex = {stopId: stop for stop, stopId in enumerate(cache.stopIds.tolist())}
+		self.routeLengths = np.diff(self.routeStopStarts)
+		self.routeNumTrips = np.diff(self.routeTripStarts)
+		self.columnPositions = np.arange(len(self.columnStops)) - np.repeat(self.routeStopStarts[:-1], self.routeLengths)
+		self.instancesCache = {}	# key = date, value = getInstances(date)
+
+	def getInstances(self, day):
+		# [routes, shifts, instance of every route on each day before] of the routes running on day (a date), an instance is a route
+		# on one service day, shift the seconds that day starts before day, the routes of the days before are the ones past midnight
+		instances = self.instancesCache.get(day)
+		if(instances == None):
+			routes = []
+			shifts = []
+			routeInstances = np.full((self.serviceDays, self.numRoutes), -1, dtype = np.int64)
+			numInstances = 0
+			for daysBefore in range(self.serviceDays):
+				serviceDay = day - timedelta(days = daysBefore)
+				if(self.calendar.getDay(serviceDay) == None):
+					continue
+				running = np.flatnonzero(self.calendar.isRunning(self.routeServices, serviceDay) & (self.routeLastTimes >= daysBefore * 86400))
+				routeInstances[daysBefore, running] = numInstances + np.arange(len(running))
+				routes.append(running)
+				shifts.append(np.full(len(running), daysBefore * 86400, dtype = np.int64))
+				numInstances += len(running)
+
+			empty = np.zeros(0, dtype = np.int64)
+			instances = [np.concatenate(routes) if routes else empty, np.concatenate(shifts) if shifts else empty, routeInstances]
+			self.instancesCache[day] = instances
+		return instances
+
+	def getTrips(self, columns, counts, labels):
+		# Earliest trip of the first counts of every column leaving at or after labels, as its index in the column (counts if none does)
+		# One binary search of every column at once, each in its own trips, which is far faster than searching one array of them all
+		start = self.columnTimeStarts[columns]
+		low = start
+		high = start + counts
+		searching = low < high
+		while searching.any():
+			middle = (low + high) // 2
+			later = searching & (self.departures[np.where(searching, middle, 0)] < labels)
+			low = np.where(later, middle + 1, low)
+			high = np.where(searching & ~later, middle, high)
+			searching = low < high
+		return low - start
+
+	def getTargetBest(self, search, target):
+		return INFINITY if target == None else search.best[target]
+
+	def scanRoutes(self, search, round, marked, instances, target):
+		# Rides one more bus from the stops marked in the round before, returns [stops it reached earlier than other buses, stops it
+		# reached earlier]
+		instanceRoutes, instanceShifts, routeInstances = instances
+		if not len(instanceRoutes):
+			return [np.zeros(0, dtype = np.int64)] * 2
+		isMarked = np.zeros(self.numStops, dtype = bool)
+		isMarked[marked] = True
+
+		# Every running route is scanned from its first marked stop, but the last (no bus leaves it)
+		# A stop that wasn't marked has the label it had when its routes were scanned before, so whatever a trip caught there reaches,
+		# the rounds before reached as early
+		columnMarked = isMarked[self.columnStops]
+		columnMarked[self.routeStopStarts[1:] - 1] = False
+		routeFirst = np.minimum.reduceat(np.where(columnMarked, self.columnPositions, self.maxLength), self.routeStopStarts[:-1])
+		first = routeFirst[instanceRoutes]
+		scanned = np.flatnonzero(first < self.maxLength)
+		if not len(scanned):
+			return [np.zeros(0, dtype = np.int64)] * 2
+		routes = instanceRoutes[scanned]
+		first = first[scanned]
+		lengths = self.routeLengths[routes] - first
+		segments = np.repeat(np.arange(len(scanned)), lengths)
+		segmentStarts = np.cumsum(lengths) - lengths
+		elements = np.arange(len(segments))
+		positions = first[segments] + elements - segmentStarts[segments]
+		columns = self.routeStopStarts[routes][segments] + positions
+		stops = self.columnStops[columns]
+		shifts = instanceShifts[scanned][segments]
+		labels = search.board[stops] + shifts
+		catchable = (columnMarked[columns] & (labels <= self.columnLastDepartures[columns])
+			& (labels < self.getTargetBest(search, target) + shifts))
+
+		# Earliest trip caught at the first marked stop of every route it can be caught at, the stops after only need a search when
+		# they can catch an earlier trip than that, trips are kept as trip * maxLength + position
+		none = self.maxTrips * self.maxLength
+		caught = np.full(len(segments), none, dtype = np.int64)
+		firstCaught = np.minimum.reduceat(np.where(catchable, elements, len(elements)), segmentStarts)
+		searched = firstCaught[firstCaught < len(elements)]
+		caught[searched] = (self.getTrips(columns[searched], self.routeNumTrips[routes[segments[searched]]], labels[searched]) * self.maxLength
+			+ positions[searched])
+		others = np.flatnonzero(catchable)
+		others = others[others != firstCaught[segments[others]]]
+		firstTrips = caught[firstCaught[segments[others]]] // self.maxLength
+		earlier = labels[others] <= self.departures[self.columnTimeStarts[columns[others]] + firstTrips]
+		others = others[earlier]
+		caught[others] = self.getTrips(columns[others], firstTrips[earlier], labels[others]) * self.maxLength + positions[others]
+
+		# Trip ridden at every column, the earliest caught before it on the route, a running minimum that restarts at every route
+		# because the routes after are offset below the ones before
+		offset = (len(scanned) - segments) * (none + 1)
+		ridden = np.empty(len(caught), dtype = np.int64)
+		ridden[1:] = (np.minimum.accumulate(caught + offset) - offset)[:-1]
+		ridden[segmentStarts] = none
+		on = np.flatnonzero(ridden < none)
+		trips = ridden[on] // self.maxLength
+		arrivals = self.arrivals[self.columnTimeStarts[columns[on]] + trips] - shifts[on]
+
+		# Buses are compared with the other buses, a stop reached earlier walking is still walked on from when a bus gets there
+		better = arrivals < np.minimum(search.bestBus[stops[on]], self.getTargetBest(search, target))
+		on = on[better]
+		trips = trips[better]
+		arrivals = arrivals[better]
+		earliest = keepEarliest(stops[on], arrivals, self.numStops)
+		on = on[earliest]
+		arrivals = arrivals[earliest]
+		busImproved = stops[on]
+		search.busArrivals[round, busImproved] = arrivals
+		search.bestBus[busImproved] = arrivals
+		search.parentRoutes[round, busImproved] = routes[segments[on]]
+		search.parentFroms[round, busImproved] = ridden[on] % self.maxLength
+		search.parentTrips[round, busImproved] = trips[earliest]
+		search.parentShifts[round, busImproved] = shifts[on]
+
+		# The round's label is the bus when it's earlier than the walk there
+		earlier = arrivals < search.arrivals[round, busImproved]
+		search.arrivals[round, busImproved[earlier]] = arrivals[earlier]
+		search.walkFroms[round, busImproved[earlier]] = -1
+		improved = arrivals < search.best[busImproved]
+		search.best[busImproved[improved]] = arrivals[improved]
+		return [busImproved, busImproved[improved]]
+
+	def walk(self, search, round, fromStops, target):
+		# Walks from fromStops to the stops near when their bus arrives, returns the stops reached earlier
+		starts = self.transferStarts[fromStops]
+		counts = self.transferStarts[fromStops + 1] - starts
+		pairs = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())
+		pairFroms = np.repeat(fromStops, counts)
+		toStops = self.transferStops[pairs]
+		arrivals = search.busArrivals[round, pairFroms] + self.transferTimes[pairs]
+
+		better = arrivals < np.minimum(search.best[toStops], self.getTargetBest(search, target))
+		earliest = np.flatnonzero(better)[keepEarliest(toStops[better], arrivals[better], self.numStops)]
+		improved = toStops[earliest]
+		search.arrivals[round, improved] = arrivals[earliest]
+		search.best[improved] = arrivals[earliest]
+		search.walkFroms[round, improved] = pairFroms[earliest]
+		return improved
+
+	def run(self, search, origin, seconds, instances, numRounds, target):
+		# One RAPTOR search leaving origin at seconds, labels of earlier searches (of later departures) are kept, like rRAPTOR does
+		if(seconds >= search.best[origin]):
+			return
+		search.arrivals[0, origin] = seconds
+		search.busArrivals[0, origin] = seconds
+		search.best[origin] = seconds
+		search.bestBus[origin] = seconds
+		search.walkFroms[0, origin] = -1
+		search.parentRoutes[0, origin] = ORIGIN
+		marked = np.concatenate([[origin], self.walk(search, 0, np.array([origin]), target)])
+		search.board = search.arrivals[0].copy()
+
+		for round in range(1, numRounds + 1):
+			if not len(marked):
+				break
+			busImproved, improved = self.scanRoutes(search, round, marked, instances, target)
+			walked = self.walk(search, round, busImproved, target)
+			search.board = np.minimum(search.board, search.arrivals[round] + CHANGE_TIME)
+			marked = np.union1d(improved, walked)
+
+	def getJourney(self, search, round, target, departure):
+		# [departure, arrival, buses, legs] of the journey reaching target in round, legs are ["walk", from StopID, to StopID, departure,
+		# arrival] and ["bus", TripID, RouteID, from StopID, to StopID, departure, arrival]
+		stopIds = self.cache.stopIds
+		legs = []
+		stop = target
+		arrival = int(search.arrivals[round, target])
+		while True:
+			fromStop = int(search.walkFroms[round, stop])
+			if(fromStop >= 0):
+				legs.append(["walk", int(stopIds[fromStop]), int(stopIds[stop]), int(search.busArrivals[round, fromStop]),
+					int(search.arrivals[round, stop])])
+				stop = fromStop
+			route = int(search.parentRoutes[round, stop])
+			if(route == ORIGIN):
+				break
+
+			# The bus was caught with the earliest label of the rounds before at the stop it was caught at
+			column = self.routeStopStarts[route] + search.parentFroms[round, stop]
+			trip = int(search.parentTrips[round, stop])
+			boardStop = int(self.columnStops[column])
+			tripIndex = int(self.routeTrips[self.routeTripStarts[route] + trip])
+			leaving = int(self.departures[self.columnTimeStarts[column] + trip]) - int(search.parentShifts[round, stop])
+			legs.append(["bus", self.cache.tripIds[tripIndex], self.cache.routeIds[self.cache.tripRoute[tripIndex]], int(stopIds[boardStop]),
+				int(stopIds[stop]), leaving, int(search.busArrivals[round, stop])])
+			labels = search.arrivals[:round, boardStop] + CHANGE_TIME
+			labels[0] -= CHANGE_TIME
+			round = int(np.argmin(labels))
+			stop = boardStop
+
+		legs.reverse()
+		return [departure, arrival, sum(leg[0] == "bus" for leg in legs), legs]
+
+	def getStops(self, fromStopId, toStopId):
+		# Stop indices of both StopIDs, None when one isn't in the feed
+		return [self.stopIndex.get(fromStopId), self.stopIndex.get(toStopId)]
+
+	def earliestArrival(self, fromStopId, toStopId, day, seconds, maxBuses = MAX_ROUNDS):
+		#* Journey arriving the earliest at toStopId leaving fromStopId at seconds (local time) of day (a date), with up to maxBuses buses
+		#* Returns [departure, arrival, buses, legs] (see getJourney) or None when toStopId can't be reached, times are seconds since the
+		#* start of day, trips of the days before running past midnight included
+		origin, target = self.getStops(fromStopId, toStopId)
+		if(origin == None or target == None):
+			return None
+		search = Search(maxBuses, self.numStops)
+		self.run(search, origin, seconds, self.getInstances(day), maxBuses, target)
+		if(search.best[target] == INFINITY):
+			return None
+		round = int(np.argmin(search.arrivals[:, target]))
+		return self.getJourney(search, round, target, seconds)
+
+	def getDepartureTimes(self, origin, instances, start, end):
+		# Times from start to end at which leaving origin catches a bus there or at a stop walked to, latest first
+		instanceRoutes, instanceShifts, routeInstances = instances
+		sources = [[origin, 0]] + list(zip(self.transferStops[self.transferStarts[origin]:self.transferStarts[origin + 1]].tolist(),
+			self.transferTimes[self.transferStarts[origin]:self.transferStarts[origin + 1]].tolist()))
+		times = []
+		for stop, walkTime in sources:
+			for route, position in zip(self.stopRoutes[self.stopRouteStarts[stop]:self.stopRouteStarts[stop + 1]].tolist(),
+				self.stopRoutePositions[self.stopRouteStarts[stop]:self.stopRouteStarts[stop + 1]].tolist()):
+				if(position == self.routeLengths[route] - 1):
+					continue
+				column = self.routeStopStarts[route] + position
+				columnTimes = self.departures[self.columnTimeStarts[column]:self.columnTimeStarts[column] + self.routeNumTrips[route]]
+				for instance in routeInstances[:, route].tolist():
+					if(instance >= 0):
+						leaving = columnTimes - instanceShifts[instance] - walkTime
+						times.append(leaving[(leaving >= start) & (leaving <= end)])
+		return np.unique(np.concatenate(times))[::-1].tolist() if times else []
+
+	def profile(self, fromStopId, toStopId, day, start, end = None, maxBuses = MAX_ROUNDS):
+		#* Every journey from fromStopId to toStopId leaving from start to end (seconds, local time) of day (a date) that no other
+		#* leaves later, arrives earlier and takes fewer buses than, with up to maxBuses buses
+		#* Returns [departure, arrival, buses, legs] journeys (see getJourney) by departure
+		origin, target = self.getStops(fromStopId, toStopId)
+		if(origin == None or target == None):
+			return []
+		if(end == None):
+			end = start + PROFILE_WINDOW
+		instances = self.getInstances(day)
+
+		# Latest departure first, the labels of later departures bound the ones of earlier departures
+		search = Search(maxBuses, self.numStops)
+		journeys = []
+		for departure in self.getDepartureTimes(origin, instances, start, end):
+			before = search.arrivals[:, target].copy()
+			self.run(search, origin, departure, instances, maxBuses, target)
+			for round in np.flatnonzero(search.arrivals[:, target] < before).tolist():
+				journeys.append(self.getJourney(search, round, target, departure))
+
+		kept = [journey for journey in journeys if not any(other[0] >= journey[0] and other[1] <= journey[1] and other[2] <= journey[2]
+			and other[:3] != journey[:3] for other in journeys)]
+		return sorted(kept, key = lambda journey: (journey[0], journey[2]))
+
+def openJourneyPlanner(feedPath, cacheDir = CACHE_DIR):
+	#* Opens the journey planner of the feed at feedPath, building it (and the feed's cache and stop index) if needed
+	cache = openFeedCache(feedPath, cacheDir)
+	calendar = openServiceCalendar(feedPath, cacheDir, cache)
+	plannerPath = os.path.join(cache.path, f"journeyPlanner{PLANNER_VERSION}")
+	if not os.path.exists(plannerPath):
+		index = openStopIndex(feedPath, cacheDir)
+		print("Building timetable of the journey planner")
+		buildPlanner(cache, index, plannerPath)
+
+	return JourneyPlanner(plannerPath, cache, calendar)
+
+def getArrivalByScan(planner, fromStopId, toStopId, day, seconds):
+	# Earliest arrival at toStopId as JourneyPlanner.earliestArrival finds it with unlimited buses, by a plain connection scan
+	cache = planner.cache
+	origin, target = planner.getStops(fromStopId, toStopId)
+	offsets = np.asarray(cache.tripOffsets)
+	arrivals, departures, routable = getTimes(cache)
+	tripOfRow = np.repeat(np.arange(len(cache.tripIds)), np.diff(offsets))
+	rows = np.flatnonzero((np.arange(len(tripOfRow)) + 1 < offsets[tripOfRow + 1]) & routable[tripOfRow])
+
+	# Connections between consecutive stops of the trips running, by departure
+	connections = []
+	for daysBefore in range(planner.serviceDays):
+		running = rows[planner.calendar.isTripRunning(tripOfRow[rows], day - timedelta(days = daysBefore))]
+		connections.append(np.stack([departures[running] - daysBefore * 86400, arrivals[running + 1] - daysBefore * 86400,
+			tripOfRow[running] + daysBefore * len(cache.tripIds), np.asarray(cache.stopTimeStop)[running],
+			np.asarray(cache.stopTimeStop)[running + 1]], axis = 1))
+	connections = np.concatenate(connections) if connections else np.zeros((0, 5), dtype = np.int64)
+	connections = connections[np.argsort(connections[:, 0], kind = "stable")]
+
+	arrival = {origin: seconds}
+	board = {origin: seconds}
+	for stop, walkTime in zip(planner.transferStops[planner.transferStarts[origin]:planner.transferStarts[origin + 1]].tolist(),
+		planner.transferTimes[planner.transferStarts[origin]:planner.transferStarts[origin + 1]].tolist()):
+		arrival[stop] = min(arrival.get(stop, INFINITY), seconds + walkTime)
+		board[stop] = arrival[stop]
+
+	# Walks are from the earliest bus at a stop, like the planner's
+	reached = set()
+	busArrival = {origin: seconds}
+	first = int(np.searchsorted(connections[:, 0], seconds))
+	for leaving, arriving, trip, fromStop, toStop in connections[first:].tolist():
+		if(leaving >= arrival.get(target, INFINITY)):
+			break
+		if(trip not in reached and board.get(fromStop, INFINITY) > leaving):
+			continue
+		reached.add(trip)
+		if(arriving >= busArrival.get(toStop, INFINITY)):
+			continue
+		busArrival[toStop] = arriving
+		arrival[toStop] = min(arrival.get(toStop, INFINITY), arriving)
+		board[toStop] = min(board.get(toStop, INFINITY), arriving + CHANGE_TIME)
+		for stop, walkTime in zip(planner.transferStops[planner.transferStarts[toStop]:planner.transferStarts[toStop + 1]].tolist(),
+			planner.transferTimes[planner.transferStarts[toStop]:planner.transferStarts[toStop + 1]].tolist()):
+			if(arriving + walkTime < arrival.get(stop, INFINITY)):
+				arrival[stop] = arriving + walkTime
+				board[stop] = min(board.get(stop, INFINITY), arriving + walkTime + CHANGE_TIME)
+	return arrival.get(target)
+
+def main():
+	if(len(sys.argv) not in [2, 3]):
+		print("Usage: python journeyPlanner.py <feed.zip> [queries]")
+		sys.exit(2)
+	numQueries = int(sys.argv[2]) if len(sys.argv) == 3 else 200
+
+	start = time.perf_counter()
+	planner = openJourneyPlanner(sys.argv[1])
+	print(f"Opened in {time.perf_counter() - start:.2f} s -> {planner.numRoutes} routes, {len(planner.departures)} stop times, "
+		f"{len(planner.transferStops)} transfers")
+	running = np.flatnonzero(planner.calendar.dayBits.any(axis = 1))
+	if not len(running):
+		print("The feed has no calendar")
+		return
+
+	# Random stops with buses, at random times of the day of random days the feed covers
+	rand = np.random.default_rng(0)
+	stops = np.flatnonzero(np.diff(planner.stopRouteStarts) > 0)
+	stopIds = np.asarray(planner.cache.stopIds)[rand.choice(stops, (numQueries, 2))].tolist()
+	days = [planner.calendar.getDate(int(day)) for day in rand.choice(running, numQueries)]
+	seconds = rand.integers(6 * 3600, 21 * 3600, numQueries).tolist()
+	for day in set(days):
+		planner.getInstances(day)
+
+	for name, query in [["Earliest arrival", lambda index: planner.earliestArrival(*stopIds[index], days[index], seconds[index])],
+		["Profile of an hour", lambda index: planner.profile(*stopIds[index], days[index], seconds[index])]]:
+		times = []
+		results = []
+		for index in range(numQueries):
+			start = time.perf_counter()
+			results.append(query(index))
+			times.append(time.perf_counter() - start)
+		found = [result for result in results if result]
+		times = sorted(times)
+		percentiles = ", ".join(f"p{percent} {times[min(len(times) - 1, len(times) * percent // 100)] * 1000:.1f} ms" for percent in [50, 90, 99])
+		print(f"{name} -> {numQueries / sum(times):.1f} queries/s, {percentiles}, {len(found)} of {numQueries} found")
+		if(name == "Earliest arrival"):
+			arrivals = results
+
+	# The first queries again, by a connection scan of the whole day
+	numChecked = min(numQueries, 20)
+	wrong = 0
+	for index in range(numChecked):
+		journey = planner.earliestArrival(*stopIds[index], days[index], seconds[index], 20)
+		if((journey[1] if journey else None) != getArrivalByScan(planner, *stopIds[index], days[index], seconds[index])):
+			wrong += 1
+	print(f"{numChecked - wrong} of {numChecked} earliest arrivals (with any number of buses) equal to a connection scan")
+	print(f"Mean buses of the journeys found -> {np.mean([journey[2] for journey in arrivals if journey] or [0]):.2f}")
+
+if(__name__ == "__main__"):
+	main()
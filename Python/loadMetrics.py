@@ -0,0 +1,148 @@
+import cProfile
+import contextlib
+import json
+import os
+import resource
+import time
+
+from dbConnection import METRICS
+
+#* Timings of the phases of a load (download, parsing, each set* and its DB writes)
+#* Every phase records its wall time, rows processed, DB statements and commits issued, and the peak RSS of the process so far
+#* At the end of a run they are written as a JSON summary and as a Prometheus textfile collector file
+
+METRICS_PREFIX = "smartpath_load"
+
+# Finished phases of this process, workers forked from the main process report their own
+PHASES = []
+openPhases = []
+
+# Phase run under cProfile, and where its stats go
+profiledPhase = None
+profilePath = None
+
+def getPeakRss():
+	# ru_maxrss is in KiB on Linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def setProfiledPhase(name, path):
+	global profiledPhase, profilePath
+	profiledPhase = name
+	profilePath = path
+
+@contextlib.contextmanager
+def phase(name):
+	#* with phase(name): ... records everything done inside, phases can be nested
+	record = {"phase": name, "rows": 0, "pid": os.getpid()}
+	statements = METRICS["statements"]
+	commits = METRICS["commits"]
+	profiler = cProfile.Profile() if name == profiledPhase else None
+
+	openPhases.append(record)
+	start = time.perf_counter()
+	if(profiler != None):
+		profiler.enable()
+	try:
+		yield record
+	finally:
+		if(profiler != None):
+			profiler.disable()
+			try:
+				profiler.dump_stats(profilePath)
+				print(f"Profile of phase {name} written to {profilePath}")
+			except OSError as error:
+				print(f"Error while writing the profile of phase {name} -> '{error}'")
+
+		record["seconds"] = time.perf_counter() - start
+		record["rowsPerSecond"] = record["rows"] / record["seconds"] if record["seconds"] > 0 else 0.0
+		record["statements"] = METRICS["statements"] - statements
+		record["commits"] = METRICS["commits"] - commits
+		record["peakRssBytes"] = getPeakRss()
+		openPhases.pop()
+		PHASES.append(record)
+
+def addRows(count):
+	# Rows processed by the innermost open phase
+	if openPhases:
+		openPhases[-1]["rows"] += count
+
+def resetPhases():
+	PHASES.clear()
+	openPhases.clear()
+
+def mergePhases(phases):
+	# Adds the phases of a worker to the ones of this process
+	PHASES.extend(phases)
+
+def getSummary(success):
+	# Workers are children of this process, their peak RSS is in RUSAGE_CHILDREN
+	childrenRss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024
+	return {
+		"timestamp": time.time(),
+		"success": success,
+		"peakRssBytes": max(getPeakRss(), childrenRss),
+		"db": dict(METRICS),
+		"phases": PHASES,
+	}
+
+def escapeLabel(value):
+	return value.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+def toPrometheus(summary):
+	lines = []
+
+	def addMetric(name, description, samples):
+		lines.append(f"# HELP {METRICS_PREFIX}_{name} {description}")
+		lines.append(f"# TYPE {METRICS_PREFIX}_{name} gauge")
+		for labels, value in samples:
+			labelText = ",".join(f"{key}=\"{escapeLabel(str(labelValue))}\"" for key, labelValue in labels.items())
+			lines.append(f"{METRICS_PREFIX}_{name}{{{labelText}}} {value}" if labelText else f"{METRICS_PREFIX}_{name} {value}")
+
+	addMetric("last_run_timestamp_seconds", "Time the last load finished", [[{}, f"{summary['timestamp']:.3f}"]])
+	addMetric("success", "1 if every command of the last load succeeded", [[{}, int(summary["success"])]])
+	addMetric("peak_rss_bytes", "Peak RSS of the last load, its workers included", [[{}, summary["peakRssBytes"]]])
+	addMetric("db_events", "DB connections, retries, statements and commits of the last load", [[{"event": key}, value] for key, value in summary["db"].items()])
+
+	# The same phase can run more than once (like a table cleared twice), those runs are added up
+	totals = {}
+	for record in summary["phases"]:
+		total = totals.setdefault(record["phase"], {"seconds": 0.0, "rows": 0, "statements": 0, "commits": 0, "peakRssBytes": 0})
+		for key in ["seconds", "rows", "statements", "commits"]:
+			total[key] += record[key]
+		total["peakRssBytes"] = max(total["peakRssBytes"], record["peakRssBytes"])
+
+	phaseMetrics = [
+		["phase_seconds", "Wall time of each phase of the last load", "seconds"],
+		["phase_rows", "Rows processed by each phase of the last load", "rows"],
+		["phase_statements", "DB statements issued by each phase of the last load", "statements"],
+		["phase_commits", "DB commits issued by each phase of the last load", "commits"],
+		["phase_peak_rss_bytes", "Peak RSS of the process at the end of each phase of the last load", "peakRssBytes"],
+	]
+	for name, description, key in phaseMetrics:
+		addMetric(name, description, [[{"phase": phaseName}, total[key]] for phaseName, total in totals.items()])
+	addMetric("phase_rows_per_second", "Rows per second of each phase of the last load",
+		[[{"phase": phaseName}, total["rows"] / total["seconds"] if total["seconds"] > 0 else 0.0] for phaseName, total in totals.items()])
+
+	return "\n".join(lines) + "\n"
+
+def writeAtomically(path, text):
+	# The textfile collector may read the file at any time, it must never see half of it
+	tempPath = path + ".part"
+	with open(tempPath, 'w', encoding = "utf8") as file:
+		file.write(text)
+	os.replace(tempPath, path)
+
+def writeMetrics(metricsDir, success):
+	#* Writes loadMetrics.json and loadMetrics.prom to metricsDir, returns True on success
+	summary = getSummary(success)
+	try:
+		os.makedirs(metricsDir, exist_ok = True)
+		writeAtomically(os.path.join(metricsDir, "loadMetrics.json"), json.dumps(summary, indent = 1))
+		writeAtomically(os.path.join(metricsDir, "loadMetrics.prom"), toPrometheus(summary))
+	except OSError as error:
+		print(f"Error while writing load metrics -> '{error}'")
+		return False
+
+	for record in PHASES:
+		print(f"Phase {record['phase']} -> {record['seconds']:.2f} s, {record['rows']} rows ({record['rowsPerSecond']:.0f}/s), {record['statements']} statements, {record['commits']} commits")
+	return True
@@ -0,0 +1,306 @@
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from datetime import date, timedelta
+from feedCache import openFeedCache, CACHE_DIR, NO_TIME
+from routePatterns import getPatternID
+from segmentTimes import getDayType
+
+#* Next departures of every stop, per day type (the set of services running on a day, see segmentTimes.getDayType)
+#* Days running the same services share their departures, so each stop has one sorted array of departure times per day type
+#* and "next buses at this stop" is a binary search in it, plus the one of the day before for trips running past midnight
+#* The index is kept memory-mapped in the feed's cache directory, the loader materializes it in StopDepartures and ServiceDayTypes
+#* python nextDepartures.py <feed.zip> [queries] benchmarks it with random lookups
+
+INDEX_VERSION = 1
+NEXT_COUNT = 5		# Departures a lookup returns when not told
+
+#* Arrays of an index
+# dates (YYYYMMDD), dateDayTypes -> day type of every date the feed covers, -1 when nothing runs
+# keyOffsets -> departures of stop s (index in the cache's stopIds) on day type d are entries keyOffsets[k] to keyOffsets[k + 1], k = d * numStops + s
+# entryTimes, entryTrips, entryRows -> departures, seconds since the start of the service day, trip and row of the cache's stop times,
+# sorted by time
+# tripPatterns -> index in patternIds of the pattern of every trip, -1 for trips without stop times
+ARRAYS = ["dates", "dateDayTypes", "keyOffsets", "entryTimes", "entryTrips", "entryRows", "tripPatterns"]
+
+class NextDepartures:
+	#* Departures index of a feed, opened memory-mapped from indexPath, with the feed's cache for the ids
+	def __init__(self, indexPath, cache):
+		self.cache = cache
+		for name in ARRAYS:
+			# Plain arrays over the mapped files, slicing a memmap costs more than the search
+			setattr(self, name, np.asarray(np.load(os.path.join(indexPath, name + ".npy"), mmap_mode = "r")))
+
+		with open(os.path.join(indexPath, "index.json"), 'r', encoding = "utf8") as file:
+			meta = json.load(file)
+		self.dayTypes = meta["dayTypes"]
+		self.patternIds = meta["patternIds"]
+		self.serviceDays = meta["serviceDays"]	# Days a trip can run for, counting the one it starts
+
+		self.numStops = len(cache.stopIds)
+		self.stopIndex = {stopId: stop for stop, stopId in enumerate(cache.stopIds.tolist())}
+		self.dateIndex = dict(zip(self.dates.tolist(), self.dateDayTypes.tolist()))
+		self.serviceDaysCache = {}	# key = date, value = getServiceDays(date)
+
+		# Per trip columns, looked up once instead of once per departure
+		self.tripRoutes = [cache.routeIds[route] for route in cache.tripRoute.tolist()]
+		self.tripPatternIds = [self.patternIds[pattern] if pattern >= 0 else None for pattern in self.tripPatterns.tolist()]
+		self.stopTimeSequence = np.asarray(cache.stopTimeSequence)
+
+	def getDayType(self, serviceDate):
+		# DayType of a YYYYMMDD date, None when nothing runs or the feed doesn't cover it
+		dayType = self.dateIndex.get(serviceDate, -1)
+		return None if dayType < 0 else self.dayTypes[dayType]
+
+	def getServiceDays(self, day):
+		# [days before day, its ServiceDate, first key of its day type] of the service days with trips that can still be running on day
+		serviceDays = self.serviceDaysCache.get(day)
+		if(serviceDays == None):
+			serviceDays = []
+			for daysBefore in range(self.serviceDays):
+				serviceDay = day - timedelta(days = daysBefore)
+				serviceDate = serviceDay.year * 10000 + serviceDay.month * 100 + serviceDay.day
+				dayType = self.dateIndex.get(serviceDate, -1)
+				if(dayType >= 0):
+					serviceDays.append([daysBefore, serviceDate, dayType * self.numStops])
+			self.serviceDaysCache[day] = serviceDays
+		return serviceDays
+
+	def getRow(self, serviceDate, entry):
+		# [ServiceDate, DepartureTime, TripID, RouteID, PatternID, StopSequence] of an entry
+		trip = int(self.entryTrips[entry])
+		return [serviceDate, int(self.entryTimes[entry]), self.cache.tripIds[trip], self.tripRoutes[trip], self.tripPatternIds[trip],
+			int(self.stopTimeSequence[self.entryRows[entry]])]
+
+	def getNext(self, stopId, day, seconds, count = NEXT_COUNT):
+		#* Next count departures from stopId at seconds (local time) of day (a date), trips of the days before running past midnight included
+		#* Returns [ServiceDate, DepartureTime, TripID, RouteID, PatternID, StopSequence] rows ordered by time,
+		#* DepartureTime is seconds since the start of its ServiceDate (so it can go past 24:00)
+		stop = self.stopIndex.get(stopId)
+		if(stop == None):
+			return []
+
+		# Up to count departures of each service day, merged
+		found = []
+		for daysBefore, serviceDate, firstKey in self.getServiceDays(day):
+			start, end = self.keyOffsets[firstKey + stop:firstKey + stop + 2].tolist()
+			serviceSeconds = seconds + daysBefore * 86400
+			# Most days before have no trip still running at seconds
+			if(start == end or self.entryTimes[end - 1] < serviceSeconds):
+				continue
+			first = start + int(np.searchsorted(self.entryTimes[start:end], serviceSeconds))
+			last = min(first + count, end)
+			for entry, moment in zip(range(first, last), self.entryTimes[first:last].tolist()):
+				found.append([moment - daysBefore * 86400, serviceDate, entry])
+
+		found.sort(key = lambda departure: departure[0])
+		return [self.getRow(serviceDate, entry) for _, serviceDate, entry in found[:count]]
+
+def getDayTypes(cache):
+	# [dates (YYYYMMDD), services running on each], every day the feed covers, as ServiceModes has them
+	services = {}
+	for day, service, exceptionType in zip(cache.calendarDate.tolist(), cache.calendarService.tolist(), cache.calendarException.tolist()):
+		running = services.setdefault(day, [])
+		if(exceptionType == 1):
+			running.append(service)
+	if not services:
+		return [[], []]
+
+	dates = []
+	dateServices = []
+	day = date(min(services) // 10000, min(services) // 100 % 100, min(services) % 100)
+	while(day.year * 10000 + day.month * 100 + day.day <= max(services)):
+		index = day.year * 10000 + day.month * 100 + day.day
+		dates.append(index)
+		dateServices.append(services.get(index, []))
+		day += timedelta(days = 1)
+	return [dates, dateServices]
+
+def buildNextDepartures(cache, indexPath):
+	#* Builds the departures index of the feed cache in indexPath
+	numStops = len(cache.stopIds)
+	offsets = np.asarray(cache.tripOffsets)
+	tripOfRow = np.repeat(np.arange(len(cache.tripIds)), np.diff(offsets))
+
+	# Buses leave every stop of a trip but its last, at their departure time (or arrival, if that's all there is)
+	departures = np.asarray(cache.stopTimeDeparture)
+	times = np.where(departures != NO_TIME, departures, cache.stopTimeArrival)
+	leaving = times != NO_TIME
+	leaving[offsets[1:][offsets[1:] > offsets[:-1]] - 1] = False
+	rows = np.flatnonzero(leaving)
+	rowTrips = tripOfRow[rows]
+	rowStops = np.asarray(cache.stopTimeStop)[rows]
+	rowTimes = times[rows]
+
+	# Patterns as in BusPatterns
+	patternIds = []
+	patternIndex = {}
+	tripPatterns = np.full(len(cache.tripIds), -1, dtype = np.int32)
+	stopIds = np.asarray(cache.stopIds)
+	for trip, [start, end] in enumerate(zip(offsets[:-1].tolist(), offsets[1:].tolist())):
+		if(start == end):
+			continue
+		patternId = getPatternID(cache.routeIds[cache.tripRoute[trip]], int(cache.tripDirection[trip]), tuple(stopIds[cache.stopTimeStop[start:end]].tolist()))
+		if patternId not in patternIndex:
+			patternIndex[patternId] = len(patternIds)
+			patternIds.append(patternId)
+		tripPatterns[trip] = patternIndex[patternId]
+
+	# Day types, in order of first date
+	dates, dateServices = getDayTypes(cache)
+	dayTypes = []
+	dayTypeServices = []
+	dayTypeIndex = {}
+	dateDayTypes = []
+	for services in dateServices:
+		if not services:
+			dateDayTypes.append(-1)
+			continue
+		dayType = getDayType(",".join(cache.serviceIds[service] for service in services))
+		if dayType not in dayTypeIndex:
+			dayTypeIndex[dayType] = len(dayTypes)
+			dayTypes.append(dayType)
+			dayTypeServices.append(sorted(set(services)))
+		dateDayTypes.append(dayTypeIndex[dayType])
+
+	# Departures of the trips running on each day type, by stop and time
+	tripServices = np.asarray(cache.tripService)
+	keyCounts = []
+	entryTimes = []
+	entryTrips = []
+	entryRows = []
+	for dayType, services in enumerate(dayTypeServices):
+		running = np.isin(tripServices[rowTrips], services)
+		stops = rowStops[running]
+		order = np.lexsort((rowTrips[running], rowTimes[running], stops))
+		keyCounts.append(np.bincount(stops, minlength = numStops))
+		entryTimes.append(rowTimes[running][order])
+		entryTrips.append(rowTrips[running][order])
+		entryRows.append(rows[running][order])
+
+	keyCounts = np.concatenate(keyCounts) if keyCounts else np.zeros(0, dtype = np.int64)
+	arrays = {
+		"dates": np.array(dates, dtype = np.int32),
+		"dateDayTypes": np.array(dateDayTypes, dtype = np.int32),
+		"keyOffsets": np.concatenate([[0], np.cumsum(keyCounts)]).astype(np.int64),
+		"entryTimes": np.concatenate(entryTimes).astype(np.int32) if entryTimes else np.zeros(0, dtype = np.int32),
+		"entryTrips": np.concatenate(entryTrips).astype(np.int32) if entryTrips else np.zeros(0, dtype = np.int32),
+		"entryRows": np.concatenate(entryRows).astype(np.int32) if entryRows else np.zeros(0, dtype = np.int32),
+		"tripPatterns": tripPatterns,
+	}
+	serviceDays = int(rowTimes.max() // 86400) + 1 if len(rowTimes) else 1
+
+	# Written to a temporary directory first, so a crash never leaves a broken index
+	tempPath = indexPath.rstrip("/") + f".part{os.getpid()}"
+	shutil.rmtree(tempPath, ignore_errors = True)
+	os.makedirs(tempPath)
+	for name, array in arrays.items():
+		np.save(os.path.join(tempPath, name + ".npy"), array)
+	with open(os.path.join(tempPath, "index.json"), 'w', encoding = "utf8") as file:
+		json.dump({"version": INDEX_VERSION, "dayTypes": dayTypes, "patternIds": patternIds, "serviceDays": serviceDays}, file)
+
+	try:
+		os.rename(tempPath, indexPath)
+	except OSError:	# Someone else built it first
+		shutil.rmtree(tempPath, ignore_errors = True)
+
+def openNextDepartures(feedPath, cacheDir = CACHE_DIR):
+	#* Opens the departures index of the feed at feedPath, building it (and the feed's cache) if needed
+	cache = openFeedCache(feedPath, cacheDir)
+	indexPath = os.path.join(cache.path, f"nextDepartures{INDEX_VERSION}")
+	if not os.path.exists(indexPath):
+		print("Building index of the departures")
+		buildNextDepartures(cache, indexPath)
+
+	return NextDepartures(indexPath, cache)
+
+#* Row builders of the loader (see setCarrisData.py)
+
+def getServiceDayTypesRows(departures):
+	return [[serviceDate, departures.dayTypes[dayType]] for serviceDate, dayType in zip(departures.dates.tolist(), departures.dateDayTypes.tolist())
+		if dayType >= 0]
+
+def getStopDeparturesChunks(departures, chunkSize = 10000):
+	#* Yields the rows of StopDepartures in chunks, by StopID and DayType, so InnoDB fills its primary key in order
+	cache = departures.cache
+	stopIds = cache.stopIds.tolist()
+	stopOrder = np.argsort(np.asarray(cache.stopIds), kind = "stable")
+	dayTypeOrder = np.argsort(np.array(departures.dayTypes, dtype = str), kind = "stable")
+	keys = (dayTypeOrder[None, :] * departures.numStops + stopOrder[:, None]).ravel()
+
+	# Entries of the keys in that order
+	starts = departures.keyOffsets[keys]
+	counts = departures.keyOffsets[keys + 1] - starts
+	keyOfEntry = np.repeat(keys, counts)
+	entries = np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(len(keyOfEntry))
+
+	for start in range(0, len(entries), chunkSize):
+		end = min(start + chunkSize, len(entries))
+		chunk = entries[start:end]
+		columns = zip(keyOfEntry[start:end].tolist(), departures.entryTimes[chunk].tolist(), departures.entryTrips[chunk].tolist(),
+			departures.stopTimeSequence[departures.entryRows[chunk]].tolist())
+		yield [[stopIds[key % departures.numStops], departures.dayTypes[key // departures.numStops], seconds, cache.tripIds[trip], sequence,
+			departures.tripRoutes[trip], departures.tripPatternIds[trip]]
+			for key, seconds, trip, sequence in columns]
+
+def getNextByScan(cache, stopId, day, seconds, count = NEXT_COUNT):
+	# What NextDepartures.getNext returns, as [ServiceDate, DepartureTime, TripID], from the cache alone and slowly
+	offsets = np.asarray(cache.tripOffsets)
+	tripOfRow = np.repeat(np.arange(len(cache.tripIds)), np.diff(offsets))
+	departures = np.asarray(cache.stopTimeDeparture)
+	times = np.where(departures != NO_TIME, departures, cache.stopTimeArrival)
+	isLast = np.zeros(len(times), dtype = bool)
+	isLast[offsets[1:][offsets[1:] > offsets[:-1]] - 1] = True
+
+	found = []
+	for daysBefore in range(int(times.max() // 86400) + 1):
+		serviceDay = day - timedelta(days = daysBefore)
+		serviceDate = serviceDay.year * 10000 + serviceDay.month * 100 + serviceDay.day
+		services = [service for calendarDate, service, exceptionType in zip(cache.calendarDate.tolist(), cache.calendarService.tolist(),
+			cache.calendarException.tolist()) if calendarDate == serviceDate and exceptionType == 1]
+		rows = np.flatnonzero((np.asarray(cache.stopIds)[cache.stopTimeStop] == stopId) & ~isLast & (times != NO_TIME)
+			& np.isin(np.asarray(cache.tripService)[tripOfRow], services) & (times >= seconds + daysBefore * 86400))
+		found += [[int(times[row]) - daysBefore * 86400, daysBefore, int(tripOfRow[row]), int(row), serviceDate] for row in rows]
+
+	found.sort()
+	return [[serviceDate, moment + daysBefore * 86400, cache.tripIds[trip]] for moment, daysBefore, trip, _, serviceDate in found[:count]]
+
+def main():
+	if(len(sys.argv) not in [2, 3]):
+		print("Usage: python nextDepartures.py <feed.zip> [queries]")
+		sys.exit(2)
+	numQueries = int(sys.argv[2]) if len(sys.argv) == 3 else 100000
+
+	start = time.perf_counter()
+	departures = openNextDepartures(sys.argv[1])
+	print(f"Opened in {time.perf_counter() - start:.2f} s -> {len(departures.dayTypes)} day types, {len(departures.entryTimes)} departures")
+	if not len(departures.dates):
+		print("The feed has no calendar")
+		return
+
+	# Random stops with departures, at random times of the days the feed covers
+	rand = np.random.default_rng(0)
+	stops = np.unique(np.asarray(departures.cache.stopTimeStop))
+	stopIds = np.asarray(departures.cache.stopIds)[rand.choice(stops, numQueries)].tolist()
+	days = [date(int(day) // 10000, int(day) // 100 % 100, int(day) % 100) for day in rand.choice(np.asarray(departures.dates), numQueries)]
+	seconds = rand.integers(0, 86400, numQueries).tolist()
+
+	start = time.perf_counter()
+	results = [departures.getNext(stopId, day, second) for stopId, day, second in zip(stopIds, days, seconds)]
+	elapsed = time.perf_counter() - start
+	print(f"{numQueries} lookups in {elapsed:.2f} s -> {elapsed / numQueries * 1e6:.1f} us per lookup, "
+		f"{sum(len(result) for result in results) / numQueries:.1f} departures each")
+
+	# The first lookups again, by scanning every stop time
+	numChecked = min(numQueries, 200)
+	wrong = sum(getNextByScan(departures.cache, stopId, day, second) != [row[:3] for row in result]
+		for stopId, day, second, result in list(zip(stopIds, days, seconds, results))[:numChecked])
+	print(f"{numChecked - wrong} of {numChecked} lookups equal to a scan of the stop times")
+
+if(__name__ == "__main__"):
+	main()
@@ -0,0 +1,281 @@
+import bisect
+import sys
+import time
+
+from mysql.connector import Error
+from dbConnection import DBConnection, runWithRetry, printMetrics, METRICS
+from dbWriter import batches, getUpsertQuery, safeRollback, BATCH_SIZE
+from gpsMatcher import toLocal, toDateTime, fromDateTime, JOB as MATCHER_JOB
+from tableSchemas import createTables
+from watermarks import getWatermark, readWatermark, setWatermark, WATERMARKS_TABLE
+
+#* Occupancy rollups of the Openings and Passengers event logs the UPLYs fill, so the app's capacity views are point reads
+#* VehicleOccupancy has the last capacity every bus reported, RouteOccupancy the capacity, boardings and journeys of each route
+#* in BUCKET_TIME buckets of local time, the route of an event is the one of the bus' last stop visit (see gpsMatcher.py)
+#* Both logs are read past their own watermark in chunks, each chunk's rollups and watermark are written in one transaction
+#* An event waits (and the ones after it) until the matcher has gone past it on its bus' GPS, or MAX_ROUTE_AGE past it on every bus
+#* Route buckets are added to in the DB (INSERT ... ON DUPLICATE KEY UPDATE x = x + VALUES(x)), so they are never read back
+#* python occupancyRollups.py [options] runs the job, --prune-days <days> then deletes the events rolled up before that
+
+CHUNK_SIZE = 5000		# Events rolled up and written together
+BUCKET_TIME = 900		# Seconds of each RouteOccupancy bucket
+MAX_ROUTE_AGE = 900		# Seconds after a stop visit an event is still on its route
+PRUNE_BATCH = 10000		# Events deleted per statement, so locks are short
+
+OCCUPANCY_TABLES = [WATERMARKS_TABLE, "VehicleOccupancy", "RouteOccupancy"]
+VEHICLE_COLUMNS = ["UPLYID", "RouteID", "Direction", "TripID", "Capacity", "OpeningTime", "Latitude", "Longitude", "LastOpeningID"]
+ROUTE_KEY = ["RouteID", "Direction", "BucketStart"]
+ROUTE_COUNTERS = ["Openings", "CapacitySum", "Boardings", "Alightings", "Journeys"]
+
+# key = event log, value = [job, query of the events past the watermark]
+EVENT_LOGS = {
+	"Openings": ["occupancyOpenings", "SELECT ID, UPLYID, Date, OpeningUTCTime, Capacity, DiffPeople, Latitude, Longitude FROM Openings "
+		"WHERE ID > %s ORDER BY ID LIMIT %s"],
+	"Passengers": ["occupancyPassengers", "SELECT ID, UPLYID, Date, EntryTime FROM Passengers WHERE ID > %s ORDER BY ID LIMIT %s"],
+}
+
+def getRouteUpsertQuery():
+	# Counters are added to the bucket's, MaxCapacity is the highest of both
+	placeholders = ", ".join(["%s"] * (len(ROUTE_KEY) + len(ROUTE_COUNTERS) + 1))
+	assignments = ", ".join(f"{column} = {column} + VALUES({column})" for column in ROUTE_COUNTERS)
+	return (f"INSERT INTO RouteOccupancy ({', '.join(ROUTE_KEY + ROUTE_COUNTERS)}, MaxCapacity) VALUES ({placeholders}) "
+		f"ON DUPLICATE KEY UPDATE {assignments}, MaxCapacity = GREATEST(MaxCapacity, VALUES(MaxCapacity))")
+
+def fetchRows(conn, query, params, description):
+	def fetch():
+		cursor = conn.cursor()
+		cursor.execute(query, params)
+		METRICS["statements"] += 1
+		rows = cursor.fetchall()
+		cursor.close()
+		return rows
+
+	return runWithRetry(conn, fetch, description)
+
+def getRoutes(conn, events):
+	#* events are [UPLYID, local seconds], returns the [RouteID, Direction, TripID] each one was on, or None
+	if not events:
+		return []
+
+	# Stop visits of the buses around the events, in one query per batch of buses
+	first = toDateTime(min(seconds for _, seconds in events) - MAX_ROUTE_AGE)
+	last = toDateTime(max(seconds for _, seconds in events))
+	visits = {}	# key = UPLYID, value = [visit times, [RouteID, Direction, TripID] of each]
+	for batch in batches(list(dict.fromkeys(uplyId for uplyId, _ in events))):
+		query = ("SELECT UPLYID, VisitTime, RouteID, Direction, TripID FROM StopVisits "
+			f"WHERE UPLYID IN ({', '.join(['%s'] * len(batch))}) AND VisitTime BETWEEN %s AND %s ORDER BY UPLYID, VisitTime")
+		for uplyId, visitTime, route, direction, trip in fetchRows(conn, query, batch + [first, last], "reading StopVisits"):
+			busVisits = visits.setdefault(uplyId, [[], []])
+			busVisits[0].append(fromDateTime(visitTime))
+			busVisits[1].append([route, bool(direction), trip])
+
+	routes = []
+	for uplyId, seconds in events:
+		busVisits = visits.get(uplyId)
+		visit = bisect.bisect_right(busVisits[0], seconds) - 1 if busVisits else -1
+		if(visit >= 0 and seconds - busVisits[0][visit] <= MAX_ROUTE_AGE):
+			routes.append(busVisits[1][visit])
+		else:
+			routes.append(None)
+	return routes
+
+def getBucket(buckets, route, seconds):
+	# Counters of the route's bucket holding seconds, ROUTE_COUNTERS and then MaxCapacity
+	key = (route[0], route[1], toDateTime(seconds - seconds % BUCKET_TIME))
+	return buckets.setdefault(key, [0] * len(ROUTE_COUNTERS) + [0])
+
+def rollUpOpenings(conn, rows):
+	#* Returns [VehicleOccupancy rows, RouteOccupancy buckets] of rows of Openings
+	events = [row for row in rows if None not in row[1:5]]
+	times = [toLocal(row[2], row[3]) for row in events]
+	routes = getRoutes(conn, [[row[1], seconds] for row, seconds in zip(events, times)])
+
+	vehicles = {}	# key = UPLYID, the last opening of each bus is kept
+	buckets = {}
+	for [openingId, uplyId, _, _, capacity, diffPeople, latitude, longitude], seconds, route in zip(events, times, routes):
+		vehicles[uplyId] = [uplyId] + (route or [None, None, None]) + [capacity, toDateTime(seconds),
+			None if latitude == None else float(latitude), None if longitude == None else float(longitude), openingId]
+		if(route == None):
+			continue
+
+		# Boardings and alightings from the net change in people of each opening
+		bucket = getBucket(buckets, route, seconds)
+		bucket[0] += 1
+		bucket[1] += capacity
+		bucket[2] += max(diffPeople or 0, 0)
+		bucket[3] += max(-(diffPeople or 0), 0)
+		bucket[5] = max(bucket[5], capacity)
+
+	return [list(vehicles.values()), buckets]
+
+def rollUpPassengers(conn, rows):
+	#* Returns [no VehicleOccupancy rows, RouteOccupancy buckets] of rows of Passengers, journeys count where they started
+	events = [row for row in rows if None not in row[1:4]]
+	times = [toLocal(row[2], row[3]) for row in events]
+	routes = getRoutes(conn, [[row[1], seconds] for row, seconds in zip(events, times)])
+
+	buckets = {}
+	for seconds, route in zip(times, routes):
+		if(route != None):
+			getBucket(buckets, route, seconds)[4] += 1
+	return [[], buckets]
+
+def writeChunk(conn, job, vehicleRows, buckets, lastId, batchSize = BATCH_SIZE):
+	# A retry runs the whole transaction again
+	#? Unless the connection dropped during COMMIT and the server committed anyway, route buckets would be added to twice,
+	#? so after a COMMIT that didn't answer the watermark is read first and the chunk is skipped if it already got there
+	routeRows = [list(key) + counters for key, counters in buckets.items()]
+	committing = [False]	# Set while the COMMIT hasn't answered
+
+	def write():
+		cursor = conn.cursor()
+		if committing[0]:
+			committing[0] = False
+			if(readWatermark(cursor, job) >= lastId):
+				print(f"Rollups of {job} up to row {lastId} were committed, not writing them again")
+				cursor.close()
+				return
+		for query, rows in [[getUpsertQuery("VehicleOccupancy", VEHICLE_COLUMNS), vehicleRows], [getRouteUpsertQuery(), routeRows]]:
+			for batch in batches(rows, batchSize):
+				cursor.executemany(query, batch)
+				METRICS["statements"] += 1
+		setWatermark(cursor, job, lastId)
+		committing[0] = True
+		conn.commit()
+		committing[0] = False
+		METRICS["commits"] += 1
+		cursor.close()
+
+	runWithRetry(conn, write, f"writing rollups of {job} up to row {lastId}")
+
+def getMatcherHorizon(conn):
+	# Local seconds of the last GPS fix the matcher got to, None if it never ran
+	rows = fetchRows(conn, "SELECT Date, UTCTime FROM GPS WHERE ID = %s", (getWatermark(conn, MATCHER_JOB),), "reading GPS")
+	return toLocal(rows[0][0], rows[0][1]) if rows else None
+
+def getBusHorizons(conn, uplyIds):
+	#* Local seconds of the last GPS fix the matcher got to of each bus, key = UPLYID, buses it never saw aren't there
+	horizons = {}
+	for batch in batches(list(uplyIds)):
+		query = ("SELECT VehicleTrips.UPLYID, GPS.Date, GPS.UTCTime FROM VehicleTrips JOIN GPS ON GPS.ID = VehicleTrips.LastGPSID "
+			f"WHERE VehicleTrips.UPLYID IN ({', '.join(['%s'] * len(batch))})")
+		for uplyId, day, utcTime in fetchRows(conn, query, batch, "reading VehicleTrips"):
+			horizons[uplyId] = toLocal(day, utcTime)
+	return horizons
+
+def getMatchedRows(conn, rows, matcherHorizon):
+	#* Returns [the first rows of rows (events ordered by ID) the matcher has found the routes of, whether any were left out]
+	#? A bus the matcher hasn't got to yet may still have visits before its event, the event waits for them
+	#? A bus that went quiet (or never sent GPS) would hold its events forever, they go once the matcher is MAX_ROUTE_AGE past them
+	busHorizons = getBusHorizons(conn, {row[1] for row in rows if row[1] != None})
+	for index, row in enumerate(rows):
+		if(row[2] == None or row[3] == None):
+			continue
+		seconds = toLocal(row[2], row[3])
+		if(seconds > busHorizons.get(row[1], seconds - 1) and seconds + MAX_ROUTE_AGE > matcherHorizon):
+			return [rows[:index], True]
+	return [rows, False]
+
+def rollUpLog(conn, tableName, chunkSize = CHUNK_SIZE, batchSize = BATCH_SIZE):
+	#* Rolls up the events of tableName (Openings or Passengers) past its watermark
+	#* Returns the number of events rolled up, or None in case of error
+	job, query = EVENT_LOGS[tableName]
+	numRows = 0
+	try:
+		watermark = getWatermark(conn, job)
+		horizon = getMatcherHorizon(conn)
+		if(horizon == None):
+			print(f"The GPS matcher hasn't run yet, table {tableName} is left for later")
+			return 0
+
+		while True:
+			# Keyset pagination, every chunk is a range scan of the primary key
+			rows = fetchRows(conn, query, (watermark, chunkSize), f"reading {tableName}")
+
+			# Events the matcher hasn't found the routes of are left for the next run, with the watermark before them
+			rows, caughtUp = getMatchedRows(conn, rows, horizon)
+			if not rows:
+				break
+			if(tableName == "Openings"):
+				vehicleRows, buckets = rollUpOpenings(conn, rows)
+			else:
+				vehicleRows, buckets = rollUpPassengers(conn, rows)
+			watermark = rows[-1][0]
+			writeChunk(conn, job, vehicleRows, buckets, watermark, batchSize)
+			numRows += len(rows)
+			if caughtUp:
+				break
+	except Error as error:
+		safeRollback(conn)
+		print(f"Error while rolling up table {tableName}, {numRows} rows were rolled up -> '{error}'")
+		return None
+
+	print(f"Table {tableName} rolled up -> {numRows} rows")
+	return numRows
+
+def pruneLog(conn, tableName, days):
+	#* Deletes the events of tableName already rolled up that are older than days, returns True on success
+	job = EVENT_LOGS[tableName][0]
+	query = f"DELETE FROM {tableName} WHERE ID <= %s AND Date < CURDATE() - INTERVAL %s DAY LIMIT {PRUNE_BATCH}"
+	deleted = 0
+
+	def prune():
+		cursor = conn.cursor()
+		cursor.execute(query, (watermark, days))
+		count = cursor.rowcount
+		conn.commit()
+		METRICS["statements"] += 1
+		METRICS["commits"] += 1
+		cursor.close()
+		return count
+
+	try:
+		watermark = getWatermark(conn, job)
+		while True:
+			count = runWithRetry(conn, prune, f"pruning table {tableName}")
+			deleted += count
+			if(count < PRUNE_BATCH):
+				break
+	except Error as error:
+		safeRollback(conn)
+		print(f"Error while pruning table {tableName}, {deleted} rows were deleted -> '{error}'")
+		return False
+
+	print(f"Table {tableName} pruned -> {deleted} rows deleted")
+	return True
+
+def main():
+	args = sys.argv[1:]
+	options = {"--chunk-size": CHUNK_SIZE, "--batch-size": BATCH_SIZE, "--prune-days": 0}
+	try:
+		if(len(args) % 2 != 0 or any(arg not in options for arg in args[::2])):
+			raise ValueError
+		for arg, value in zip(args[::2], args[1::2]):
+			options[arg] = type(options[arg])(value)
+		if(options["--chunk-size"] < 1 or options["--batch-size"] < 1):
+			raise ValueError
+	except ValueError:
+		print("Usage: python occupancyRollups.py [--chunk-size <rows>] [--batch-size <rows>] [--prune-days <days>]")
+		print("--prune-days deletes the rows of Openings and Passengers already rolled up and older than that, default 0 keeps them")
+		sys.exit(2)
+
+	conn = DBConnection()
+	if(conn == None):
+		sys.exit(1)
+
+	try:
+		if not createTables(conn, OCCUPANCY_TABLES):
+			return
+		for tableName in EVENT_LOGS:
+			start = time.perf_counter()
+			if(rollUpLog(conn, tableName, options["--chunk-size"], options["--batch-size"]) == None):
+				return
+			print(f"Rolled up in {time.perf_counter() - start:.2f} s")
+			if options["--prune-days"]:
+				pruneLog(conn, tableName, options["--prune-days"])
+	finally:
+		conn.close()
+		printMetrics()
+
+if(__name__ == "__main__"):
+	main()
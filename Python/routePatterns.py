@@ -0,0 +1,59 @@
+import hashlib
+import json
+
+#* Route patterns, every distinct sequence of stops of a route in one direction
+#* Trips with the same stops share their pattern, which is stored once in BusPatterns and referenced from BusTrips
+#* A pattern's ID is a hash of its route, direction and stops, so the same pattern keeps its ID from feed to feed
+#* Rows of BusRoutes and BusTrips carry a fingerprint of their values the same way, so a table can be verified by its fingerprints alone
+
+def getPatternID(route, direction, stops):
+	text = f"{route}|{direction}|{','.join(str(stop) for stop in stops)}"
+	return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+def getFingerprint(values):
+	# Hash of the values of a row, the same values give the same fingerprint from feed to feed
+	text = "|".join(str(value) for value in values)
+	return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+def buildRouteRows(routes, tripsRows, tripStops, startingTimes):
+	#* routes is the list of RouteIDs in routes.txt order, only their trips are kept
+	#* tripsRows are [route_id, service_id, trip_id, direction_id] rows of trips.txt, in file order
+	#* tripStops is {TripID: tuple of StopIDs ordered by stop_sequence}, startingTimes is {TripID: StartingTime}
+	#* Trips without stop times are left out
+	#* Returns [busRoutesRows, busTripsRows, busPatternsRows], rows of BusRoutes and BusTrips start with their key (RouteDirectionID,
+	#* FeedTripID) and end with their fingerprint
+	tripsByRoute = {}	# key = RouteID, value = list of [RouteService, TripID, Direction]
+	for route, service, trip, direction in tripsRows:
+		tripsByRoute.setdefault(route, []).append([service, trip, direction])
+
+	busRoutesRows = []
+	busTripsRows = []
+	busPatternsRows = []
+	for route in dict.fromkeys(routes):
+		# Patterns of the route in order of first trip, key = (Direction, stops), value = [PatternID, number of trips]
+		patterns = {}
+		for service, trip, direction in tripsByRoute.get(route, []):
+			stops = tripStops.get(trip)
+			if(stops == None):	# Trip without stop times
+				continue
+
+			pattern = patterns.get((direction, stops))
+			if(pattern == None):
+				pattern = [getPatternID(route, direction, stops), 0]
+				patterns[(direction, stops)] = pattern
+			pattern[1] += 1
+			tripRow = [trip, route, service, startingTimes[trip], pattern[0]]
+			busTripsRows.append(tripRow + [getFingerprint(tripRow)])
+
+		# The stops of each direction of the route are the ones of its most common pattern
+		mainPatterns = {}	# key = Direction, value = [stops, number of trips]
+		for (direction, stops), [patternID, numTrips] in patterns.items():
+			busPatternsRows.append([patternID, route, direction != 0, json.dumps(list(stops)), numTrips])
+			if(direction not in mainPatterns or numTrips > mainPatterns[direction][1]):
+				mainPatterns[direction] = [stops, numTrips]
+
+		for direction, [stops, _] in mainPatterns.items():
+			routeRow = [str(route) + str(direction), route, json.dumps(list(stops)), direction != 0]
+			busRoutesRows.append(routeRow + [getFingerprint(routeRow)])
+
+	return busRoutesRows, busTripsRows, busPatternsRows
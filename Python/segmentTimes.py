@@ -0,0 +1,261 @@
+import hashlib
+import json
+import math
+import sys
+import time
+
+import numpy as np
+
+from mysql.connector import Error
+from dbConnection import DBConnection, runWithRetry, printMetrics, METRICS
+from dbWriter import batches, getUpsertQuery, safeRollback, BATCH_SIZE
+from feedCache import openFeedCache, CACHE_DIR
+from gpsMatcher import toDateTime, fromDateTime, FEED_PATH
+from tableSchemas import createTables
+from watermarks import getWatermark, setWatermark, WATERMARKS_TABLE
+
+#* Historic travel times between consecutive stops of the trips, from the stop visits matched by gpsMatcher.py
+#* Every segment (a stop and the next one of a trip) has, per hour of the day and day type, the number of trips timed, their mean
+#* and percentiles, and a sketch of the times: a histogram with buckets RELATIVE_ACCURACY apart, whose percentiles are that close
+#* to the exact ones and which adds up from run to run, so each run only reads the visits written since the last one
+#* Visits are read in the order they were written (by GPSID), so the ones matched late (GPS replayed from a spill, buffered by the
+#* UPLY or caught up on by the matcher) are aggregated too, a segment counts once, with the later written of its two visits
+#* A day type is the set of services running that day (see ServiceModes), days running the same services share it
+#* python segmentTimes.py [options] runs the job
+
+JOB = "segmentTimes"
+RELATIVE_ACCURACY = 0.02
+LOG_GAMMA = math.log((1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY))
+SKETCH_DTYPE = np.dtype([("bucket", "<u2"), ("count", "<u4")])	# Non-empty buckets of a sketch, as stored in SegmentTimes.Sketch
+
+MAX_SEGMENT_TIME = 1800	# Seconds, longer ones are a bus out of service or a bad match
+SETTLE_TIME = 1800		# Seconds before the last visit that aren't aggregated yet, their matches can still change
+CHUNK_SIZE = 5000		# New visits aggregated and written together
+MAX_GPS_ID = 2 ** 32 - 1	# Watermarks above it are VisitTimes in seconds, as the job kept them before it went by GPSID
+
+SEGMENT_TABLES = [WATERMARKS_TABLE, "SegmentTimes"]
+SEGMENT_KEY = ["FromStopID", "ToStopID", "DayType", "Hour"]
+SEGMENT_COLUMNS = SEGMENT_KEY + ["NumTrips", "TotalSeconds", "MeanSeconds", "P50Seconds", "P90Seconds", "P95Seconds", "Sketch"]
+
+NEW_VISITS_QUERY = "SELECT GPSID, TripID, ServiceDate, VisitTime FROM StopVisits WHERE GPSID > %s ORDER BY GPSID LIMIT %s"
+
+def getDayType(services):
+	# services is the comma-joined string of ServiceModes.Services
+	text = ",".join(sorted(service for service in services.split(",") if service))
+	return hashlib.sha256(text.encode()).hexdigest()[:16]
+
+#* Sketches are {bucket: count}, a time t is in bucket ceil(log(t) / LOG_GAMMA)
+
+def addToSketch(sketch, seconds):
+	buckets = np.ceil(np.log(np.maximum(seconds, 1)) / LOG_GAMMA).astype(np.int64)
+	for bucket, count in zip(*np.unique(buckets, return_counts = True)):
+		sketch[int(bucket)] = sketch.get(int(bucket), 0) + int(count)
+
+def encodeSketch(sketch):
+	return np.array(sorted(sketch.items()), dtype = SKETCH_DTYPE).tobytes()
+
+def decodeSketch(data):
+	buckets = np.frombuffer(data, dtype = SKETCH_DTYPE)
+	return dict(zip(buckets["bucket"].tolist(), buckets["count"].tolist()))
+
+def getPercentile(sketch, fraction):
+	# Middle of the bucket holding the time fraction of the way through the sorted times
+	rank = fraction * (sum(sketch.values()) - 1)
+	seen = 0
+	for bucket in sorted(sketch):
+		seen += sketch[bucket]
+		if(seen > rank):
+			return 2 * math.exp(bucket * LOG_GAMMA) / (1 + math.exp(LOG_GAMMA))
+	return 0.0
+
+class TripStops:
+	#* Tells whether two stop sequences of a trip are consecutive, with the feed's cache
+	def __init__(self, feedPath, cacheDir = CACHE_DIR):
+		self.cache = openFeedCache(feedPath, cacheDir)
+		self.tripIndex = {tripId: trip for trip, tripId in enumerate(self.cache.tripIds)}
+
+	def isNextStop(self, tripId, sequence, nextSequence):
+		trip = self.tripIndex.get(tripId)
+		if(trip == None):	# Trip of an older feed
+			return False
+		sequences = self.cache.stopTimeSequence[self.cache.tripOffsets[trip]:self.cache.tripOffsets[trip + 1]]
+		position = int(np.searchsorted(sequences, sequence))
+		return position + 1 < len(sequences) and sequences[position] == sequence and sequences[position + 1] == nextSequence
+
+def getSegmentTimes(tripStops, visits, since, dayTypes):
+	#* visits are [GPSID, UPLYID, TripID, ServiceDate, StopSequence, StopID, VisitTime in seconds] rows of StopVisits
+	#* Returns {(FromStopID, ToStopID, DayType, Hour): [travel times]} of the segments with a visit past GPSID since
+	segments = {}
+	visits.sort(key = lambda visit: visit[1:5])
+	for visit, nextVisit in zip(visits, visits[1:]):
+		# Consecutive stops of the same run of a trip, by the same bus
+		if(visit[1:4] != nextVisit[1:4] or max(visit[0], nextVisit[0]) <= since):
+			continue
+		seconds = nextVisit[6] - visit[6]
+		dayType = dayTypes.get(visit[3])
+		if(not 0 < seconds <= MAX_SEGMENT_TIME or dayType == None or not tripStops.isNextStop(visit[2], visit[4], nextVisit[4])):
+			continue
+		segments.setdefault((visit[5], nextVisit[5], dayType, visit[6] // 3600 % 24), []).append(seconds)
+
+	return segments
+
+def getRunVisits(conn, runs, lastId):
+	# Visits of runs ([TripID, ServiceDate]) up to GPSID lastId, through the TripVisits index
+	visits = []
+	for batch in batches(runs):
+		query = ("SELECT GPSID, UPLYID, TripID, ServiceDate, StopSequence, StopID, VisitTime FROM StopVisits "
+			f"WHERE (TripID, ServiceDate) IN ({', '.join(['(%s, %s)'] * len(batch))}) AND GPSID <= %s")
+		for row in fetchRows(conn, query, [value for run in batch for value in run] + [lastId], "reading StopVisits"):
+			visits.append(list(row[:6]) + [fromDateTime(row[6])])
+	return visits
+
+def getStartingWatermark(conn):
+	# GPSID aggregated up to, a watermark of the VisitTime the job went by before is turned into the last GPSID visited by then
+	#? Visits written late before that can't be told apart anymore, they stay out as they were
+	watermark = getWatermark(conn, JOB)
+	if(watermark <= MAX_GPS_ID):
+		return watermark
+	lastId = fetchRows(conn, "SELECT MAX(GPSID) FROM StopVisits WHERE VisitTime <= %s", (toDateTime(watermark),), "reading StopVisits")[0][0]
+	return lastId or 0
+
+def getSegmentRow(key, numTrips, totalSeconds, sketch):
+	percentiles = [round(getPercentile(sketch, fraction)) for fraction in [0.5, 0.9, 0.95]]
+	return list(key) + [numTrips, totalSeconds, totalSeconds / numTrips] + percentiles + [encodeSketch(sketch)]
+
+def fetchRows(conn, query, params, description):
+	def fetch():
+		cursor = conn.cursor()
+		cursor.execute(query, params)
+		METRICS["statements"] += 1
+		rows = cursor.fetchall()
+		cursor.close()
+		return rows
+
+	return runWithRetry(conn, fetch, description)
+
+def getDayTypes(conn):
+	# key = ServiceDate (YYYYMMDD), value = day type
+	dayTypes = {}
+	for day, services in fetchRows(conn, "SELECT DayOfYear, Services FROM ServiceModes", (), "reading ServiceModes"):
+		try:
+			services = json.loads(services)
+		except ValueError:	# Not JSON, the services as they are
+			pass
+		dayTypes[int(day)] = getDayType(str(services))
+	return dayTypes
+
+def mergeSegments(conn, segments):
+	# Adds the new times to the segments' rows of SegmentTimes, returns the rows to write
+	current = {}
+	keys = list(segments)
+	for batch in batches(keys):
+		query = (f"SELECT NumTrips, TotalSeconds, Sketch, {', '.join(SEGMENT_KEY)} FROM SegmentTimes "
+			f"WHERE ({', '.join(SEGMENT_KEY)}) IN ({', '.join(['(%s, %s, %s, %s)'] * len(batch))})")
+		for row in fetchRows(conn, query, [value for key in batch for value in key], "reading SegmentTimes"):
+			current[tuple(row[3:])] = row[:3]
+
+	segmentRows = []
+	for key, times in segments.items():
+		numTrips, totalSeconds, data = current.get(key, [0, 0, b""])
+		sketch = decodeSketch(data)
+		addToSketch(sketch, np.array(times))
+		segmentRows.append(getSegmentRow(key, numTrips + len(times), totalSeconds + sum(times), sketch))
+	return segmentRows
+
+def writeSlice(conn, segmentRows, watermark, batchSize = BATCH_SIZE):
+	# A retry runs the whole transaction again
+	def write():
+		cursor = conn.cursor()
+		query = getUpsertQuery("SegmentTimes", SEGMENT_COLUMNS)
+		for batch in batches(segmentRows, batchSize):
+			cursor.executemany(query, batch)
+			METRICS["statements"] += 1
+		setWatermark(cursor, JOB, watermark)
+		conn.commit()
+		METRICS["commits"] += 1
+		cursor.close()
+
+	runWithRetry(conn, write, f"writing segment times up to visit {watermark}")
+
+def runSegmentTimes(conn, tripStops, batchSize = BATCH_SIZE, chunkSize = CHUNK_SIZE):
+	#* Aggregates the stop visits written since the watermark in chunks of chunkSize, stopping at the first one within SETTLE_TIME of the last
+	#* The watermark is the GPSID of StopVisits aggregated up to
+	#* Returns [visits read, segment rows written] or None in case of error
+	numVisits = 0
+	numSegments = 0
+	try:
+		last = fetchRows(conn, "SELECT MAX(VisitTime) FROM StopVisits", (), "reading StopVisits")[0][0]
+		if(last == None):
+			return [0, 0]
+		dayTypes = getDayTypes(conn)
+
+		watermark = getStartingWatermark(conn)
+		cutoff = fromDateTime(last) - SETTLE_TIME
+		while True:
+			# Keyset pagination, every chunk is a range scan of the primary key
+			rows = fetchRows(conn, NEW_VISITS_QUERY, (watermark, chunkSize), "reading StopVisits")
+
+			# Visits that haven't settled are left for the next run, with the watermark before them
+			caughtUp = len(rows) < chunkSize
+			for index, row in enumerate(rows):
+				if(fromDateTime(row[3]) > cutoff):
+					rows = rows[:index]
+					caughtUp = True
+					break
+			if not rows:
+				break
+
+			# Every visit of the runs the new ones are in, so their segments are found whatever visit was written first
+			end = rows[-1][0]
+			visits = getRunVisits(conn, list(dict.fromkeys((row[1], row[2]) for row in rows)), end)
+			segmentRows = mergeSegments(conn, getSegmentTimes(tripStops, visits, watermark, dayTypes))
+			writeSlice(conn, segmentRows, end, batchSize)
+
+			numVisits += len(rows)
+			numSegments += len(segmentRows)
+			watermark = end
+			if caughtUp:
+				break
+	except Error as error:
+		safeRollback(conn)
+		print(f"Error while aggregating segment times -> '{error}'")
+		return None
+
+	return [numVisits, numSegments]
+
+def main():
+	args = sys.argv[1:]
+	options = {"--feed": FEED_PATH, "--batch-size": BATCH_SIZE}
+	try:
+		if(len(args) % 2 != 0 or any(arg not in options for arg in args[::2])):
+			raise ValueError
+		for arg, value in zip(args[::2], args[1::2]):
+			options[arg] = type(options[arg])(value)
+	except ValueError:
+		print("Usage: python segmentTimes.py [--feed <feed.zip>] [--batch-size <rows>]")
+		print("The feed is the one the stop visits were matched against, default " + FEED_PATH)
+		sys.exit(2)
+
+	try:
+		tripStops = TripStops(options["--feed"])
+	except (OSError, ValueError, KeyError) as error:
+		print(f"Error while opening the feed -> '{error}'")
+		sys.exit(1)
+
+	conn = DBConnection()
+	if(conn == None):
+		sys.exit(1)
+
+	try:
+		if not createTables(conn, SEGMENT_TABLES):
+			return
+		start = time.perf_counter()
+		result = runSegmentTimes(conn, tripStops, options["--batch-size"])
+		if(result != None):
+			print(f"Aggregated {result[0]} stop visits in {time.perf_counter() - start:.2f} s -> {result[1]} segment rows")
+	finally:
+		conn.close()
+		printMetrics()
+
+if(__name__ == "__main__"):
+	main()
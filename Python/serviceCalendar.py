@@ -0,0 +1,228 @@
+import hashlib
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from datetime import date
+from zipfile import ZipFile
+from feedCache import FeedCache, openFeedCache, getCacheKey, getServiceModesRows, hashMember, intern, CACHE_DIR
+from gtfsReader import readChunks
+
+#* Calendar of the feed's services as bitsets, built from calendar_dates.txt
+#* Every service (interned as in the cache's serviceIds) has one bit per day of the dates the feed covers, so whether a trip runs
+#* on a day is a bit test and the services running on a day are one row of the same bits transposed, no strings are parsed
+#* The bitsets are kept memory-mapped in the cache directory, keyed by calendar_dates.txt alone, the loader writes them to ServiceCalendars
+#? Only calendar_dates.txt is read to build them, or the feed's cache if it was already built, never the whole feed
+#* python serviceCalendar.py <feed.zip> [queries] benchmarks it against the rows of ServiceModes
+
+CALENDAR_VERSION = 2
+
+#* Arrays of a calendar, day d is the d-th day from the calendar's first date, bits are in little endian order (bit d % 8 of byte d // 8)
+# serviceBits -> bit d of serviceBits[s] is set when service s runs on day d, as ServiceCalendars.Days has it
+# dayBits -> bit s of dayBits[d] is set when service s runs on day d
+ARRAYS = ["serviceBits", "dayBits"]
+
+def toDayNumber(day):
+	# YYYYMMDD, like calendar_dates.txt and ServiceModes
+	return day.year * 10000 + day.month * 100 + day.day
+
+class ServiceCalendar:
+	#* Service calendar of a feed, opened memory-mapped from calendarPath, with the feed's cache (if given) for the trips
+	#* serviceIds are the services of calendar_dates.txt, the cache interns them first so they have the same indices there
+	#* Days are dates, days the feed doesn't cover have no service running
+	def __init__(self, calendarPath, cache = None):
+		self.cache = cache
+		for name in ARRAYS:
+			# Plain arrays over the mapped files, slicing a memmap costs more than the bit test
+			setattr(self, name, np.asarray(np.load(os.path.join(calendarPath, name + ".npy"), mmap_mode = "r")))
+
+		with open(os.path.join(calendarPath, "calendar.json"), 'r', encoding = "utf8") as file:
+			meta = json.load(file)
+		self.firstDate = meta["firstDate"]	# YYYYMMDD, None when the feed has no calendar
+		self.numDays = meta["numDays"]
+		self.serviceIds = meta["serviceIds"]
+
+		self.numServices = len(self.serviceIds)
+		self.tripService = None
+		if(cache != None):
+			# Services only in trips.txt never run, they get rows without bits so the cache's indices can be tested as they are
+			self.numServices = len(cache.serviceIds)
+			if(self.numServices > len(self.serviceBits)):
+				padding = np.zeros((self.numServices - len(self.serviceBits), self.serviceBits.shape[1]), dtype = np.uint8)
+				self.serviceBits = np.concatenate([self.serviceBits, padding])
+			self.tripService = np.asarray(cache.tripService)
+
+		self.firstOrdinal = date(self.firstDate // 10000, self.firstDate // 100 % 100, self.firstDate % 100).toordinal() if self.numDays else 0
+
+	def getDay(self, day):
+		# Index of day (a date) in the calendar, None when the feed doesn't cover it
+		index = day.toordinal() - self.firstOrdinal
+		return index if 0 <= index < self.numDays else None
+
+	def getDate(self, index):
+		return date.fromordinal(self.firstOrdinal + index)
+
+	def getServiceMask(self, day):
+		#* Mask over the cache's serviceIds of the services running on day (a date)
+		index = self.getDay(day)
+		if(index == None):
+			return np.zeros(self.numServices, dtype = bool)
+		return np.unpackbits(self.dayBits[index], count = self.numServices, bitorder = "little").view(bool)
+
+	def isRunning(self, services, day):
+		#* Whether each of services (indices in the cache's serviceIds) runs on day (a date)
+		index = self.getDay(day)
+		if(index == None):
+			return np.zeros(np.shape(services), dtype = bool)
+		return (self.serviceBits[services, index >> 3] >> (index & 7) & 1).view(bool)
+
+	def isTripRunning(self, trips, day):
+		#* Whether each of trips (indices in the cache's tripIds) runs on day (a date), the calendar has to be opened with the cache
+		return self.isRunning(self.tripService[trips], day)
+
+def getCalendarKey(feedPath):
+	# SHA-256 of calendar_dates.txt, so feeds with the same calendar share it whatever their other files
+	sha = hashlib.sha256(f"calendar v{CALENDAR_VERSION}".encode())
+	with ZipFile(feedPath) as zipfile:
+		hashMember(sha, zipfile, "calendar_dates.txt")
+	return sha.hexdigest()
+
+def readCalendarDates(feedPath):
+	#* Columns of calendar_dates.txt as the cache has them, read straight from the feed's zip
+	serviceIds = []
+	serviceIndex = {}
+	calendarDate = []
+	calendarService = []
+	calendarException = []
+	for chunk in readChunks(feedPath, "calendar_dates.txt", ["service_id", "date", "exception_type"]):
+		services, dates, exceptionTypes = zip(*chunk)
+		calendarService.append(intern(services, serviceIds, serviceIndex))
+		calendarDate.append(np.array(dates, dtype = np.int32))
+		calendarException.append(np.array(exceptionTypes, dtype = np.int8))
+
+	if not calendarDate:
+		return np.zeros(0, dtype = np.int32), np.zeros(0, dtype = np.int32), np.zeros(0, dtype = np.int8), serviceIds
+	return np.concatenate(calendarDate), np.concatenate(calendarService), np.concatenate(calendarException), serviceIds
+
+def buildServiceCalendar(calendarDates, calendarServices, calendarExceptions, serviceIds, calendarPath):
+	#* Builds in calendarPath the service calendar of the rows of calendar_dates.txt, services interned in serviceIds
+	numServices = len(serviceIds)
+
+	# Every day from the first date of calendar_dates.txt to the last, like ServiceModes
+	#? exception_type 2 rows only make their date part of the feed, as in ServiceModes a service runs if a row adds it
+	dates, dateOfRow = np.unique(calendarDates, return_inverse = True)
+	ordinals = np.array([date(day // 10000, day // 100 % 100, day % 100).toordinal() for day in dates.tolist()], dtype = np.int64)
+	numDays = int(ordinals[-1] - ordinals[0]) + 1 if len(ordinals) else 0
+	running = np.zeros((numServices, numDays), dtype = bool)
+	adding = np.asarray(calendarExceptions) == 1
+	running[np.asarray(calendarServices)[adding], (ordinals[dateOfRow] - ordinals[:1])[adding]] = True
+
+	arrays = {
+		"serviceBits": np.packbits(running, axis = 1, bitorder = "little"),
+		"dayBits": np.packbits(running.T, axis = 1, bitorder = "little"),
+	}
+	meta = {"version": CALENDAR_VERSION, "firstDate": int(dates[0]) if numDays else None, "numDays": numDays, "serviceIds": serviceIds}
+
+	# Written to a temporary directory first, so a crash never leaves a broken calendar
+	tempPath = calendarPath.rstrip("/") + f".part{os.getpid()}"
+	shutil.rmtree(tempPath, ignore_errors = True)
+	os.makedirs(tempPath)
+	for name, array in arrays.items():
+		np.save(os.path.join(tempPath, name + ".npy"), array)
+	with open(os.path.join(tempPath, "calendar.json"), 'w', encoding = "utf8") as file:
+		json.dump(meta, file)
+
+	try:
+		os.rename(tempPath, calendarPath)
+	except OSError:	# Someone else built it first
+		shutil.rmtree(tempPath, ignore_errors = True)
+
+def openServiceCalendar(feedPath, cacheDir = CACHE_DIR, cache = None):
+	#* Opens the service calendar of the feed at feedPath, building it if needed, with cache (or the feed's cache if it was built) for the trips
+	#* The feed's cache is never built for it, the calendar is built from calendar_dates.txt when there is none
+	if(cache == None):
+		cachePath = os.path.join(cacheDir, getCacheKey(feedPath))
+		if os.path.exists(cachePath):
+			cache = FeedCache(cachePath)
+
+	calendarPath = os.path.join(cacheDir, "serviceCalendar" + getCalendarKey(feedPath))
+	if not os.path.exists(calendarPath):
+		print("Building calendar of the services")
+		os.makedirs(cacheDir, exist_ok = True)
+		if(cache != None):
+			# The cache interns the services of calendar_dates.txt first, in the order they appear, as readCalendarDates does
+			numListed = int(np.asarray(cache.calendarService).max()) + 1 if len(cache.calendarService) else 0
+			buildServiceCalendar(cache.calendarDate, cache.calendarService, cache.calendarException, cache.serviceIds[:numListed], calendarPath)
+		else:
+			buildServiceCalendar(*readCalendarDates(feedPath), calendarPath)
+
+	return ServiceCalendar(calendarPath, cache)
+
+#* Row builder of the loader (see setCarrisData.py)
+
+def getServiceCalendarsRows(calendar):
+	# Services of calendar_dates.txt, the ones only in trips.txt never run
+	if not calendar.numDays:
+		return []
+	return [[serviceId, calendar.firstDate, calendar.numDays, bits.tobytes()] for serviceId, bits
+		in zip(calendar.serviceIds, calendar.serviceBits)]
+
+def main():
+	if(len(sys.argv) not in [2, 3]):
+		print("Usage: python serviceCalendar.py <feed.zip> [queries]")
+		sys.exit(2)
+	numQueries = int(sys.argv[2]) if len(sys.argv) == 3 else 1000
+
+	cache = openFeedCache(sys.argv[1])
+	start = time.perf_counter()
+	calendar = openServiceCalendar(sys.argv[1], cache = cache)
+	print(f"Opened in {time.perf_counter() - start:.2f} s -> {calendar.numServices} services over {calendar.numDays} days, "
+		f"{calendar.serviceBits.nbytes + calendar.dayBits.nbytes} bytes")
+	if not calendar.numDays:
+		print("The feed has no calendar")
+		return
+
+	# Every day of ServiceModes against the calendar
+	serviceModes = {day: json.loads(services) for day, services in getServiceModesRows(cache)}
+	wrong = 0
+	for index in range(calendar.numDays):
+		day = calendar.getDate(index)
+		services = serviceModes[toDayNumber(day)]
+		expected = np.isin(np.array(cache.serviceIds, dtype = object), services.split(",") if services else [])
+		wrong += not np.array_equal(calendar.getServiceMask(day), expected)
+	print(f"{calendar.numDays - wrong} of {calendar.numDays} days equal to ServiceModes")
+
+	# Every trip on random days, as ServiceModes has to be read (parsing the day's row) and with the bitsets
+	rand = np.random.default_rng(0)
+	days = [calendar.getDate(index) for index in rand.integers(0, calendar.numDays, numQueries).tolist()]
+	rows = {toDayNumber(day): json.dumps(serviceModes[toDayNumber(day)]) for day in days}
+	trips = np.arange(len(cache.tripIds))
+	tripServiceIds = [cache.serviceIds[service] for service in calendar.tripService.tolist()]
+
+	start = time.perf_counter()
+	byString = []
+	for day in days:
+		services = set(json.loads(rows[toDayNumber(day)]).split(","))
+		byString.append([serviceId in services for serviceId in tripServiceIds])
+	stringTime = time.perf_counter() - start
+
+	start = time.perf_counter()
+	byBits = [calendar.isTripRunning(trips, day) for day in days]
+	bitsTime = time.perf_counter() - start
+
+	start = time.perf_counter()
+	masks = [calendar.getServiceMask(day) for day in days]
+	maskTime = time.perf_counter() - start
+
+	wrong = sum(not np.array_equal(running, expected) or not np.array_equal(mask[calendar.tripService], expected)
+		for running, mask, expected in zip(byBits, masks, byString))
+	print(f"{numQueries} days of {len(trips)} trips -> {stringTime / numQueries * 1000:.3f} ms each parsing ServiceModes, "
+		f"{bitsTime / numQueries * 1000:.3f} ms each with the bitsets, {maskTime / numQueries * 1e6:.2f} us per mask of a day")
+	print(f"{numQueries - wrong} of {numQueries} days equal")
+
+if(__name__ == "__main__"):
+	main()
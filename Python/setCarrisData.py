@@ -1,769 +1,883 @@
-import csv
-import mysql.connector
-import pandas as pd
 import os
-import calendar
 import json
 import sys
 import gc
 import signal
-
-from dotenv import load_dotenv
+import hashlib
+import multiprocessing
+import gtfsFrames
+import feedCache
+import nextDepartures
+import serviceCalendar
+
+from datetime import datetime, timedelta
 from mysql.connector import Error
-from urllib.request import urlopen
-from io import BytesIO
-from zipfile import ZipFile
+from dbConnection import DBConnection, runWithRetry, mergeMetrics, printMetrics, METRICS
+from gtfsReader import readRows, readChunks
+from dbWriter import syncTable, syncFingerprints, openWriter, safeRollback, BATCH_SIZE, COMMIT_EVERY, MAX_UNCOMMITTED
+from tableSchemas import createTables
+from routePatterns import buildRouteRows
+from stagingTables import prepareStaging, buildIndexes, swapStaging, dropStaging, rollbackSwap, STAGING_SUFFIX
+from loadMetrics import phase, addRows, resetPhases, mergePhases, setProfiledPhase, writeMetrics, PHASES
+from feedDownload import downloadZip, loadFeedState, saveFeedState, hashFeedFiles, isTableLoaded, setTableLoaded, clearTableLoaded, FEED_URL, TABLE_FILES
 
 
 def handler(signum, frame):
-	global conn
-
 	print("Received SIGINT from user, terminating program")
-	# Terminate DB connection
-	conn.close()
-	quit()
+	# Unwinds main(), which stops the workers and terminates the DB connection
+	raise KeyboardInterrupt
     
-def DBConnection():
-	# Get environment variables
-	load_dotenv()
-	hostname = os.getenv("hostname")
-	DBName = os.getenv("dbnameSecure")
-	username = os.getenv("usernameSecure")
-	password = os.getenv("passwordSecure")
-	port = int(os.getenv("portSecure"))
-
-	# Try to create a connection
-	try:
-			conn = mysql.connector.connect(host = hostname, user = username, password = password, database = DBName, port = port)
-			print("DB connection successful")
-	except Error as error:
-			print(f"Error while setting the DB connection -> '{error}'")
-
-	return conn
-
-def downloadZip(extractPath):
-	url = "https://github.com/carrismetropolitana/gtfs/raw/live/CarrisMetropolitana.zip"
-
-	httpResponse = urlopen(url)
-	zipfile = ZipFile(BytesIO(httpResponse.read()))
-	zipfile.extractall(path = extractPath)
-
 def clearTable(tableName, conn):
 	query = f"DELETE FROM {tableName}"
-	try:
+
+	def clear():
 		cursor = conn.cursor()
 		cursor.execute(query)
 		conn.commit()
-		print(f"Cleared table {tableName}")
+		METRICS["statements"] += 1
+		METRICS["commits"] += 1
 		cursor.close()
+
+	try:
+		with phase(f"clear {tableName}"):
+			runWithRetry(conn, clear, f"clearing table {tableName}")
+		print(f"Cleared table {tableName}")
 	except Error as error:
 		print(f"Error while clearing table {tableName} -> '{error}'")
 		return False
 	
 	return True
 
-def setBusStops(extractPath, conn, clearedBusStops):
+def getBusStopsRows(feedPath):
+	# Read stops file
+	return [list(row) for row in readRows(feedPath, "stops.txt", ["stop_id", "stop_name", "stop_lat", "stop_lon"])]
+
+def setBusStops(feedPath, conn, clearedBusStops, batchSize = BATCH_SIZE, fastLoad = False, source = "stream", prepared = False, tableSuffix = ""):
+	tableName = "BusStops" + tableSuffix
 	if not clearedBusStops:
-		print("Verifying and setting table BusStops")
+		print(f"Verifying and setting table {tableName}")
 	else:
-		print("Setting table BusStops")
-
-	# Read stops file
-	stopsPath = extractPath + "stops.txt"
-	with open(stopsPath, 'r', encoding = "utf8") as file:
-		lines = list(csv.reader(file, delimiter = ','))
-
-	# * Line format is
-	# stop_id,stop_code,stop_name,stop_lat,stop_lon,municipality,locality,near_health_clinic,near_hospital,near_university,near_school,near_police_station,near_fire_station,near_shopping,near_historic_building,near_transit_office,light_rail,subway,train,boat,airport,bike_sharing,bike_parking,car_parking
-
-	stop_idArray = []
-	stop_nameArray = []
-	stop_latArray = []
-	stop_lonArray = []
-
-	# Ignore header line and get necessary information
-	for row in lines[1:]:
-		stop_idArray.append(int(row[0]))
-		stop_nameArray.append(row[2])
-		stop_latArray.append(float(row[3]))
-		stop_lonArray.append(float(row[4]))
-
-	stops = []
-	for iter in range(len(stop_idArray)):
-		tempStop = []
-		tempStop.append(stop_idArray[iter])
-		tempStop.append(stop_nameArray[iter])
-		tempStop.append(stop_latArray[iter])
-		tempStop.append(stop_lonArray[iter])
-
-		if not clearedBusStops:
-			# Verify if this entry exists in the DB and if it's valid
-			query = "SELECT * FROM BusStops WHERE StopID = %s"
-			
-			try:
-				cursor = conn.cursor()
-				cursor.execute(query, tempStop[0])
-				reply = cursor.fetchone()
-				cursor.close()
-			except Error as error:
-				print(f"Error while verifying values for table BusStops on row with StopID {tempStop[0]} -> '{error}'")
-				return False
+		print(f"Setting table {tableName}")
 
-			if(reply == None):	# Row is not present in the DB, add it
-				stops.append(tempStop)
-				#print(f"Adding row StopID = {tempStop[0]}, StopName = {tempStop[1]}, Latitude = {tempStop[2]}, Longitude = {tempStop[3]}, Type = {tempStop[4]}")
-			else:								# Else, check if it matches the current information
-				if(tempStop[1] != reply[1] or tempStop[2] != reply[2] or tempStop[3] != reply[3]):
-					# Delete row in DB and insert current one
-					query = "DELETE FROM BusStops WHERE StopID = %s"
-
-					try:
-						cursor = conn.cursor()
-						cursor.execute(query, tempStop[0])
-						conn.commit()
-						cursor.close()
-					except Error as error:
-						print(f"Error while deleting row with StopID {tempStop[0]} from table BusStops -> '{error}'")
-						return False
-
-					stops.append(tempStop)
+	with phase(f"parse {tableName}"):
+		if(source == "cache"):
+			stops = feedCache.getBusStopsRows(feedCache.openFeedCache(feedPath))
+		elif(source == "pandas"):
+			stops = gtfsFrames.getBusStopsRows(feedPath)
 		else:
-			stops.append(tempStop)
-	
-	# Ready query
-	query = "INSERT INTO BusStops (StopID, StopName, Latitude, Longitude) VALUES (%s, %s, %s, %s)"
+			stops = getBusStopsRows(feedPath)
+		addRows(len(stops))
 
+	if not clearedBusStops:
+		# Verify the whole table against the feed and only write what changed
+		with phase(f"write {tableName}"):
+			addRows(len(stops))
+			return syncTable(conn, tableName, ["StopID", "StopName", "Latitude", "Longitude"], stops, batchSize) != None
+	
 	# Execute query
 	try:
-		print("Creating query for table BusStops")
-		cursor = conn.cursor()
-		cursor.executemany(query, stops)
-		conn.commit()
-		print("Table BusStops set")
-		cursor.close()
+		print(f"Creating query for table {tableName}")
+		with phase(f"write {tableName}"):
+			writer = openWriter(conn, tableName, ["StopID", "StopName", "Latitude", "Longitude"], batchSize, fastLoad = fastLoad, prepared = prepared)
+			for row in stops:
+				writer.add(row)
+			writer.close()
+			addRows(writer.rowsWritten)
+		print(f"Table {tableName} set")
 	except Error as error:
-		print(f"Error while setting values for table BusStops -> '{error}'")
+		safeRollback(conn)
+		print(f"Error while setting values for table {tableName} -> '{error}'")
 		return False
 	
 	return True
 
-def setServiceModes(extractPath, conn, clearedServiceModes):
-	if not clearedServiceModes:
-		print("Verifying and setting table ServiceModes")
-	else:
-		print("Setting table ServiceModes")
-
-	# Read calendar_dates file
-	filePath = extractPath + "calendar_dates.txt"
-	with open(filePath, 'r', encoding = "utf8") as file:
-		lines = list(csv.reader(file, delimiter = ','))
-
-	# * Line format is
-	# service_id,date,holiday,period,day_type,exception_type
-
-	# Get current year
-	year = int(lines[1][1][:4])
-
-	# Declare dictionary that will be used to input values to the DB
-	dic = {}
-	for month in range(1, 13):	# For each month, add a line for each day of it
-		monthStr = f"{month:02}"
-		_, daysInMonth = calendar.monthrange(year, month)
-		for day in range(1, daysInMonth + 1):
-			dayStr = f"{day:02}"
-			
-			# Add day to dictionary
-			index = str(year) + monthStr + dayStr
-			dic[f"{index}"] = ""
-
-	# Check different services for a given day
-	for day, _ in dic.items():
-		for row in lines[1:]:
-			if(row[1] == day):
-				dic[f"{day}"] = dic.get(f"{day}") + row[0] + ','
-
-	# Remove final ',' in each row
-	for day, _ in dic.items():
-		dic[f"{day}"] = dic.get(f"{day}")[:-1]
-
+def getServiceModesRows(feedPath):
+	# Read calendar_dates file, grouping the services of each day in a single pass
+	#? exception_type 1 means the service runs on that day, 2 that it was removed from it
+	dic = {}	# key = date, value = list of services
+	for service, day, exceptionType in readRows(feedPath, "calendar_dates.txt", ["service_id", "date", "exception_type"]):
+		services = dic.setdefault(day, [])
+		if(exceptionType == 1):
+			services.append(service)
+
+	if not dic:
+		return []
+
+	# Add a row for every day the feed covers (which can span several years), days without service are left empty
+	day = datetime.strptime(min(dic), "%Y%m%d").date()
+	lastDay = datetime.strptime(max(dic), "%Y%m%d").date()
 	queryRows = []
-	for day, services in dic.items():
-		queryRowTemp = []
-		queryRowTemp.append(int(day))
-		queryRowTemp.append(json.dumps(services))
+	while day <= lastDay:
+		index = day.strftime("%Y%m%d")
+		queryRows.append([int(index), json.dumps(",".join(dic.get(index, [])))])
+		day += timedelta(days = 1)
 
-		if not clearedServiceModes:
-			# Verify if this entry exists in the DB and if it's valid
-			query = "SELECT * FROM ServiceModes WHERE DayOfYear = %s"
+	return queryRows
 
-			try:
-				cursor = conn.cursor()
-				cursor.execute(query, queryRowTemp[0])
-				reply = cursor.fetchone()
-				cursor.close()
-			except Error as error:
-				print(f"Error while verifying values for table ServicesModes on row with DayOfYear {queryRowTemp[0]} -> '{error}'")
-				return False
-			
-			if(reply == None):	# Row is not present in the DB, add it
-				queryRows.append(queryRowTemp)
-			else:								# Else, check if it matches the current information
-				if(queryRowTemp[1] != reply[1]):
-					# Delete row in DB and insert current one
-					query = "DELETE FROM BusStops WHERE StopID = %s"
-
-					try:
-						cursor = conn.cursor()
-						cursor.execute(query, queryRowTemp[0])
-						conn.commit()
-						cursor.close()
-					except Error as error:
-						print(f"Error while deleting row with DayOfYear {queryRowTemp[0]} from table ServicesModes -> '{error}'")
-						return False
-
-					queryRows.append(queryRowTemp)
+def setServiceModes(feedPath, conn, clearedServiceModes, batchSize = BATCH_SIZE, fastLoad = False, source = "stream", prepared = False, tableSuffix = ""):
+	tableName = "ServiceModes" + tableSuffix
+	if not clearedServiceModes:
+		print(f"Verifying and setting table {tableName}")
+	else:
+		print(f"Setting table {tableName}")
+
+	with phase(f"parse {tableName}"):
+		if(source == "cache"):
+			queryRows = feedCache.getServiceModesRows(feedCache.openFeedCache(feedPath))
+		elif(source == "pandas"):
+			queryRows = gtfsFrames.getServiceModesRows(feedPath)
 		else:
-			queryRows.append(queryRowTemp)
-	
-	# Ready query
-	query = "INSERT INTO ServiceModes (DayOfYear, Services) VALUES (%s, %s)"
+			queryRows = getServiceModesRows(feedPath)
+		addRows(len(queryRows))
+	if not queryRows:
+		print(f"File calendar_dates.txt is empty, table {tableName} not set")
+		return False
 
+	if not clearedServiceModes:
+		# Verify the whole table against the feed and only write what changed
+		with phase(f"write {tableName}"):
+			addRows(len(queryRows))
+			return syncTable(conn, tableName, ["DayOfYear", "Services"], queryRows, batchSize) != None
+	
 	# Execute query
 	try:
-		print("Creating query for table ServiceModes")
-		cursor = conn.cursor()
-		cursor.executemany(query, queryRows)
-		conn.commit()
-		print("Table ServiceModes set")
-		cursor.close()
+		print(f"Creating query for table {tableName}")
+		with phase(f"write {tableName}"):
+			writer = openWriter(conn, tableName, ["DayOfYear", "Services"], batchSize, fastLoad = fastLoad, prepared = prepared)
+			for row in queryRows:
+				writer.add(row)
+			writer.close()
+			addRows(writer.rowsWritten)
+		print(f"Table {tableName} set")
 	except Error as error:
-		print(f"Error while setting values for table ServiceModes -> '{error}'")
+		safeRollback(conn)
+		print(f"Error while setting values for table {tableName} -> '{error}'")
 		return False
 	
 	return True
 
-def setBusTripsAndBusRoutes(extractPath, conn, clearedBusTrips, clearedBusRoutes):
-	if not clearedBusTrips:
-		print("Verifying and setting table BusTrips")
+SERVICE_CALENDARS_COLUMNS = ["ServiceID", "FirstDate", "NumDays", "Days"]
+
+def setServiceCalendars(feedPath, conn, batchSize = BATCH_SIZE, tableSuffix = ""):
+	#* Sets ServiceCalendars from the service calendar (see serviceCalendar.py), whatever the source
+	#* A row per service, so the table is always verified, also once cleared (its bitsets aren't text LOAD DATA could read)
+	tableName = "ServiceCalendars" + tableSuffix
+	try:
+		with phase("build service calendar"):
+			calendar = serviceCalendar.openServiceCalendar(feedPath)
+	except (OSError, ValueError, KeyError) as error:
+		print(f"Error while building the service calendar -> '{error}'")
+		return False
+
+	queryRows = serviceCalendar.getServiceCalendarsRows(calendar)
+	if not queryRows:
+		print(f"File calendar_dates.txt is empty, table {tableName} not set")
+		return False
+
+	print(f"Verifying and setting table {tableName}")
+	with phase(f"write {tableName}"):
+		addRows(len(queryRows))
+		return syncTable(conn, tableName, SERVICE_CALENDARS_COLUMNS, queryRows, batchSize) != None
+
+def fixTime(time):
+	# Carris thinks the day has 25 hours sometimes, wrap those back into a 24 hour clock
+	hours = int(time[:time.index(':')])
+	if(hours >= 24):
+		time = f"{hours - 24:02}" + time[time.index(':'):]
+	return time
+
+def buildBusTripsAndBusRoutesRows(tripsRows, stopTimesRows, routes):
+	#* tripsRows are [route_id, service_id, trip_id, direction_id] rows of trips.txt
+	#* stopTimesRows are [trip_id, arrival_time, stop_id, stop_sequence] rows of stop_times.txt
+	#* routes is the list of RouteIDs in routes.txt order
+	#* Returns [busRoutesRows, busTripsRows, busPatternsRows], see routePatterns.py
+	#? Files can be in any order, everything is indexed by TripID so each file is only read once
+	tripsRows = list(tripsRows)
+
+	# Single pass over stop_times.txt, keeping the first stop of every trip and the stops of every trip
+	#? Stops of a trip are gathered while its rows follow each other, then kept as a tuple shared by every trip with the same stops
+	#? so memory grows with the number of patterns, not of stop times
+	#? Trips whose rows come back later (out of order files) are gathered apart in a list until every row is read, and only then shared
+	firstStops = {}		# key = TripID, value = [stop_sequence, arrival_time]
+	sequences = {}		# key = TripID, value = tuple of (stop_sequence, StopID) of a finished trip
+	shared = {}			# key = the distinct tuples of sequences, value = [tuple, number of trips with it]
+	scattered = {}		# key = TripID, value = list of (stop_sequence, StopID) of a trip whose rows aren't contiguous
+	openTrip = None
+	openStops = []
+
+	def closeTrip(trip, tripStops):
+		stops = tuple(sorted(tripStops))
+		entry = shared.setdefault(stops, [stops, 0])
+		entry[1] += 1
+		sequences[trip] = entry[0]
+
+	for row in stopTimesRows:
+		trip = row[0]
+		sequence = row[3]
+
+		firstStop = firstStops.get(trip)
+		if(firstStop == None or sequence < firstStop[0]):
+			firstStops[trip] = [sequence, row[1]]
+
+		if(trip != openTrip):
+			if(openTrip != None and openTrip not in scattered):
+				closeTrip(openTrip, openStops)
+			openTrip = trip
+			if trip in scattered:
+				openStops = scattered[trip]
+			elif trip in sequences:
+				# Rows of a trip can come back later in out of order files, its tuple is no longer shared
+				stops = sequences.pop(trip)
+				entry = shared[stops]
+				entry[1] -= 1
+				if(entry[1] == 0):
+					del shared[stops]
+				openStops = list(stops)
+				scattered[trip] = openStops
+			else:
+				openStops = []
+		openStops.append((sequence, row[2]))
+	if(openTrip != None and openTrip not in scattered):
+		closeTrip(openTrip, openStops)
+	for trip, tripStops in scattered.items():
+		closeTrip(trip, tripStops)
+	scattered.clear()
+
+	# Stops of every trip, ordered by stop_sequence
+	stopsOf = {tripSequences: tuple(stop for _, stop in tripSequences) for tripSequences, _ in shared.values()}
+	tripStops = {trip: stopsOf[tripSequences] for trip, tripSequences in sequences.items()}
+
+	startingTimes = {trip: fixTime(firstStop[1]) for trip, firstStop in firstStops.items()}
+	return buildRouteRows(routes, tripsRows, tripStops, startingTimes)
+
+def getBusTripsAndBusRoutesRows(feedPath):
+	# Read the files, stop_times.txt is streamed and never held in memory
+	routes = [row[0] for row in readRows(feedPath, "routes.txt", ["route_id"])]
+	tripsRows = readRows(feedPath, "trips.txt", ["route_id", "service_id", "trip_id", "direction_id"])
+	stopTimesRows = readRows(feedPath, "stop_times.txt", ["trip_id", "arrival_time", "stop_id", "stop_sequence"])
+	return buildBusTripsAndBusRoutesRows(tripsRows, stopTimesRows, routes)
+
+# Keys first and fingerprints last, as syncFingerprints needs them
+BUS_ROUTES_COLUMNS = ["RouteDirectionID", "RouteID", "Stops", "Direction", "Fingerprint"]
+BUS_TRIPS_COLUMNS = ["FeedTripID", "RouteID", "RouteService", "StartingTime", "PatternID", "Fingerprint"]
+
+def setBusTripsAndBusRoutes(feedPath, conn, clearedBusTrips, clearedBusRoutes, clearedBusPatterns, batchSize = BATCH_SIZE, commitEvery = COMMIT_EVERY, fastLoad = False, source = "stream", prepared = False, tableSuffix = ""):
+	#* Sets BusTrips, BusRoutes and BusPatterns, every trip of BusTrips references its pattern in BusPatterns
+	busTripsName = "BusTrips" + tableSuffix
+	busRoutesName = "BusRoutes" + tableSuffix
+	busPatternsName = "BusPatterns" + tableSuffix
+	for tableName, cleared in [[busTripsName, clearedBusTrips], [busRoutesName, clearedBusRoutes], [busPatternsName, clearedBusPatterns]]:
+		if not cleared:
+			print(f"Verifying and setting table {tableName}")
+		else:
+			print(f"Setting table {tableName}")
+
+	with phase(f"parse {busTripsName}, {busRoutesName} and {busPatternsName}"):
+		if(source == "cache"):
+			busRoutesRows, busTripsRows, busPatternsRows = feedCache.getBusTripsAndBusRoutesRows(feedCache.openFeedCache(feedPath))
+		elif(source == "pandas"):
+			busRoutesRows, busTripsRows, busPatternsRows = gtfsFrames.getBusTripsAndBusRoutesRows(feedPath)
+		else:
+			busRoutesRows, busTripsRows, busPatternsRows = getBusTripsAndBusRoutesRows(feedPath)
+		addRows(len(busRoutesRows) + len(busTripsRows) + len(busPatternsRows))
+	gc.collect()	# To avoid memory problems
+	print(f"{len(busPatternsRows)} distinct stop patterns in {len(busTripsRows)} trips")
+
+	# Patterns go first, trips reference them
+	#? Pattern IDs are hashes of the patterns, so an existing table can be synced instead of written again
+	if not clearedBusPatterns:
+		with phase(f"write {busPatternsName}"):
+			addRows(len(busPatternsRows))
+			if(syncTable(conn, busPatternsName, ["PatternID", "RouteID", "Direction", "Stops", "NumTrips"], busPatternsRows, batchSize) == None):
+				return False
 	else:
-		print("Setting table BusTrips")
+		try:
+			with phase(f"write {busPatternsName}"):
+				writer = openWriter(conn, busPatternsName, ["PatternID", "RouteID", "Direction", "Stops", "NumTrips"], batchSize, commitEvery, fastLoad, prepared)
+				for queryRow in busPatternsRows:
+					writer.add(queryRow)
+				writer.close()
+				addRows(writer.rowsWritten)
+		except Error as error:
+			safeRollback(conn)
+			print(f"Error while setting values for table {busPatternsName} -> '{error}'")
+			return False
+
+	# Routes and trips that were set before are verified by their fingerprints, so only the ones that changed are written
+	#? A day-to-day update of the feed changes a few trips, which is all that gets written
+	for tableName, cleared, columns, queryRows in [[busRoutesName, clearedBusRoutes, BUS_ROUTES_COLUMNS, busRoutesRows],
+		[busTripsName, clearedBusTrips, BUS_TRIPS_COLUMNS, busTripsRows]]:
+		if not cleared:
+			with phase(f"write {tableName}"):
+				addRows(len(queryRows))
+				if(syncFingerprints(conn, tableName, columns, queryRows, batchSize) == None):
+					return False
+			continue
+
+		#? Rows are written in batches, so the server never has to hold more than batchSize rows of a statement
+		#? Cleared tables can be fast loaded from a file instead
+		try:
+			with phase(f"write {tableName}"):
+				writer = openWriter(conn, tableName, columns, batchSize, commitEvery, fastLoad, prepared)
+				for queryRow in queryRows:
+					writer.add(queryRow)
+				writer.close()
+				addRows(writer.rowsWritten)
+		except Error as error:
+			safeRollback(conn)
+			print(f"Error while setting values for table {tableName} -> '{error}'")
+			return False
+
+	print(f"Tables {busTripsName}, {busRoutesName} and {busPatternsName} set")
+	return True
 
-	if not clearedBusRoutes:
-		print("Verifying and setting table BusRoutes")
+# Tables built from the same files, always set together
+ROUTE_TABLES = ["BusTrips", "BusRoutes", "BusPatterns"]
+
+# Columns of StopTimes, in the order of its rows
+STOP_TIMES_COLUMNS = ["TripID", "StopSequence", "StopID", "RouteID", "ServiceID", "Direction", "ArrivalTime", "DepartureTime"]
+# Batches per commit of StopTimes when --commit-every isn't given, one transaction of millions of rows strains the server's undo log
+STOP_TIMES_COMMIT_EVERY = 100
+
+def timeToSeconds(time):
+	# "HH:MM:SS" to seconds since the start of the service day, hours can be 24 or more
+	#? Stops that aren't timepoints can have no time
+	if not time:
+		return None
+	hours, minutes, seconds = time.split(":")
+	return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+
+def getStopTimesChunks(feedPath):
+	#* Yields the StopTimes rows in chunks, stop_times.txt is streamed and never held in memory
+	# Trips are few enough to be kept
+	trips = {}
+	for route, service, trip, direction in readRows(feedPath, "trips.txt", ["route_id", "service_id", "trip_id", "direction_id"]):
+		trips[trip] = [route, service, direction != 0]
+
+	for chunk in readChunks(feedPath, "stop_times.txt", ["trip_id", "stop_sequence", "stop_id", "arrival_time", "departure_time"]):
+		rows = []
+		for trip, sequence, stop, arrival, departure in chunk:
+			tripInfo = trips.get(trip)
+			if(tripInfo == None):	# Stop times of trips not in trips.txt are left out
+				continue
+			rows.append([trip, sequence, stop, tripInfo[0], tripInfo[1], tripInfo[2], timeToSeconds(arrival), timeToSeconds(departure)])
+		yield rows
+
+def setStopTimes(feedPath, conn, clearedStopTimes, batchSize = BATCH_SIZE, commitEvery = COMMIT_EVERY, fastLoad = False, source = "stream", prepared = False, tableSuffix = ""):
+	#* Sets StopTimes, which has to be empty (cleared, or the staging copy of a reload)
+	tableName = "StopTimes" + tableSuffix
+	if not clearedStopTimes:
+		# Millions of rows are too many to verify, main() turns a set of a table that wasn't cleared into a reload
+		print(f"Table {tableName} is too big to verify, clear or reload it to set it")
+		return False
+	print(f"Setting table {tableName}")
+
+	# The cache has the stop times already parsed, otherwise they are streamed from the feed (the pandas pipeline included)
+	if(source == "cache"):
+		chunks = feedCache.getStopTimesChunks(feedCache.openFeedCache(feedPath))
 	else:
-		print("Setting table BusRoutes")
-	print("This step may take a while")
-
-	#* Read routes file
-	#* Line format is
-	# route_id,agency_id,route_short_name,route_long_name,route_type,route_color,route_text_color,circular,path_type
-	filePath = extractPath + "routes.txt"
-	with open(filePath, 'r', encoding = "utf8") as file:
-		linesRoutes = list(csv.reader(file, delimiter = ','))
-
-	# Get routes
-	routes = []
-	for row in linesRoutes[1:]:
-		routes.append(row[0])
-	del linesRoutes	# To avoid memory problems
-	gc.collect()
-
-	#* Read stop_times file
-	#* Line format is
-	# trip_id,arrival_time,departure_time,stop_id,stop_sequence,shape_dist_traveled,pickup_type,drop_off_type
-	filePath = extractPath + "stop_times.txt"
-	with open(filePath, 'r', encoding = "utf8") as file:
-		linesStopTimes = list(csv.reader(file, delimiter = ','))
-
-	#* Read trips file
-	#* Line format is
-	# route_id,service_id,trip_id,trip_headsign,direction_id,shape_id,calendar_desc
-	filePath = extractPath + "trips.txt"
-	with open(filePath, 'r', encoding = "utf8") as file:
-		linesTrips = list(csv.reader(file, delimiter = ','))
-
-
-	# These will speed up the program
-	tripsPosition = 1 		
-	stopTimesRoutesPosition = 1	
-	stopTimesTimePosition = 1
-
-	# This is to take care of out-of-order trips that may arise
-	dicStops = {}	# key = str(RouteID) + str(Direction)
-	dicTime = {}	# key = TripID
-
-	skipped = False
-	skippedTrips = []
-
-	#? This huge for loop will go through every route and every line on trips.txt
-	#? It will first populate the table BusRoutes with the stops of each route and then it will populate the table BusTrips with all the trips
-	for route in routes:
-		print("-> Checking route", route)
-
-		stopsAdded = False
-		matched = False
-
-		#! This step assumes that trips of the same route are grouped together, which seems to be the case
-		
-		# First check skipped trips
-		for skippedTrip in skippedTrips:
-			if(skippedTrip[0] == route):  # Match
-				matched = True
-				trip = skippedTrip[2]
-				direction = skippedTrip[4]
-
-				#? Routes in one way may have different stops when compared to the same route in the other way (one way streets and such)
-				
-				# Check to see if stops were already added
-				if(stopsAdded == False):
-					#* First check if any of the routes there were out of order is the required one
-					hadItSaved = False
-					index = str(route) + str(direction)
-					for savedIndex, savedStops in dicStops.items():
-						if(savedIndex == index):	# Match
-							stops = savedStops
-							hadItSaved = True
-							print("Had stops of RouteDirectionID", index, "saved")
-							del dicStops[f"{index}"]
-							break
-
-					if not hadItSaved:
-						# Go to stop_times and retrieve stops
-						stops = []
-
-						stopsRetrieved = False
-						#? Order of RouteID is not the same in routes.txt and in stop_times.txt
-						for rowStopTimes in linesStopTimes[stopTimesRoutesPosition:]:	
-							if(rowStopTimes[0] == trip):
-								stops.append(int(rowStopTimes[3]))
-								stopsRetrieved = True
-							elif stopsRetrieved:	# Already added all stops, skip trip (and route)
-								break
-							else:
-								#print("Tried to find", trip, "and found", rowStopTimes[0])
-								#* Order broke, save next stops on dictionary
-								# Since the program doesn't know to which route the found trip relates to, it needs to do some backtracking
-								tripFound = rowStopTimes[0]
-
-								found = False
-								# First check skipped trips
-								for skippedTrip in skippedTrips:
-									if(skippedTrip[2] == tripFound):	# Found a match
-										routeBacktrack = skippedTrip[0]
-										directionBacktrack = skippedTrip[4]
-										found = True
-										break
-								
-								# If still not found, check trips.txt
-								if not found:
-									for rowTripsBacktrack in linesTrips[tripsPosition:]:
-										if(rowTripsBacktrack[2] == tripFound):	# Found a match
-											routeBacktrack = rowTripsBacktrack[0]
-											directionBacktrack = rowTripsBacktrack[4]
-											break
-
-								index = str(routeBacktrack) + str(directionBacktrack)
-								# Create new entry in dictionary if it doesn't exist
-								if(index in dicStops.keys()):
-									alreadyAddedStops = dicStops.get(f"{index}")
-									found = False
-									for stop in alreadyAddedStops:
-										if(stop == int(rowStopTimes[3])):
-											found = True
-											break
-
-									# The first one can appear again in the end (only once)
-									if(not found or (stop == alreadyAddedStops[0] and int(rowStopTimes[4]) != 1 and alreadyAddedStops[-1] != stop)):
-										alreadyAddedStops.append(int(rowStopTimes[3]))
-										dicStops[f"{index}"] = alreadyAddedStops
-										#print("Added stop", int(rowStopTimes[3]), "to dicStops in entry", index)
-								else:
-									alreadyAddedStops = []
-									alreadyAddedStops.append(int(rowStopTimes[3]))
-									dicStops[f"{index}"] = alreadyAddedStops
-									#print("Created entry", index, "in dicStops, and added stop", int(rowStopTimes[3]))
-
-							stopTimesRoutesPosition += 1
-					stopsAdded = True
-
-					#? Inserting information like this on the DB will reduce the memory necessity of the server
-					# Insert information into BusRoutes
-					index = str(route) + str(direction)
-					queryRow = [index, route, json.dumps(stops)]
-					if(int(direction) == '0'):
-						queryRow.append(False)
-					else:
-						queryRow.append(True)
-
-					# Ready query for BusRoutes
-					queryBusRoutes = "INSERT INTO BusRoutes (RouteDirectionID, RouteID, Stops, Direction) VALUES (%s, %s, %s, %s)"
-
-					# Execute query
-					try:
-						cursor = conn.cursor()
-						cursor.execute(queryBusRoutes, queryRow)
-						conn.commit()
-						cursor.close()
-					except Error as error:
-						print("Error while setting values for row of RouteDirectionID", index, f"on table BusRoutes -> {error}")
-						return False
-
-				else:	# Already have stops from this route, skip until next trip
-					for rowStopTimes in linesStopTimes[stopTimesRoutesPosition:]:
-						if(rowStopTimes[0] == trip):
-							stopTimesRoutesPosition += 1
-						else:
-							break
-
-
-				#? Now get stop times
-				#* tempEntry will be [RouteID, RouteService, stopTimes]
-				tempEntry = []
-				tempEntry.append(route)
-				tempEntry.append(rowTrips[1]) # TODO YOU WERE HERE
-
-				# Go to trip to get starting time
-				trip = rowTrips[2]
-
-				#* First check if any of the trips there were out of order is the required one
-				hadItSaved = False
-				for savedTrip, savedTime in dicTime.items():
-					if(savedTrip == trip):	# Match
-						tempEntry.append(savedTime)
-						hadItSaved = True
-						print("Had time of trip", trip, "saved in dictionary")
-						del dicTime[f"{trip}"]
-						break
+		chunks = getStopTimesChunks(feedPath)
 
-				if not hadItSaved:
-					timeAdded = False
-					#? Order of RouteID is not the same in routes.txt and in stop_times.txt
-					for rowStopTimes in linesStopTimes[stopTimesTimePosition:]: 
-						if(rowStopTimes[0] == trip):  # Match, get starting time if not already added
-							if(len(tempEntry) == 2):
-								time = rowStopTimes[1]	
-								if(int(time[:2]) >= 24):	# Carris thinks the day has 25 hours sometimes
-									timeDiff = 24 - int(time[:2])
-									timeShown = 24 + timeDiff
-									time = time.replace(str(timeShown), str(timeDiff), 1)
-								tempEntry.append(time)
-								timeAdded = True
-						elif timeAdded:	# Already added, next trip
-								break
-						else:
-							#* Order broke, save next starting time in a dictionary
-							# Create new entry in dictionary if it doesn't exist
-							if(rowStopTimes[0] not in dicTime.keys()):
-								print("Added entry to dicTime for trip", rowStopTimes[0], "->", rowStopTimes[1])
-								dicTime[f"{rowStopTimes[0]}"] = rowStopTimes[1]
-						
-						stopTimesTimePosition += 1
-
-				#? Inserting information like this on the DB will reduce the memory necessity of the server
-				# Insert information into BusTrips
-				queryRow = [tempEntry[0], tempEntry[1], tempEntry[2]]
-				
-				# Ready query for BusTrips
-				queryBusTrips = "INSERT INTO BusTrips (RouteID, RouteService, StartingTime) VALUES (%s, %s, %s)"
-
-				# Execute query
-				try:
-					cursor = conn.cursor()
-					cursor.execute(queryBusTrips, queryRow)
-					conn.commit()
-					cursor.close()
-				except Error as error:
-					print("Error while setting values for row of RouteID", tempEntry[0], ", RouteService", tempEntry[1], "and StartingTime", tempEntry[2], f"on table BusTrips -> {error}")
-					return False
-				
-		for rowTrips in linesTrips[tripsPosition:]:
-			if(rowTrips[0] == route):  # Match
-				matched = True
-				trip = rowTrips[2]
-				direction = rowTrips[4]
-
-				#? Routes in one way may have different stops when compared to the same route in the other way (one way streets and such)
-				
-				# Check to see if stops were already added
-				if(stopsAdded == False):		#TODO in two routes of same RouteID but diff direction, program will skip latter
-					#* First check if any of the routes there were out of order is the required one
-					hadItSaved = False
-					index = str(route) + str(direction)
-					for savedIndex, savedStops in dicStops.items():
-						if(savedIndex == index):	# Match
-							stops = savedStops
-							hadItSaved = True
-							print("Had stops of RouteDirectionID", index, "saved")
-							del dicStops[f"{index}"]
-							break
-
-					if not hadItSaved:
-						# Go to stop_times.txt and retrieve stops
-						stops = []
-
-						stopsRetrieved = False
-						#? Order of RouteID is not the same in routes.txt and in stop_times.txt
-						for rowStopTimes in linesStopTimes[stopTimesRoutesPosition:]:	
-							if(rowStopTimes[0] == trip):
-								stops.append(int(rowStopTimes[3]))
-								stopsRetrieved = True
-							elif stopsRetrieved:	# Already added all stops, skip trip (and route)
-								break
-							else:
-								#print("Tried to find", trip, "and found", rowStopTimes[0])
-								#* Order broke, save next stops on dictionary
-								# Since the program doesn't know to which route the found trip relates to, it needs to do some backtracking
-								tripFound = rowStopTimes[0]
-
-								found = False
-								# First check skipped trips
-								for skippedTrip in skippedTrips:
-									if(skippedTrip[2] == tripFound):	# Found a match
-										routeBacktrack = skippedTrip[0]
-										directionBacktrack = skippedTrip[4]
-										found = True
-										break
-								
-								# If still not found, check trips.txt
-								if not found:
-									for rowTripsBacktrack in linesTrips[tripsPosition:]:
-										if(rowTripsBacktrack[2] == tripFound):	# Found a match
-											routeBacktrack = rowTripsBacktrack[0]
-											directionBacktrack = rowTripsBacktrack[4]
-											break
-
-								index = str(routeBacktrack) + str(directionBacktrack)
-								# Create new entry in dictionary if it doesn't exist
-								if(index in dicStops.keys()):
-									alreadyAddedStops = dicStops.get(f"{index}")
-									found = False
-									for stop in alreadyAddedStops:
-										if(stop == int(rowStopTimes[3])):
-											found = True
-											break
-
-									# The first one can appear again in the end (only once)
-									if(not found or (stop == alreadyAddedStops[0] and int(rowStopTimes[4]) != 1 and alreadyAddedStops[-1] != stop)):
-										alreadyAddedStops.append(int(rowStopTimes[3]))
-										dicStops[f"{index}"] = alreadyAddedStops
-										#print("Added stop", int(rowStopTimes[3]), "to dicStops in entry", index)
-								else:
-									alreadyAddedStops = []
-									alreadyAddedStops.append(int(rowStopTimes[3]))
-									dicStops[f"{index}"] = alreadyAddedStops
-									#print("Created entry", index, "in dicStops, and added stop", int(rowStopTimes[3]))
-
-							stopTimesRoutesPosition += 1
-
-					stopsAdded = True
-
-					#? Inserting information like this on the DB will reduce the memory necessity of the server
-					# Insert information into BusRoutes
-					index = str(route) + str(direction)
-					queryRow = [index, route, json.dumps(stops)]
-					if(int(direction) == '0'):
-						queryRow.append(False)
-					else:
-						queryRow.append(True)
-
-					# Ready query for BusRoutes
-					queryBusRoutes = "INSERT INTO BusRoutes (RouteDirectionID, RouteID, Stops, Direction) VALUES (%s, %s, %s, %s)"
-
-					# Execute query
-					try:
-						cursor = conn.cursor()
-						cursor.execute(queryBusRoutes, queryRow)
-						conn.commit()
-						cursor.close()
-					except Error as error:
-						print("Error while setting values for row of RouteDirectionID", index, f"on table BusRoutes -> {error}")
-						return False
-
-				else:	# Already have stops from this route, skip until next trip
-					#! This is assuming same order of trips in trips.txt and in stop_times.txt, which seems to be the case
-					for rowStopTimes in linesStopTimes[stopTimesRoutesPosition:]:
-						if(rowStopTimes[0] == trip):
-							stopTimesRoutesPosition += 1
-						else:
-							break
-
-
-				#? Now get stop times
-				#* tempEntry will be [RouteID, RouteService, stopTimes]
-				tempEntry = []
-				tempEntry.append(route)
-				tempEntry.append(rowTrips[1]) # TODO YOU WERE HERE
-
-				# Go to trip to get starting time
-				trip = rowTrips[2]
-
-				#* First check if any of the trips there were out of order is the required one
-				hadItSaved = False
-				for savedTrip, savedTime in dicTime.items():
-					if(savedTrip == trip):	# Match
-						tempEntry.append(savedTime)
-						hadItSaved = True
-						print("Had time of trip", trip, "saved in dictionary")
-						del dicTime[f"{trip}"]
-						break
+	try:
+		with phase(f"write {tableName}"):
+			writer = openWriter(conn, tableName, STOP_TIMES_COLUMNS, batchSize, commitEvery or STOP_TIMES_COMMIT_EVERY, fastLoad, prepared)
+			for chunk in chunks:
+				for row in chunk:
+					writer.add(row)
+				addRows(len(chunk))
+			writer.close()
+		print(f"Table {tableName} set -> {writer.rowsWritten} rows")
+	except Error as error:
+		safeRollback(conn)
+		print(f"Error while setting values for table {tableName} -> '{error}'")
+		return False
 
-				if not hadItSaved:
-					timeAdded = False
-					#? Order of RouteID is not the same in routes.txt and in stop_times.txt
-					for rowStopTimes in linesStopTimes[stopTimesTimePosition:]: 
-						if(rowStopTimes[0] == trip):  # Match, get starting time if not already added
-							if(len(tempEntry) == 2):
-								time = rowStopTimes[1]	
-								if(int(time[:2]) >= 24):	# Carris thinks the day has 25 hours sometimes
-									timeDiff = 24 - int(time[:2])
-									timeShown = 24 + timeDiff
-									time = time.replace(str(timeShown), str(timeDiff), 1)
-								tempEntry.append(time)
-								timeAdded = True
-						elif timeAdded:	# Already added, next trip
-								break
-						else:
-							#* Order broke, save next starting time in a dictionary
-							# Create new entry in dictionary if it doesn't exist
-							if(rowStopTimes[0] not in dicTime.keys()):
-								print("Added entry to dicTime for trip", rowStopTimes[0], "->", rowStopTimes[1])
-								dicTime[f"{rowStopTimes[0]}"] = rowStopTimes[1]
-						
-						stopTimesTimePosition += 1
-
-				#? Inserting information like this on the DB will reduce the memory necessity of the server
-				# Insert information into BusTrips
-				queryRow = [tempEntry[0], tempEntry[1], tempEntry[2]]
-				
-				# Ready query for BusTrips
-				queryBusTrips = "INSERT INTO BusTrips (RouteID, RouteService, StartingTime) VALUES (%s, %s, %s)"
-
-				# Execute query
-				try:
-					cursor = conn.cursor()
-					cursor.execute(queryBusTrips, queryRow)
-					conn.commit()
-					cursor.close()
-				except Error as error:
-					print("Error while setting values for row of RouteID", tempEntry[0], ", RouteService", tempEntry[1], "and StartingTime", tempEntry[2], f"on table BusTrips -> {error}")
-					return False
+	return True
 
-			elif matched:	# Already checked everything related to this route
-				break
-			else:				# Save skipped trip
-				skippedTrips.append(rowTrips)
-			
-			tripsPosition += 1
+# Tables built from the departures index of the feed cache, always set together
+DEPARTURE_TABLES = ["StopDepartures", "ServiceDayTypes"]
+STOP_DEPARTURES_COLUMNS = ["StopID", "DayType", "DepartureTime", "TripID", "StopSequence", "RouteID", "PatternID"]
+
+# Groups of tables that are always set together
+TABLE_GROUPS = [ROUTE_TABLES, DEPARTURE_TABLES]
+
+def getTableGroup(tableName):
+	for tables in TABLE_GROUPS:
+		if tableName in tables:
+			return list(tables)
+	return [tableName]
+
+def getDepartureDigest(row):
+	# First 60 bits of the SHA-256 of a StopDepartures row, as the server's CONV(LEFT(SHA2(CONCAT_WS('\t', <columns>), 256), 15), 16, 10) gives it
+	return int(hashlib.sha256("\t".join(str(value) for value in row).encode("utf8")).hexdigest()[:15], 16)
+
+def syncStopDepartures(conn, tableName, departures):
+	#* Verifies StopDepartures against the departures index by DayType, deleting the day types it has that differ or are gone
+	#* Each day type is compared by its number of rows and the sum of their digests, which the server adds up in one pass,
+	#* so no row is fetched and only the day types that changed are written again
+	#? CRC32 is linear, XORs of it cancel out when two rows swap their times, a SHA-256 digest doesn't
+	#* Returns the day types to write, or None in case of error
+	# Digests are cast to integers before they are added, a SUM of strings would be a DOUBLE
+	query = (f"SELECT DayType, COUNT(*), SUM(CAST(CONV(LEFT(SHA2(CONCAT_WS('\\t', {', '.join(STOP_DEPARTURES_COLUMNS)}), 256), 15), 16, 10) AS UNSIGNED)) "
+		f"FROM {tableName} GROUP BY DayType")
+
+	def fetchDigests():
+		cursor = conn.cursor()
+		cursor.execute(query)
+		METRICS["statements"] += 1
+		rows = cursor.fetchall()
+		cursor.close()
+		return rows
+
+	try:
+		dbDigests = {dayType: [int(count), int(digest)] for dayType, count, digest
+			in runWithRetry(conn, fetchDigests, f"reading digests of table {tableName}")}
+	except Error as error:
+		print(f"Error while reading table {tableName} -> '{error}'")
+		return None
+
+	feedDigests = {}	# key = DayType, value = [rows, sum of their digests]
+	for chunk in nextDepartures.getStopDeparturesChunks(departures):
+		for row in chunk:
+			digest = feedDigests.get(row[1])
+			if(digest == None):
+				digest = feedDigests[row[1]] = [0, 0]
+			digest[0] += 1
+			digest[1] += getDepartureDigest(row)
+
+	changed = {dayType for dayType, digest in feedDigests.items() if dbDigests.get(dayType) != digest}
+	stale = [dayType for dayType, digest in dbDigests.items() if feedDigests.get(dayType) != digest]
+
+	# A day type per transaction, a crash in between leaves day types missing, which the next run writes again
+	def delete(dayType):
+		cursor = conn.cursor()
+		cursor.execute(f"DELETE FROM {tableName} WHERE DayType = %s", (dayType,))
+		conn.commit()
+		METRICS["statements"] += 1
+		METRICS["commits"] += 1
+		cursor.close()
+
+	try:
+		for dayType in stale:
+			runWithRetry(conn, lambda: delete(dayType), f"deleting day type {dayType} of table {tableName}")
+	except Error as error:
+		safeRollback(conn)
+		print(f"Error while deleting rows of table {tableName} -> '{error}'")
+		return None
+
+	print(f"Table {tableName} verified by day type -> {len(feedDigests) - len(changed)} unchanged, {len(changed)} to write, {len(stale)} deleted")
+	return changed
+
+def setStopDepartures(feedPath, conn, clearedStopDepartures, clearedServiceDayTypes, batchSize = BATCH_SIZE, commitEvery = COMMIT_EVERY, fastLoad = False, prepared = False, tableSuffix = ""):
+	#* Sets StopDepartures and ServiceDayTypes from the departures index (see nextDepartures.py), whatever the source
+	#* The index is built in the feed's cache on first use, the app's lookups and these tables then come from the same one
+	stopDeparturesName = "StopDepartures" + tableSuffix
+	serviceDayTypesName = "ServiceDayTypes" + tableSuffix
+	try:
+		with phase("build departures index"):
+			departures = nextDepartures.openNextDepartures(feedPath)
+	except (OSError, ValueError, KeyError) as error:
+		print(f"Error while building the departures index -> '{error}'")
+		return False
+
+	# As many rows as StopTimes or more, too many to verify one by one, they are verified by day type instead
+	dayTypes = None	# Day types to write, all of them when the table was cleared
+	if not clearedStopDepartures:
+		print(f"Verifying table {stopDeparturesName}")
+		with phase(f"verify {stopDeparturesName}"):
+			dayTypes = syncStopDepartures(conn, stopDeparturesName, departures)
+		if(dayTypes == None):
+			return False
+	print(f"Setting table {stopDeparturesName}")
+
+	try:
+		with phase(f"write {stopDeparturesName}"):
+			writer = openWriter(conn, stopDeparturesName, STOP_DEPARTURES_COLUMNS, batchSize, commitEvery or STOP_TIMES_COMMIT_EVERY, fastLoad, prepared)
+			if(dayTypes == None or dayTypes):
+				for chunk in nextDepartures.getStopDeparturesChunks(departures):
+					for row in chunk:
+						if(dayTypes == None or row[1] in dayTypes):
+							writer.add(row)
+					addRows(len(chunk))
+			writer.close()
+		print(f"Table {stopDeparturesName} set -> {writer.rowsWritten} rows in {len(departures.dayTypes) if dayTypes == None else len(dayTypes)} day types")
+	except Error as error:
+		safeRollback(conn)
+		print(f"Error while setting values for table {stopDeparturesName} -> '{error}'")
+		return False
+
+	# Day types go last, once their departures are there
+	queryRows = nextDepartures.getServiceDayTypesRows(departures)
+	if not clearedServiceDayTypes:
+		print(f"Verifying and setting table {serviceDayTypesName}")
+		with phase(f"write {serviceDayTypesName}"):
+			addRows(len(queryRows))
+			return syncTable(conn, serviceDayTypesName, ["ServiceDate", "DayType"], queryRows, batchSize) != None
+
+	try:
+		with phase(f"write {serviceDayTypesName}"):
+			writer = openWriter(conn, serviceDayTypesName, ["ServiceDate", "DayType"], batchSize, fastLoad = fastLoad, prepared = prepared)
+			for row in queryRows:
+				writer.add(row)
+			writer.close()
+			addRows(writer.rowsWritten)
+		print(f"Tables {stopDeparturesName} and {serviceDayTypesName} set")
+	except Error as error:
+		safeRollback(conn)
+		print(f"Error while setting values for table {serviceDayTypesName} -> '{error}'")
+		return False
 
-	print("Tables BusTrips and BusRoutes set")
 	return True
 
-def main():
-	# Handle SIGINTfrom user
-	signal.signal(signal.SIGINT, handler)
-    
-	# Download latest data set from Carris
-	extractPath = "./carrisMetropolitana/"
-	downloadZip(extractPath)
+def getSource(options):
+	# Where the rows are built from, the feed cache, the pandas pipeline or the streamed feed files
+	if options["--cache"]:
+		return "cache"
+	elif options["--pandas"]:
+		return "pandas"
+	return "stream"
+
+def setTables(tables, feedPath, conn, cleared, options, tableSuffix = ""):
+	#* Sets a group of tables that are loaded together, returns True on success
+	#* With tableSuffix, the tables with that suffix are set instead (like the staging tables of a reload)
+	source = getSource(options)
+	with phase("set " + " and ".join(table + tableSuffix for table in tables)):
+		if(tables == ["BusStops"]):
+			return setBusStops(feedPath, conn, cleared["BusStops"], options["--batch-size"], options["--fast-load"], source, options["--prepared"], tableSuffix)
+		elif(tables == ["ServiceModes"]):
+			return setServiceModes(feedPath, conn, cleared["ServiceModes"], options["--batch-size"], options["--fast-load"], source, options["--prepared"], tableSuffix)
+		elif(tables == ["ServiceCalendars"]):
+			return setServiceCalendars(feedPath, conn, options["--batch-size"], tableSuffix)
+		elif(tables == ["StopTimes"]):
+			return setStopTimes(feedPath, conn, cleared["StopTimes"], options["--batch-size"], options["--commit-every"], options["--fast-load"], source, options["--prepared"], tableSuffix)
+		elif(tables == DEPARTURE_TABLES):
+			return setStopDepartures(feedPath, conn, cleared["StopDepartures"], cleared["ServiceDayTypes"], options["--batch-size"], options["--commit-every"], options["--fast-load"], options["--prepared"], tableSuffix)
+		else:
+			return setBusTripsAndBusRoutes(feedPath, conn, cleared["BusTrips"], cleared["BusRoutes"], cleared["BusPatterns"], options["--batch-size"], options["--commit-every"], options["--fast-load"], source, options["--prepared"], tableSuffix)
 
-	# Create a connection to the DB
-	global conn
-	conn = DBConnection()
+def initWorker():
+	# SIGINT reaches every process of the terminal, but only the main one handles it (by terminating the workers)
+	signal.signal(signal.SIGINT, signal.SIG_IGN)
 
-	# These variables stop useless verification
-	clearedBusStops = False
-	clearedServiceModes = False
-	clearedBusTrips = False
-	clearedBusRoutes = False
+	# Workers are forked with the counts and phases of the main process, they report only their own
+	for key in METRICS:
+		METRICS[key] = 0
+	resetPhases()
 
-	# To exit in case of error
-	endProgram = False
+def setTablesWorker(tables, feedPath, cleared, options, tableSuffix):
+	# Each worker parses its own files and uses its own DB connection
+	#* Returns [success, DB metrics of the worker, phases of the worker]
+	conn = DBConnection()
+	if(conn == None):
+		return [False, METRICS, PHASES]
 
-	# Read command line arguments
-	numArgs = len(sys.argv) - 1
-	if(numArgs > 1):
-		while True:
-			if endProgram or argIter == numArgs:
+	try:
+		return [setTables(tables, feedPath, conn, cleared, options, tableSuffix), METRICS, PHASES]
+	finally:
+		conn.close()
+
+def runSets(groups, feedPath, conn, cleared, options, tableSuffix = ""):
+	#* Sets every group of tables, in parallel if --jobs is above 1
+	#* Returns the groups that were set
+	jobs = min(options["--jobs"], len(groups))
+	if(jobs <= 1):
+		done = []
+		for tables in groups:
+			if not setTables(tables, feedPath, conn, cleared, options, tableSuffix):
 				break
-			
-			argIter = 1
-			if(sys.argv[argIter] == "clear"):
-				for arg in range(argIter + 1, numArgs):
-					# Clear table BusStops
-					if(sys.argv[arg] == "BusStops"):
-						if(clearTable("BusStops", conn)):
-							clearedBusStops = True
-						else:
-							break
-
-					# Clear table ServiceModes
-					elif(sys.argv[arg] == "ServiceModes"):
-						if(clearTable("ServiceModes", conn)):
-							clearedServiceModes = True
-						else:
-							break
-
-					# Clear table BusTrips
-					elif(sys.argv[arg] == "BusTrips"):
-						if(clearTable("BusTrips", conn)):
-							clearedBusTrips = True
-						else:
-							break
-
-					# Clear table BusRoutes
-					elif(sys.argv[arg] == "BusRoutes"):
-						if(clearTable("BusRoutes", conn)):
-							clearedBusRoutes = True
-						else:
-							break
-
-					elif(sys.argv[arg] == "set"):
-						break
+			done.append(tables)
+		return done
 
-					else:
-						print("Unrecognized argument or invalid table ->", sys.argv[arg])
-						endProgram = True
-						break
-			
-			elif(sys.argv[argIter] == "set"):
-				alreadySet = False	# To not set BusTrips and BusRoutes twice
-				for arg in range(argIter + 1, numArgs):
-					# Set table BusStops
-					if(sys.argv[arg] == "BusStops"):
-						if not setBusStops(extractPath, conn, clearedBusStops):
-							break
-
-					# Set table ServiceModes
-					elif(sys.argv[arg] == "ServiceModes"):
-						if not setServiceModes(extractPath, conn, clearedServiceModes):
-							break
-
-					# Set table BusRoutes and BusTrips
-					elif(sys.argv[arg] == "BusTrips" or sys.argv[arg] == "BusRoutes"):
-						if not alreadySet:
-							alreadySet = True
-							if not setBusTripsAndBusRoutes(extractPath, conn, clearedBusTrips, clearedBusRoutes):
-								break
-
-					elif(sys.argv[arg] == "set"):
-						break
+	print(f"Setting {len(groups)} group(s) of tables with {jobs} processes")
+	pool = multiprocessing.Pool(jobs, initializer = initWorker)
+	try:
+		results = [[tables, pool.apply_async(setTablesWorker, (tables, feedPath, cleared, options, tableSuffix))] for tables in groups]
+		pool.close()
 
-					else:
-						print("Unrecognized argument or invalid table ->", sys.argv[arg])
-						endProgram = True
-						break
+		done = []
+		failed = []
+		for tables, result in results:
+			try:
+				success, metrics, phases = result.get()
+				mergeMetrics(metrics)
+				mergePhases(phases)
+				if success:
+					done.append(tables)
+				else:
+					failed.append(tables)
+			except Exception as error:
+				print(f"Error while setting table(s) {' and '.join(tables)} -> '{error}'")
+				failed.append(tables)
+		pool.join()
+	except KeyboardInterrupt:
+		# Uncommitted work of the workers is rolled back by the DB when their connections drop
+		pool.terminate()
+		pool.join()
+		raise
+
+	for tables in done:
+		print(f"Table(s) {' and '.join(tables)} -> set")
+	for tables in failed:
+		print(f"Table(s) {' and '.join(tables)} -> failed")
+	return done
+
+def runReload(groups, feedPath, conn, options):
+	#* Loads every group into staging tables while the live ones keep being read, then swaps them all in at once
+	#* Staging tables that weren't swapped in are dropped, whatever stopped the reload
+	#* Returns the groups that were swapped in
+	tableNames = [table for tables in groups for table in tables]
+	if not tableNames:
+		return []
+
+	swapped = False
+	try:
+		indexes = {}
+		for tableName in tableNames:
+			with phase(f"prepare {tableName}{STAGING_SUFFIX}"):
+				indexes[tableName] = prepareStaging(conn, tableName)
+			if(indexes[tableName] == None):
+				return []
+
+		# Staging tables start empty, so there's nothing to verify
+		cleared = {tableName: True for tableName in TABLE_FILES}
+		done = runSets(groups, feedPath, conn, cleared, options, STAGING_SUFFIX)
+		if(len(done) < len(groups)):
+			print("Not every staging table was set, live tables were kept")
+			return []
+
+		# Indexes are built once on the full tables, which is faster than keeping them up to date on every insert
+		for tableName in tableNames:
+			with phase(f"index {tableName}{STAGING_SUFFIX}"):
+				if not buildIndexes(conn, tableName, indexes[tableName]):
+					return []
+
+		with phase("swap"):
+			swapped = swapStaging(conn, tableNames)
+		return done if swapped else []
+	finally:
+		if not swapped:
+			safeRollback(conn)
+			dropStaging(conn, tableNames)
+
+def readOptions(args):
+	#* Splits "--option value" pairs from the commands, options can be anywhere in the command line
+	#* Returns [commands, options] or None if an option is invalid
+	options = {
+		"--batch-size": BATCH_SIZE,
+		"--commit-every": COMMIT_EVERY,
+		"--feed-url": FEED_URL,
+		"--jobs": 1,
+		"--metrics-dir": ".",
+		"--profile": "",
+	}
+	# Options without a value
+	flags = {
+		"--fast-load": False,
+		"--cache": False,
+		"--force": False,
+		"--pandas": False,
+		"--prepared": False,
+	}
+
+	commands = []
+	argIter = 0
+	while argIter < len(args):
+		arg = args[argIter]
+		if arg in flags:
+			flags[arg] = True
+			argIter += 1
+		elif arg.startswith("--"):
+			if arg not in options:
+				print("Unrecognized option ->", arg)
+				return None
+			if(argIter + 1 == len(args)):
+				print("Missing value for option ->", arg)
+				return None
 
+			try:
+				options[arg] = type(options[arg])(args[argIter + 1])
+			except ValueError:
+				print("Invalid value for option", arg, "->", args[argIter + 1])
+				return None
+			argIter += 2
+		else:
+			commands.append(arg)
 			argIter += 1
-	else:
+
+	if(options["--batch-size"] < 1):
+		print("Option --batch-size must be at least 1")
+		return None
+	if(options["--jobs"] < 1):
+		print("Option --jobs must be at least 1")
+		return None
+
+	options.update(flags)
+	return [commands, options]
+
+def main():
+	# Handle SIGINTfrom user
+	signal.signal(signal.SIGINT, handler)
+
+	# Read command line arguments
+	parsed = readOptions(sys.argv[1:])
+	if(parsed == None):
+		return
+	commands, options = parsed
+
+	if(len(commands) < 2):
 		print("Error. No command line arguments were given.")
 		print("Insert \"set <tableName>\" to verify and set table.")
 		print("Insert \"clear <tableName>\" to clear table.")
+		print("Insert \"reload <tableName>\" to set table in a staging copy and swap it in when done, the previous one is kept.")
+		print("Insert \"rollback <tableName>\" to put back the table replaced by the last reload.")
 		print("Commands can be chained\t(clear <tableName> <tableName> set <tableName>)")
+		print("All tables given to reload are swapped in together")
+		print("Tables\t" + ", ".join(TABLE_FILES) + " (StopTimes is too big to verify, set reloads it unless cleared first, StopDepartures is verified by day type)")
+		print("Options\t--batch-size <rows> (rows per INSERT, default " + str(BATCH_SIZE) + ")")
+		print("\t--commit-every <batches> (batches per commit on BusTrips, BusRoutes, BusPatterns, StopTimes and StopDepartures, default " + str(COMMIT_EVERY) + " commits once per table or every " + str(MAX_UNCOMMITTED) + " batches, every " + str(STOP_TIMES_COMMIT_EVERY) + " on StopTimes and StopDepartures)")
+		print("\t--cache (build the rows from the memory-mapped cache of the feed, built on first use)")
+		print("\t--fast-load (load cleared tables with LOAD DATA LOCAL INFILE, falls back to INSERT if not allowed)")
+		print("\t--feed-url <url> (where to download the feed from, http(s):// or file://)")
+		print("\t--force (set tables even if the feed didn't change since they were last set)")
+		print("\t--pandas (build the rows with the vectorized pandas pipeline)")
+		print("\t--jobs <processes> (set BusStops, ServiceModes, ServiceCalendars, StopTimes, BusTrips/BusRoutes/BusPatterns and StopDepartures/ServiceDayTypes at the same time, default 1)")
+		print("\t--prepared (write full batches with server-side prepared INSERTs)")
+		print("\t--metrics-dir <dir> (where loadMetrics.json and loadMetrics.prom are written at the end of the run, default .)")
+		print("\t--profile <phase> (run that phase under cProfile, like \"download\" or \"parse BusStops\", stats go to <metrics dir>/profile.prof)")
+		return
+
+	# Check every command before touching the DB
+	commandNames = ["clear", "set", "reload", "rollback"]
+	for arg in commands:
+		if(arg not in commandNames and (arg not in TABLE_FILES or arg == commands[0])):
+			print("Unrecognized argument or invalid table ->", arg)
+			return
+    
+	if options["--profile"]:
+		os.makedirs(options["--metrics-dir"], exist_ok = True)
+		setProfiledPhase(options["--profile"], os.path.join(options["--metrics-dir"], "profile.prof"))
+
+	success = load(commands, options, commandNames)
+	writeMetrics(options["--metrics-dir"], success)
+
+def load(commands, options, commandNames):
+	#* Runs the commands, returns True if all of them succeeded
+	# Download latest data set from Carris, only if it changed since the last run
+	feedPath = "./CarrisMetropolitana.zip"
+	state = loadFeedState(feedPath)
+	try:
+		with phase("download"):
+			if downloadZip(feedPath, state, options["--feed-url"]):
+				print("Downloaded new feed")
+			else:
+				print("Feed didn't change since the last download, using local copy")
+	except (OSError, ValueError) as error:
+		if not os.path.exists(feedPath):
+			print(f"Error while downloading the feed -> '{error}'")
+			return False
+		print(f"Error while downloading the feed, using local copy -> '{error}'")
+	saveFeedState(feedPath, state)
+
+	# Tables whose files didn't change since they were last set are skipped
+	with phase("hash feed"):
+		hashes = hashFeedFiles(feedPath)
+
+	# Built once here, so parallel jobs only open it
+	if options["--cache"]:
+		try:
+			with phase("build cache"):
+				feedCache.openFeedCache(feedPath)
+		except (OSError, ValueError, KeyError) as error:
+			print(f"Error while building the feed cache -> '{error}'")
+			return False
+
+	# Create a connection to the DB
+	conn = DBConnection()
+	if(conn == None):
+		return False
+
+	# These stop useless verification
+	cleared = {tableName: False for tableName in TABLE_FILES}
+
+	# New tables are created the first time they are set
+	tableNames = [arg for arg in commands if arg in TABLE_FILES]
+	for tables in TABLE_GROUPS:
+		if any(tableName in tables for tableName in tableNames):
+			tableNames += tables
+	if not createTables(conn, tableNames):
+		conn.close()
+		return False
+
+	success = False
+	try:
+		# Sets and reloads are gathered and run together, before the next clear or rollback, or at the end
+		pending = {"set": [], "reload": []}
+		alreadyGrouped = {"set": [], "reload": [], "rollback": []}	# Groups of TABLE_GROUPS already gathered, to not set them more than once
+		command = None
+		for arg in commands + [None]:
+			if(arg == None or arg in ["clear", "rollback"]):
+				done = runSets(pending["set"], feedPath, conn, cleared, options)
+				done += runReload(pending["reload"], feedPath, conn, options)
+				for tables in done:
+					for table in tables:
+						setTableLoaded(state, table, hashes)
+				saveFeedState(feedPath, state)
+				if(len(done) < len(pending["set"]) + len(pending["reload"])):
+					break
+				if(arg == None):
+					success = True
+					break
+				pending = {"set": [], "reload": []}
+
+			if arg in commandNames:
+				command = arg
+
+			elif(command == "clear"):
+				if not clearTable(arg, conn):
+					break
+				cleared[arg] = True
+				clearTableLoaded(state, arg)
+				saveFeedState(feedPath, state)
+
+			else:
+				tables = getTableGroup(arg)
+				if(len(tables) > 1):
+					# Always together, they are built from the same files
+					if tables in alreadyGrouped[command]:
+						continue
+					alreadyGrouped[command].append(tables)
+
+				if(command == "rollback"):
+					if not rollbackSwap(conn, tables):
+						break
+					# The tables are back to an older feed, the next run has to set them again
+					for table in tables:
+						clearTableLoaded(state, table)
+					saveFeedState(feedPath, state)
+					continue
+
+				# Skip if the table is already set from this exact feed
+				if not options["--force"] and all(not cleared[table] and isTableLoaded(state, table, hashes) for table in tables):
+					print(f"Table(s) {' and '.join(tables)} already set from the current feed, skipping")
+					continue
+
+				# StopTimes can't be verified, rather than emptying the live table it's reloaded, readers never see it empty
+				if(command == "set" and tables == ["StopTimes"] and not cleared["StopTimes"]):
+					print("Table StopTimes is too big to verify, reloading it instead")
+					if tables not in pending["reload"]:
+						pending["reload"].append(tables)
+					continue
+
+				if tables not in pending[command]:
+					pending[command].append(tables)
+	except KeyboardInterrupt:
+		pass
 
 	# Terminate DB connection
 	conn.close()
+	printMetrics()
 	print("All done")
+	return success
 
 if(__name__ == "__main__"):
     main()
-
@@ -0,0 +1,137 @@
+from mysql.connector import Error
+from dbConnection import runWithRetry, METRICS
+
+#* Zero-downtime reloads
+#* Tables are loaded into <Table>_staging copies, which replace the live ones with a single (atomic) RENAME TABLE
+#* The replaced tables are kept as <Table>_old, so a reload can be rolled back with another RENAME TABLE
+
+STAGING_SUFFIX = "_staging"
+OLD_SUFFIX = "_old"
+
+def runStatements(conn, statements, description):
+	# DDL commits implicitly, so every statement stands on its own
+	def run():
+		cursor = conn.cursor()
+		for statement in statements:
+			cursor.execute(statement)
+			METRICS["statements"] += 1
+		cursor.close()
+
+	runWithRetry(conn, run, description)
+
+def getSecondaryIndexes(conn, tableName):
+	#* Returns {<index>: [<unique>, <type>, [<column definition>]]} of the indexes of tableName other than the primary key
+	#* Functional indexes are left out, they are kept on the table
+	query = ("SELECT INDEX_NAME, NON_UNIQUE, INDEX_TYPE, COLUMN_NAME, SUB_PART FROM information_schema.STATISTICS "
+		"WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME <> 'PRIMARY' ORDER BY INDEX_NAME, SEQ_IN_INDEX")
+
+	def fetch():
+		cursor = conn.cursor()
+		cursor.execute(query, (tableName,))
+		METRICS["statements"] += 1
+		rows = cursor.fetchall()
+		cursor.close()
+		return rows
+
+	indexes = {}
+	functional = set()
+	for name, nonUnique, indexType, column, subPart in runWithRetry(conn, fetch, f"reading indexes of {tableName}"):
+		if(column == None):
+			functional.add(name)
+			continue
+		index = indexes.setdefault(name, [not int(nonUnique), indexType, []])
+		index[2].append(f"`{column}`" + (f"({subPart})" if subPart != None else ""))
+
+	return {name: index for name, index in indexes.items() if name not in functional}
+
+def prepareStaging(conn, tableName):
+	#* Creates an empty <tableName>_staging like tableName, without its secondary indexes (they are built after the load)
+	#* A staging table left by a load that crashed is dropped first, its rows are never reused
+	#* Returns the dropped indexes, to be given to buildIndexes, or None in case of error
+	stagingName = tableName + STAGING_SUFFIX
+	try:
+		runStatements(conn, [f"DROP TABLE IF EXISTS {stagingName}", f"CREATE TABLE {stagingName} LIKE {tableName}"], f"creating table {stagingName}")
+
+		indexes = getSecondaryIndexes(conn, stagingName)
+		if indexes:
+			drops = ", ".join(f"DROP INDEX `{name}`" for name in indexes)
+			runStatements(conn, [f"ALTER TABLE {stagingName} {drops}"], f"dropping indexes of {stagingName}")
+	except Error as error:
+		print(f"Error while creating table {stagingName} -> '{error}'")
+		return None
+
+	print(f"Created table {stagingName}")
+	return indexes
+
+def buildIndexes(conn, tableName, indexes):
+	# Builds the indexes dropped by prepareStaging, all of them in a single pass over the loaded table
+	if not indexes:
+		return True
+
+	stagingName = tableName + STAGING_SUFFIX
+	definitions = []
+	for name, [unique, indexType, columns] in indexes.items():
+		if(indexType in ["FULLTEXT", "SPATIAL"]):
+			kind = f"{indexType} INDEX"
+		elif unique:
+			kind = "UNIQUE INDEX"
+		else:
+			kind = "INDEX"
+		definitions.append(f"ADD {kind} `{name}` ({', '.join(columns)})")
+
+	try:
+		print(f"Building indexes of table {stagingName}")
+		runStatements(conn, [f"ALTER TABLE {stagingName} {', '.join(definitions)}"], f"building indexes of {stagingName}")
+	except Error as error:
+		print(f"Error while building indexes of table {stagingName} -> '{error}'")
+		return False
+
+	return True
+
+def dropStaging(conn, tableNames):
+	#* Drops the staging tables of tableNames, after a reload that didn't swap them in
+	stagingNames = [tableName + STAGING_SUFFIX for tableName in tableNames]
+	try:
+		runStatements(conn, [f"DROP TABLE IF EXISTS {stagingName}" for stagingName in stagingNames], "dropping staging tables")
+	except Error as error:
+		print(f"Error while dropping table(s) {', '.join(stagingNames)}, the next reload drops them -> '{error}'")
+		return False
+
+	print(f"Dropped table(s) {', '.join(stagingNames)}")
+	return True
+
+def swapStaging(conn, tableNames):
+	#* Replaces every table with its staging copy in one atomic RENAME TABLE, readers never see a half-loaded table
+	#* The replaced tables are kept as <table>_old
+	renames = []
+	for tableName in tableNames:
+		renames.append(f"{tableName} TO {tableName}{OLD_SUFFIX}")
+		renames.append(f"{tableName}{STAGING_SUFFIX} TO {tableName}")
+
+	try:
+		drops = [f"DROP TABLE IF EXISTS {tableName}{OLD_SUFFIX}" for tableName in tableNames]
+		runStatements(conn, drops + [f"RENAME TABLE {', '.join(renames)}"], "swapping staging tables")
+	except Error as error:
+		print(f"Error while swapping staging tables, live tables were kept -> '{error}'")
+		return False
+
+	print(f"Swapped in table(s) {', '.join(tableNames)}, previous ones kept as *{OLD_SUFFIX}")
+	return True
+
+def rollbackSwap(conn, tableNames):
+	#* Puts back the tables replaced by the last swap, in one atomic RENAME TABLE
+	#* The tables taken out become <table>_old, so rolling back twice undoes the rollback
+	renames = []
+	for tableName in tableNames:
+		renames.append(f"{tableName} TO {tableName}_rollback")
+		renames.append(f"{tableName}{OLD_SUFFIX} TO {tableName}")
+		renames.append(f"{tableName}_rollback TO {tableName}{OLD_SUFFIX}")
+
+	try:
+		runStatements(conn, [f"RENAME TABLE {', '.join(renames)}"], "rolling back tables")
+	except Error as error:
+		print(f"Error while rolling back table(s) {', '.join(tableNames)} -> '{error}'")
+		return False
+
+	print(f"Rolled back table(s) {', '.join(tableNames)}")
+	return True
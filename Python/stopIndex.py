@@ -0,0 +1,204 @@
+import json
+import os
+import shutil
+import sys
+import time
+
+import numpy as np
+
+from feedCache import openFeedCache, CACHE_DIR
+
+#* Spatial index of the stops, to snap GPS fixes (of the GPS and Passengers tables) to their nearest stop
+#* Stops are projected to meters and bucketed in a uniform grid, a fix looks at the cells around its own in growing rings
+#* until no cell left can have a closer stop, so the nearest stop is always exact
+#* Lookups are vectorized, arrays of fixes are matched at once
+#* The index is kept in the feed's cache directory, so it's built once per feed
+#* python stopIndex.py <feed.zip> [fixes] benchmarks it with random fixes
+
+INDEX_VERSION = 2
+EARTH_RADIUS = 6371008.8	# Meters
+MIN_CELL_SIZE = 50			# Meters
+STOPS_PER_CELL = 2			# Stops per cell the grid is sized for, if they were spread evenly
+
+def project(latitudes, longitudes, originLatitude):
+	# Equirectangular projection around originLatitude, in meters, precise enough at the scale of a city
+	x = np.radians(longitudes) * EARTH_RADIUS * np.cos(np.radians(originLatitude))
+	y = np.radians(latitudes) * EARTH_RADIUS
+	return x, y
+
+def haversine(latitudes1, longitudes1, latitudes2, longitudes2):
+	# Distance in meters between points, element-wise
+	lat1 = np.radians(latitudes1)
+	lat2 = np.radians(latitudes2)
+	a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(np.radians(longitudes2 - longitudes1) / 2) ** 2
+	return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+
+class StopIndex:
+	#* Grid of stops, opened memory-mapped from indexPath
+	def __init__(self, indexPath):
+		with open(os.path.join(indexPath, "index.json"), 'r', encoding = "utf8") as file:
+			meta = json.load(file)
+		self.cellSize = meta["cellSize"]
+		self.originLatitude = meta["originLatitude"]
+		self.minX = meta["minX"]
+		self.minY = meta["minY"]
+		self.numX = meta["numX"]
+		self.numY = meta["numY"]
+
+		# Stops ordered by cell, the stops of cell c are cellStarts[c] to cellStarts[c + 1]
+		for name in ["cellStarts", "stopIds", "latitudes", "longitudes", "x", "y"]:
+			setattr(self, name, np.load(os.path.join(indexPath, name + ".npy"), mmap_mode = "r"))
+
+	def getCells(self, x, y):
+		# Cell coordinates of points, points outside the grid are in the cells of its border
+		cellX = np.clip(((x - self.minX) // self.cellSize).astype(np.int64), 0, self.numX - 1)
+		cellY = np.clip(((y - self.minY) // self.cellSize).astype(np.int64), 0, self.numY - 1)
+		return cellX, cellY
+
+	def searchCells(self, fixes, offsets, x, y, cellX, cellY, best, bestDistance):
+		# Compares fixes with every stop of their cells at offsets, updating best and bestDistance in place
+		cellStarts = np.asarray(self.cellStarts)
+		neighbourX = cellX[fixes, None] + np.array([offset[0] for offset in offsets])
+		neighbourY = cellY[fixes, None] + np.array([offset[1] for offset in offsets])
+		inside = (neighbourX >= 0) & (neighbourX < self.numX) & (neighbourY >= 0) & (neighbourY < self.numY)
+		cell = np.where(inside, neighbourX * self.numY + neighbourY, 0).ravel()
+		starts = cellStarts[cell]
+		counts = np.where(inside.ravel(), cellStarts[cell + 1] - starts, 0)
+		if not counts.any():
+			return
+
+		# Every (fix, stop) pair, grouped by fix
+		pairCell = np.repeat(np.arange(len(cell)), counts)
+		stop = starts[pairCell] + np.arange(len(pairCell)) - np.repeat(np.cumsum(counts) - counts, counts)
+		pairFix = fixes[pairCell // len(offsets)]
+		distance = (np.asarray(self.x)[stop] - x[pairFix]) ** 2 + (np.asarray(self.y)[stop] - y[pairFix]) ** 2
+
+		# Closest pair of each fix
+		fixCounts = counts.reshape(len(fixes), len(offsets)).sum(axis = 1)
+		found = fixCounts > 0
+		groupStarts = (np.cumsum(fixCounts) - fixCounts)[found]
+		closest = np.minimum.reduceat(distance, groupStarts)
+		first = np.flatnonzero(distance == np.repeat(closest, fixCounts[found]))
+		first = first[np.unique(pairFix[first], return_index = True)[1]]
+
+		# pairFix is grouped by fix in the order of fixes, so unique keeps that order
+		foundFixes = fixes[found]
+		closer = closest < bestDistance[foundFixes]
+		best[foundFixes[closer]] = stop[first][closer]
+		bestDistance[foundFixes[closer]] = closest[closer]
+
+	def nearest(self, latitudes, longitudes):
+		#* Returns [StopIDs, distances in meters] of the nearest stop to every fix
+		latitudes = np.asarray(latitudes, dtype = np.float64)
+		longitudes = np.asarray(longitudes, dtype = np.float64)
+		x, y = project(latitudes, longitudes, self.originLatitude)
+		cellX, cellY = self.getCells(x, y)
+
+		# Squared distance from every fix to the border of its cell, cells of ring r are at least that plus (r - 1) cells away
+		toBorder = np.minimum.reduce([x - (self.minX + cellX * self.cellSize), self.minX + (cellX + 1) * self.cellSize - x,
+			y - (self.minY + cellY * self.cellSize), self.minY + (cellY + 1) * self.cellSize - y])
+		toBorder = np.maximum(toBorder, 0)
+
+		best = np.zeros(len(x), dtype = np.int64)
+		bestDistance = np.full(len(x), np.inf)
+		active = np.arange(len(x))	# Fixes that can still find a closer stop
+		ring = 0
+		while len(active):
+			# Cells at exactly ring cells from the fix's own
+			offsets = [[offsetX, offsetY] for offsetX in range(-ring, ring + 1) for offsetY in range(-ring, ring + 1) if max(abs(offsetX), abs(offsetY)) == ring]
+			self.searchCells(active, offsets, x, y, cellX, cellY, best, bestDistance)
+			activeDistance = bestDistance[active]
+
+			# Done once the next ring is farther than the best stop, or there are no cells left
+			reach = toBorder[active] + ring * self.cellSize
+			active = active[(activeDistance > reach ** 2) & (ring < max(self.numX, self.numY))]
+			ring += 1
+
+		return np.asarray(self.stopIds)[best], haversine(latitudes, longitudes, np.asarray(self.latitudes)[best], np.asarray(self.longitudes)[best])
+
+def buildStopIndex(stopIds, latitudes, longitudes, indexPath, cellSize = None):
+	#* Builds the index of the given stops in indexPath
+	#* Without cellSize, cells are sized for STOPS_PER_CELL stops each
+	stopIds = np.asarray(stopIds, dtype = np.int64)
+	latitudes = np.asarray(latitudes, dtype = np.float64)
+	longitudes = np.asarray(longitudes, dtype = np.float64)
+	if not len(stopIds):
+		raise ValueError("no stops to index")
+
+	originLatitude = float(np.mean(latitudes))
+	x, y = project(latitudes, longitudes, originLatitude)
+	minX = float(x.min())
+	minY = float(y.min())
+	if(cellSize == None):
+		area = max((x.max() - minX) * (y.max() - minY), 1.0)
+		cellSize = max(MIN_CELL_SIZE, float(np.sqrt(area * STOPS_PER_CELL / len(stopIds))))
+	numX = int((x.max() - minX) // cellSize) + 1
+	numY = int((y.max() - minY) // cellSize) + 1
+
+	cell = ((x - minX) // cellSize).astype(np.int64) * numY + ((y - minY) // cellSize).astype(np.int64)
+	order = np.argsort(cell, kind = "stable")
+	arrays = {
+		"cellStarts": np.concatenate([[0], np.cumsum(np.bincount(cell, minlength = numX * numY))]).astype(np.int64),
+		"stopIds": stopIds[order],
+		"latitudes": latitudes[order],
+		"longitudes": longitudes[order],
+		"x": x[order],
+		"y": y[order],
+	}
+
+	# Written to a temporary directory first, so a crash never leaves a broken index
+	tempPath = indexPath.rstrip("/") + f".part{os.getpid()}"
+	shutil.rmtree(tempPath, ignore_errors = True)
+	os.makedirs(tempPath)
+	for name, array in arrays.items():
+		np.save(os.path.join(tempPath, name + ".npy"), array)
+	with open(os.path.join(tempPath, "index.json"), 'w', encoding = "utf8") as file:
+		json.dump({"version": INDEX_VERSION, "cellSize": cellSize, "originLatitude": originLatitude, "minX": minX, "minY": minY,
+			"numX": numX, "numY": numY}, file)
+
+	try:
+		os.rename(tempPath, indexPath)
+	except OSError:	# Someone else built it first
+		shutil.rmtree(tempPath, ignore_errors = True)
+
+def openStopIndex(feedPath, cacheDir = CACHE_DIR):
+	#* Opens the index of the stops of the feed at feedPath, building it (and the feed's cache) if needed
+	cache = openFeedCache(feedPath, cacheDir)
+	indexPath = os.path.join(cache.path, f"stopIndex{INDEX_VERSION}")
+	if not os.path.exists(indexPath):
+		print("Building index of the stops")
+		count = cache.listedStops
+		latitudes = np.asarray(cache.stopLat[:count])
+		longitudes = np.asarray(cache.stopLon[:count])
+		located = ~(np.isnan(latitudes) | np.isnan(longitudes))	# Stops without coordinates can't be found
+		buildStopIndex(np.asarray(cache.stopIds[:count])[located], latitudes[located], longitudes[located], indexPath)
+
+	return StopIndex(indexPath)
+
+def main():
+	if(len(sys.argv) not in [2, 3]):
+		print("Usage: python stopIndex.py <feed.zip> [fixes]")
+		sys.exit(2)
+	numFixes = int(sys.argv[2]) if len(sys.argv) == 3 else 100000
+
+	index = openStopIndex(sys.argv[1])
+
+	# Random fixes around the stops
+	rand = np.random.default_rng(0)
+	stop = rand.integers(0, len(index.stopIds), numFixes)
+	latitudes = np.asarray(index.latitudes)[stop] + rand.normal(0, 0.002, numFixes)
+	longitudes = np.asarray(index.longitudes)[stop] + rand.normal(0, 0.002, numFixes)
+
+	start = time.perf_counter()
+	stopIds, distances = index.nearest(latitudes, longitudes)
+	seconds = time.perf_counter() - start
+	print(f"{numFixes} fixes in {seconds * 1000:.1f} ms -> {numFixes / seconds / 1000:.0f} fixes/ms, median distance {np.median(distances):.0f} m")
+
+	# Checked against every stop on a sample
+	sample = slice(0, min(numFixes, 2000))
+	x, y = project(latitudes[sample], longitudes[sample], index.originLatitude)
+	expected = np.asarray(index.stopIds)[np.argmin((np.asarray(index.x)[None, :] - x[:, None]) ** 2 + (np.asarray(index.y)[None, :] - y[:, None]) ** 2, axis = 1)]
+	print("Matches brute force" if np.array_equal(expected, stopIds[sample]) else "Doesn't match brute force")
+
+if(__name__ == "__main__"):
+	main()
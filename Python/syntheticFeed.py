@@ -0,0 +1,82 @@
+import random
+import sys
+
+from datetime import date, timedelta
+from zipfile import ZipFile, ZIP_DEFLATED
+
+#* Synthetic GTFS feeds, with the files and columns of the Carris feed that the loader reads
+#* Routes alternate directions and every trip of a route stops at the same stops (reversed in direction 1)
+#* unless the route has more than one pattern per direction, pattern k > 0 skips the k-th stop and is more common the higher k is
+#* python syntheticFeed.py <feed.zip> <routes> <tripsPerRoute> <stopsPerTrip> [shuffle]
+
+SERVICES = ["DU", "SAB", "DOM", "FER"]
+FIRST_DAY = date(2023, 12, 1)
+NUM_DAYS = 90
+
+def makeFeed(feedPath, routes, tripsPerRoute, stopsPerTrip, shuffleStopTimes = False, shuffleTrips = False, seed = 0, patterns = 1):
+	#* Writes a feed to feedPath, returns the number of rows of stop_times.txt
+	#* shuffleStopTimes and shuffleTrips write the rows of stop_times.txt and trips.txt out of order, like some feeds do
+	#* patterns is the number of stop patterns of each direction of a route, at most stopsPerTrip
+	rand = random.Random(seed)
+
+	# Routes share some of their stops with the next route, like lines that cross
+	numStops = max(routes * stopsPerTrip // 2, stopsPerTrip)
+	stops = ["stop_id,stop_code,stop_name,stop_lat,stop_lon,zone_shift"]
+	for stop in range(numStops):
+		stops.append(f"{10000 + stop:06},{stop},Stop {stop},{38.6 + rand.random() * 0.3:.6f},{-9.3 + rand.random() * 0.4:.6f},0")
+
+	# Every service runs on some days of the feed's range
+	calendarDates = ["service_id,date,holiday,period,day_type,exception_type"]
+	for day in range(NUM_DAYS):
+		dayDate = (FIRST_DAY + timedelta(days = day)).strftime("%Y%m%d")
+		for service in SERVICES:
+			if(rand.random() < 0.6):
+				calendarDates.append(f"{service},{dayDate},0,1,1,1")
+
+	routesRows = ["route_id,agency_id,route_short_name,route_long_name,route_type"]
+	trips = []
+	stopTimes = []
+	for route in range(routes):
+		routeId = f"{1000 + route}_0"
+		routesRows.append(f"{routeId},1,{1000 + route},Route {route},3")
+		routeStops = [(route * stopsPerTrip // 2 + stop) % numStops for stop in range(stopsPerTrip)]
+
+		for trip in range(tripsPerRoute):
+			tripId = f"{routeId}_{trip}"
+			direction = trip % 2
+			pattern = rand.choices(range(patterns), weights = range(1, patterns + 1))[0] if patterns > 1 else 0
+			tripStops = [stop for position, stop in enumerate(routeStops) if position != pattern or pattern == 0]
+			trips.append(f"{routeId},{rand.choice(SERVICES)},{tripId},Headsign {route},{direction},{routeId}_{direction}")
+
+			# Trips start every few minutes from 05:00, the last ones go past 24:00
+			time = 5 * 3600 + trip * (20 * 3600 // max(tripsPerRoute, 1))
+			for sequence, stop in enumerate(tripStops[::-1] if direction else tripStops):
+				clock = f"{time // 3600:02}:{time // 60 % 60:02}:{time % 60:02}"
+				stopTimes.append(f"{tripId},{clock},{clock},{10000 + stop:06},{sequence + 1},0,0,{sequence * 0.4:.3f}")
+				time += rand.randint(60, 180)
+
+	if shuffleTrips:
+		rand.shuffle(trips)
+	if shuffleStopTimes:
+		rand.shuffle(stopTimes)
+
+	files = {
+		"stops.txt": stops,
+		"calendar_dates.txt": calendarDates,
+		"routes.txt": routesRows,
+		"trips.txt": ["route_id,service_id,trip_id,trip_headsign,direction_id,shape_id"] + trips,
+		"stop_times.txt": ["trip_id,arrival_time,departure_time,stop_id,stop_sequence,pickup_type,drop_off_type,shape_dist_traveled"] + stopTimes,
+	}
+	with ZipFile(feedPath, 'w', ZIP_DEFLATED) as zipfile:
+		for fileName, rows in files.items():
+			zipfile.writestr(fileName, "\n".join(rows) + "\n")
+
+	return len(stopTimes)
+
+if(__name__ == "__main__"):
+	if(len(sys.argv) not in [5, 6]):
+		print("Usage: python syntheticFeed.py <feed.zip> <routes> <tripsPerRoute> <stopsPerTrip> [shuffle]")
+		sys.exit(2)
+	shuffle = len(sys.argv) == 6 and sys.argv[5] == "shuffle"
+	numRows = makeFeed(sys.argv[1], int(sys.argv[2]), int(sys.argv[3]), int(sys.argv[4]), shuffle, shuffle)
+	print(f"Wrote {sys.argv[1]} with {numRows} stop times")
@@ -0,0 +1,207 @@
+from mysql.connector import Error
+from dbConnection import runWithRetry, METRICS
+from stagingTables import runStatements
+
+#* Tables the loader creates itself when they don't exist yet, the others are described in DBSchema.ods
+#* Columns the loader needs on those other tables are added the same way
+
+TABLE_SCHEMAS = {
+	# One row per stop of every trip, times are seconds since the start of the service day (so they can go past 24:00)
+	#? StopSchedule answers "next departures from this stop for these services after this time"
+	"StopTimes": ("CREATE TABLE IF NOT EXISTS StopTimes ("
+		"TripID VARCHAR(64) NOT NULL, "
+		"StopSequence SMALLINT UNSIGNED NOT NULL, "
+		"StopID MEDIUMINT UNSIGNED NOT NULL, "
+		"RouteID VARCHAR(16) NOT NULL, "
+		"ServiceID VARCHAR(32) NOT NULL, "
+		"Direction BOOLEAN NOT NULL, "
+		"ArrivalTime MEDIUMINT UNSIGNED, "
+		"DepartureTime MEDIUMINT UNSIGNED, "
+		"PRIMARY KEY (TripID, StopSequence), "
+		"INDEX StopSchedule (StopID, ServiceID, DepartureTime)"
+		") ENGINE = InnoDB DEFAULT CHARSET = utf8mb4"),
+
+	# Departures of every stop per day type, the materialized index of nextDepartures.py
+	#? The primary key answers "next departures from this stop after this time" once the day's DayType is read from ServiceDayTypes
+	"StopDepartures": ("CREATE TABLE IF NOT EXISTS StopDepartures ("
+		"StopID MEDIUMINT UNSIGNED NOT NULL, "
+		"DayType CHAR(16) NOT NULL, "
+		"DepartureTime MEDIUMINT UNSIGNED NOT NULL, "
+		"TripID VARCHAR(64) NOT NULL, "
+		"StopSequence SMALLINT UNSIGNED NOT NULL, "
+		"RouteID VARCHAR(16) NOT NULL, "
+		"PatternID CHAR(16) NOT NULL, "
+		"PRIMARY KEY (StopID, DayType, DepartureTime, TripID, StopSequence)"
+		") ENGINE = InnoDB DEFAULT CHARSET = utf8mb4"),
+
+	# Day type of every day with service, DayType is segmentTimes.getDayType of the day's services like in SegmentTimes
+	"ServiceDayTypes": ("CREATE TABLE IF NOT EXISTS ServiceDayTypes ("
+		"ServiceDate INT UNSIGNED NOT NULL, "
+		"DayType CHAR(16) NOT NULL, "
+		"PRIMARY KEY (ServiceDate)"
+		") ENGINE = InnoDB DEFAULT CHARSET = utf8mb4"),
+
+	# Days each service runs, as the bitsets of serviceCalendar.py, bit d (of byte d DIV 8, from its lowest bit) is the d-th day from FirstDate
+	#? FirstDate is YYYYMMDD like ServiceModes.DayOfYear, a service runs on a day if ORD(SUBSTRING(Days, d DIV 8 + 1, 1)) >> (d % 8) & 1
+	"ServiceCalendars": ("CREATE TABLE IF NOT EXISTS ServiceCalendars ("
+		"ServiceID VARCHAR(32) NOT NULL, "
+		"FirstDate INT UNSIGNED NOT NULL, "
+		"NumDays SMALLINT UNSIGNED NOT NULL, "
+		"Days BLOB NOT NULL, "
+		"PRIMARY KEY (ServiceID)"
+		") ENGINE = InnoDB DEFAULT CHARSET = utf8mb4"),
+
+	# Every distinct sequence of stops of a route in one direction, see routePatterns.py
+	"BusPatterns": ("CREATE TABLE IF NOT EXISTS BusPatterns ("
+		"PatternID CHAR(16) NOT NULL, "
+		"RouteID VARCHAR(16) NOT NULL, "
+		"Direction BOOLEAN NOT NULL, "
+		"Stops JSON NOT NULL, "
+		"NumTrips INT UNSIGNED NOT NULL, "
+		"PRIMARY KEY (PatternID), "
+		"INDEX RouteDirection (RouteID, Direction)"
+		") ENGINE = InnoDB DEFAULT CHARSET = utf8mb4"),
+
+	# Last input row of each incremental job, see watermarks.py
+	"JobWatermarks": ("CREATE TABLE IF NOT EXISTS JobWatermarks ("
+		"Job VARCHAR(32) NOT NULL, "
+		"LastID BIGINT UNSIGNED NOT NULL, "
+		"UpdatedAt TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP, "
+		"PRIMARY KEY (Job)"
+		") ENGINE = InnoDB DEFAULT CHARSET = utf8mb4"),
+
+	# Every visit of a bus to a stop, from its first GPS fix near the stop, with the trip it was matched to (see gpsMatcher.py)
+	#? VisitTime is local time, ServiceDate is YYYYMMDD like ServiceModes.DayOfYear, Delay is in seconds (negative when early)
+	"StopVisits": ("CREATE TABLE IF NOT EXISTS StopVisits ("
+		"GPSID INT UNSIGNED NOT NULL, "
+		"UPLYID BIGINT NOT NULL, "
+		"StopID MEDIUMINT UNSIGNED NOT NULL, "
+		"VisitTime DATETIME NOT NULL, "
+		"TripID VARCHAR(64) NOT NULL, "
+		"RouteID VARCHAR(16) NOT NULL, "
+		"PatternID CHAR(16) NOT NULL, "
+		"Direction BOOLEAN NOT NULL, "
+		"ServiceDate INT UNSIGNED NOT NULL, "
+		"StopSequence SMALLINT UNSIGNED NOT NULL, "
+		"Delay MEDIUMINT NOT NULL, "
+		"PRIMARY KEY (GPSID), "
+		"INDEX TripVisits (TripID, ServiceDate, StopSequence), "
+		"INDEX BusVisits (UPLYID, VisitTime), "
+		"INDEX VisitTime (VisitTime)"
+		") ENGINE = InnoDB DEFAULT CHARSET = utf8mb4"),
+
+	# Trip each bus is currently running and its delay, Visits are its last stop visits, which the matcher resumes from
+	"VehicleTrips": ("CREATE TABLE IF NOT EXISTS VehicleTrips ("
+		"UPLYID BIGINT NOT NULL, "
+		"TripID VARCHAR(64) NULL, "
+		"RouteID VARCHAR(16) NULL, "
+		"PatternID CHAR(16) NULL, "
+		"Direction BOOLEAN NULL, "
+		"ServiceDate INT UNSIGNED NULL, "
+		"StopSequence SMALLINT UNSIGNED NULL, "
+		"StopID MEDIUMINT UNSIGNED NULL, "
+		"Delay MEDIUMINT NULL, "
+		"VisitTime DATETIME NULL, "
+		"LastGPSID INT UNSIGNED NOT NULL, "
+		"Visits JSON NOT NULL, "
+		"PRIMARY KEY (UPLYID), "
+		"INDEX RouteDirection (RouteID, Direction)"
+		") ENGINE = InnoDB DEFAULT CHARSET = utf8mb4"),
+
+	# Travel times between consecutive stops, per day type and local hour of the day, see segmentTimes.py
+	#? DayType is segmentTimes.getDayType of the day's ServiceModes.Services, the app looks segments up by the whole key
+	"SegmentTimes": ("CREATE TABLE IF NOT EXISTS SegmentTimes ("
+		"FromStopID MEDIUMINT UNSIGNED NOT NULL, "
+		"ToStopID MEDIUMINT UNSIGNED NOT NULL, "
+		"DayType CHAR(16) NOT NULL, "
+		"Hour TINYINT UNSIGNED NOT NULL, "
+		"NumTrips INT UNSIGNED NOT NULL, "
+		"TotalSeconds BIGINT UNSIGNED NOT NULL, "
+		"MeanSeconds FLOAT NOT NULL, "
+		"P50Seconds SMALLINT UNSIGNED NOT NULL, "
+		"P90Seconds SMALLINT UNSIGNED NOT NULL, "
+		"P95Seconds SMALLINT UNSIGNED NOT NULL, "
+		"Sketch BLOB NOT NULL, "
+		"PRIMARY KEY (FromStopID, ToStopID, DayType, Hour)"
+		") ENGINE = InnoDB DEFAULT CHARSET = utf8mb4"),
+
+	# Last capacity every bus reported, and the route it was on, see occupancyRollups.py
+	#? RouteDirection answers "capacity of the buses on this route now"
+	"VehicleOccupancy": ("CREATE TABLE IF NOT EXISTS VehicleOccupancy ("
+		"UPLYID BIGINT NOT NULL, "
+		"RouteID VARCHAR(16) NULL, "
+		"Direction BOOLEAN NULL, "
+		"TripID VARCHAR(64) NULL, "
+		"Capacity TINYINT UNSIGNED NOT NULL, "
+		"OpeningTime DATETIME NOT NULL, "
+		"Latitude DECIMAL(9,6) NULL, "
+		"Longitude DECIMAL(9,6) NULL, "
+		"LastOpeningID INT UNSIGNED NOT NULL, "
+		"PRIMARY KEY (UPLYID), "
+		"INDEX RouteDirection (RouteID, Direction)"
+		") ENGINE = InnoDB DEFAULT CHARSET = utf8mb4"),
+
+	# Occupancy of each route in buckets of local time, mean capacity is CapacitySum / Openings, see occupancyRollups.py
+	#? The primary key answers "capacity history of this route between these times"
+	"RouteOccupancy": ("CREATE TABLE IF NOT EXISTS RouteOccupancy ("
+		"RouteID VARCHAR(16) NOT NULL, "
+		"Direction BOOLEAN NOT NULL, "
+		"BucketStart DATETIME NOT NULL, "
+		"Openings INT UNSIGNED NOT NULL, "
+		"CapacitySum INT UNSIGNED NOT NULL, "
+		"MaxCapacity TINYINT UNSIGNED NOT NULL, "
+		"Boardings INT UNSIGNED NOT NULL, "
+		"Alightings INT UNSIGNED NOT NULL, "
+		"Journeys INT UNSIGNED NOT NULL, "
+		"PRIMARY KEY (RouteID, Direction, BucketStart)"
+		") ENGINE = InnoDB DEFAULT CHARSET = utf8mb4"),
+}
+
+# Columns the loader added to tables described in DBSchema.ods, {<table>: [[<column>, <definition>, <index or None>]]}
+#? FeedTripID is the trip_id of trips.txt, Fingerprint is routePatterns.getFingerprint of the row's other columns
+TABLE_COLUMNS = {
+	"BusTrips": [["PatternID", "CHAR(16) NULL", "INDEX Pattern (PatternID)"], ["FeedTripID", "VARCHAR(64) NULL", "INDEX FeedTrip (FeedTripID)"],
+		["Fingerprint", "CHAR(16) NULL", None]],
+	"BusRoutes": [["Fingerprint", "CHAR(16) NULL", None]],
+}
+
+def getMissingColumns(conn, tableName):
+	# Columns of TABLE_COLUMNS that tableName doesn't have yet
+	query = "SELECT COLUMN_NAME FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s"
+
+	def fetch():
+		cursor = conn.cursor()
+		cursor.execute(query, (tableName,))
+		METRICS["statements"] += 1
+		rows = cursor.fetchall()
+		cursor.close()
+		return rows
+
+	existing = {row[0] for row in runWithRetry(conn, fetch, f"reading columns of {tableName}")}
+	return [column for column in TABLE_COLUMNS[tableName] if column[0] not in existing]
+
+def createTables(conn, tableNames):
+	#* Creates the tables of tableNames that have a schema here, and adds the columns of TABLE_COLUMNS they are missing
+	#* Returns True on success
+	statements = [TABLE_SCHEMAS[tableName] for tableName in dict.fromkeys(tableNames) if tableName in TABLE_SCHEMAS]
+
+	try:
+		if statements:
+			runStatements(conn, statements, "creating tables")
+
+		for tableName in dict.fromkeys(tableNames):
+			if tableName not in TABLE_COLUMNS:
+				continue
+			additions = []
+			for column, definition, index in getMissingColumns(conn, tableName):
+				additions.append(f"ADD COLUMN {column} {definition}")
+				if(index != None):
+					additions.append(f"ADD {index}")
+			if additions:
+				print(f"Adding column(s) to table {tableName}")
+				runStatements(conn, [f"ALTER TABLE {tableName} {', '.join(additions)}"], f"altering table {tableName}")
+	except Error as error:
+		print(f"Error while creating tables -> '{error}'")
+		return False
+
+	return True
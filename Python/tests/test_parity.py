@@ -0,0 +1,145 @@
+import csv
+import io
+import json
+import os
+import sys
+
+from zipfile import ZipFile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import feedCache
+import gtfsFrames
+import setCarrisData
+import syntheticFeed
+from routePatterns import getPatternID, getFingerprint
+
+#* Rows of the streamed builders of setCarrisData.py, the pandas ones of gtfsFrames.py and the feed cache's have to be the same
+#* Checked on synthetic feeds written in order and out of order (see syntheticFeed.py), with one and several patterns per direction
+#* BusTrips, BusRoutes and BusPatterns are also checked against a plain builder below, and against rows written by hand
+
+# key = tables, value = [stream builder, pandas builder, cache builder]
+BUILDERS = {
+	"BusStops": [setCarrisData.getBusStopsRows, gtfsFrames.getBusStopsRows, feedCache.getBusStopsRows],
+	"ServiceModes": [setCarrisData.getServiceModesRows, gtfsFrames.getServiceModesRows, feedCache.getServiceModesRows],
+	"BusTrips, BusRoutes and BusPatterns": [setCarrisData.getBusTripsAndBusRoutesRows, gtfsFrames.getBusTripsAndBusRoutesRows,
+		feedCache.getBusTripsAndBusRoutesRows],
+}
+
+# Feed of a single route written by hand, its rows are the ones of makeExpectedRows
+#? Direction 0 has two patterns, the most common one comes second, trip 1's stop times are split (rows of other trips in between),
+#? trip 3 has no stop times, route 9 isn't in routes.txt, trip 4 starts past 24:00
+HAND_FEED = {
+	"stops.txt": ["stop_id,stop_name,stop_lat,stop_lon", "1,Stop 1,38.7,-9.1", "2,Stop 2,38.71,-9.11", "3,Stop 3,38.72,-9.12"],
+	"calendar_dates.txt": ["service_id,date,exception_type", "DU,20240101,1", "SAB,20240106,1"],
+	"routes.txt": ["route_id", "1"],
+	"trips.txt": ["route_id,service_id,trip_id,direction_id", "1,DU,t1,0", "1,DU,t2,0", "1,SAB,t3,0", "1,DU,t4,1", "1,SAB,t5,0",
+		"9,DU,t6,0"],
+	"stop_times.txt": ["trip_id,arrival_time,departure_time,stop_id,stop_sequence",
+		"t1,08:00:00,08:00:00,1,1", "t1,08:05:00,08:05:00,2,2",
+		"t2,09:00:00,09:00:00,1,1", "t2,09:07:00,09:07:00,3,2",
+		"t1,08:10:00,08:10:00,3,3",
+		"t4,25:10:00,25:10:00,3,1", "t4,25:15:00,25:15:00,2,2", "t4,25:20:00,25:20:00,1,3",
+		"t5,10:07:00,10:07:00,3,2", "t5,10:00:00,10:00:00,1,1",
+		"t6,11:00:00,11:00:00,1,1"],
+}
+
+def makeExpectedRows():
+	# [busRoutesRows, busTripsRows, busPatternsRows] of HAND_FEED
+	patterns = [["1", 0, (1, 2, 3), 1], ["1", 0, (1, 3), 2], ["1", 1, (3, 2, 1), 1]]
+	patternIds = [getPatternID(route, direction, stops) for route, direction, stops, _ in patterns]
+	tripsRows = [["t1", "1", "DU", "08:00:00", patternIds[0]], ["t2", "1", "DU", "09:00:00", patternIds[1]],
+		["t4", "1", "DU", "01:10:00", patternIds[2]], ["t5", "1", "SAB", "10:00:00", patternIds[1]]]
+	routesRows = [["10", "1", "[1, 3]", False], ["11", "1", "[3, 2, 1]", True]]
+	return [[row + [getFingerprint(row)] for row in routesRows], [row + [getFingerprint(row)] for row in tripsRows],
+		[[patternId, route, direction != 0, json.dumps(list(stops)), numTrips] for patternId, [route, direction, stops, numTrips]
+		in zip(patternIds, patterns)]]
+
+def readFile(feedPath, fileName):
+	with ZipFile(feedPath) as zipfile:
+		with zipfile.open(fileName) as member:
+			return list(csv.DictReader(io.TextIOWrapper(member, encoding = "utf-8-sig", newline = "")))
+
+def getReferenceRouteRows(feedPath):
+	#* BusRoutes, BusTrips and BusPatterns rows as routePatterns.buildRouteRows describes them, built the plain way:
+	#* every file read whole, the stop times of each trip sorted, the trips of each pattern counted
+	tripStopTimes = {}
+	for row in readFile(feedPath, "stop_times.txt"):
+		tripStopTimes.setdefault(row["trip_id"], []).append([int(row["stop_sequence"]), int(row["stop_id"]), row["arrival_time"]])
+	routes = list(dict.fromkeys(row["route_id"] for row in readFile(feedPath, "routes.txt")))
+	trips = readFile(feedPath, "trips.txt")
+
+	busRoutesRows = []
+	busTripsRows = []
+	busPatternsRows = []
+	for route in routes:
+		patterns = {}	# key = (Direction, stops), value = [PatternID, number of trips], in order of first trip
+		for trip in trips:
+			stopTimes = sorted(tripStopTimes.get(trip["trip_id"], []))
+			if(trip["route_id"] != route or not stopTimes):
+				continue
+			direction = int(trip["direction_id"])
+			stops = tuple(stop for _, stop, _ in stopTimes)
+			pattern = patterns.setdefault((direction, stops), [getPatternID(route, direction, stops), 0])
+			pattern[1] += 1
+			tripRow = [trip["trip_id"], route, trip["service_id"], setCarrisData.fixTime(stopTimes[0][2]), pattern[0]]
+			busTripsRows.append(tripRow + [getFingerprint(tripRow)])
+
+		for direction in dict.fromkeys(direction for direction, _ in patterns):
+			candidates = [[stops, numTrips] for (patternDirection, stops), [_, numTrips] in patterns.items() if patternDirection == direction]
+			stops = max(candidates, key = lambda candidate: candidate[1])[0]	# The first of the most common
+			routeRow = [route + str(direction), route, json.dumps(list(stops)), direction != 0]
+			busRoutesRows.append(routeRow + [getFingerprint(routeRow)])
+		busPatternsRows += [[patternId, route, direction != 0, json.dumps(list(stops)), numTrips]
+			for (direction, stops), [patternId, numTrips] in patterns.items()]
+
+	return [busRoutesRows, busTripsRows, busPatternsRows]
+
+def openFeed(path, feedPath):
+	# [feed path, its cache], the cache is built in the test's own directory
+	return [feedPath, feedCache.openFeedCache(feedPath, str(path / "cache"))]
+
+@pytest.fixture(scope = "module", params = ["ordered", "shuffled", "ordered patterns", "shuffled patterns"])
+def feed(request, tmp_path_factory):
+	path = tmp_path_factory.mktemp(request.param.replace(" ", "_"))
+	feedPath = str(path / "feed.zip")
+	shuffled = request.param.startswith("shuffled")
+	patterns = 4 if request.param.endswith("patterns") else 1
+	syntheticFeed.makeFeed(feedPath, 6, 40, 12, shuffleStopTimes = shuffled, shuffleTrips = shuffled, patterns = patterns)
+	return openFeed(path, feedPath) + [patterns]
+
+@pytest.fixture(scope = "module")
+def handFeed(tmp_path_factory):
+	path = tmp_path_factory.mktemp("hand")
+	feedPath = str(path / "feed.zip")
+	with ZipFile(feedPath, 'w') as zipfile:
+		for fileName, lines in HAND_FEED.items():
+			zipfile.writestr(fileName, "\n".join(lines) + "\n")
+	return openFeed(path, feedPath)
+
+@pytest.mark.parametrize("tables", list(BUILDERS))
+def test_builders_match(feed, tables):
+	feedPath, cache, _ = feed
+	getRows, getFrameRows, getCacheRows = BUILDERS[tables]
+	rows = getRows(feedPath)
+	assert rows
+	assert getFrameRows(feedPath) == rows
+	assert getCacheRows(cache) == rows
+
+def test_route_rows_match_reference(feed):
+	feedPath, _, patterns = feed
+	rows = [list(rows) for rows in setCarrisData.getBusTripsAndBusRoutesRows(feedPath)]
+	assert rows == getReferenceRouteRows(feedPath)
+	# Every direction of every route has one pattern, or more when the feed was written with more
+	busRoutesRows, _, busPatternsRows = rows
+	assert (len(busPatternsRows) > len(busRoutesRows)) == (patterns > 1)
+
+def test_hand_written_rows(handFeed):
+	feedPath, cache = handFeed
+	expected = makeExpectedRows()
+	assert getReferenceRouteRows(feedPath) == expected
+	for getRows, source in [[setCarrisData.getBusTripsAndBusRoutesRows, feedPath], [gtfsFrames.getBusTripsAndBusRoutesRows, feedPath],
+		[feedCache.getBusTripsAndBusRoutesRows, cache]]:
+		assert [list(rows) for rows in getRows(source)] == expected
@@ -0,0 +1,75 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import nextDepartures
+import setCarrisData
+
+#* StopDepartures is verified by day type, a day type whose rows changed has to be written again
+
+ROWS = [
+	[10001, "weekday", 28800, "1001_0_1", 3, "1001", "p1"],
+	[10001, "weekday", 29400, "1002_0_1", 3, "1001", "p1"],
+	[10002, "weekday", 29000, "1001_0_1", 4, "1001", "p1"],
+	[10001, "sunday", 36000, "1003_0_1", 3, "1001", "p1"],
+]
+
+def swapTimes(rows):
+	# Departures of the two trips at the first stop swapped, same ids, same lengths
+	rows = [list(row) for row in rows]
+	rows[0][2], rows[1][2] = rows[1][2], rows[0][2]
+	return rows
+
+class DigestCursor:
+	# Answers the digest query as the server would, from the rows of the connection
+	def __init__(self, conn):
+		self.conn = conn
+
+	def execute(self, query, params = None):
+		if query.startswith("DELETE"):
+			self.conn.deleted.append(params[0])
+		self.rows = []
+		if query.startswith("SELECT"):
+			digests = {}
+			for row in self.conn.rows:
+				digest = digests.setdefault(row[1], [0, 0])
+				digest[0] += 1
+				digest[1] += setCarrisData.getDepartureDigest(row)
+			self.rows = [(dayType, count, total) for dayType, (count, total) in digests.items()]
+
+	def fetchall(self):
+		return self.rows
+
+	def close(self):
+		pass
+
+class DigestConnection:
+	def __init__(self, rows):
+		self.rows = rows
+		self.deleted = []
+
+	def cursor(self, prepared = False):
+		return DigestCursor(self)
+
+	def commit(self):
+		pass
+
+	def rollback(self):
+		pass
+
+def test_swapped_times_change_the_digest():
+	digests = [sum(setCarrisData.getDepartureDigest(row) for row in rows[:2]) for rows in [ROWS, swapTimes(ROWS)]]
+	assert digests[0] != digests[1]
+
+def test_swapped_times_are_written_again(monkeypatch):
+	monkeypatch.setattr(nextDepartures, "getStopDeparturesChunks", lambda departures: [swapTimes(ROWS)])
+	conn = DigestConnection(ROWS)
+	assert setCarrisData.syncStopDepartures(conn, "StopDepartures", None) == {"weekday"}
+	assert conn.deleted == ["weekday"]
+
+def test_unchanged_rows_are_kept(monkeypatch):
+	monkeypatch.setattr(nextDepartures, "getStopDeparturesChunks", lambda departures: [ROWS])
+	conn = DigestConnection(ROWS)
+	assert setCarrisData.syncStopDepartures(conn, "StopDepartures", None) == set()
+	assert conn.deleted == []
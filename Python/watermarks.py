@@ -0,0 +1,29 @@
+from dbConnection import runWithRetry, METRICS
+
+#* Watermarks of the incremental jobs, the last ID of their input table they processed
+#* A job writes its watermark in the same transaction as its results, so a crash never skips nor repeats rows
+
+WATERMARKS_TABLE = "JobWatermarks"
+
+def readWatermark(cursor, job):
+	# Same as getWatermark, in the caller's transaction
+	cursor.execute(f"SELECT LastID FROM {WATERMARKS_TABLE} WHERE Job = %s", (job,))
+	METRICS["statements"] += 1
+	row = cursor.fetchone()
+	return 0 if row == None else int(row[0])
+
+def getWatermark(conn, job):
+	#* Returns the last ID job processed, 0 if it never ran
+	def fetch():
+		cursor = conn.cursor()
+		watermark = readWatermark(cursor, job)
+		cursor.close()
+		return watermark
+
+	return runWithRetry(conn, fetch, f"reading the watermark of {job}")
+
+def setWatermark(cursor, job, lastId):
+	# Runs in the caller's transaction, committed with the results it covers
+	query = f"INSERT INTO {WATERMARKS_TABLE} (Job, LastID) VALUES (%s, %s) ON DUPLICATE KEY UPDATE LastID = VALUES(LastID)"
+	cursor.execute(query, (job, lastId))
+	METRICS["statements"] += 1